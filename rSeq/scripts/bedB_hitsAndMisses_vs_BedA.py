@@ -40,6 +40,8 @@ in each 'side' of the double output.  'side' = keep the 'right' or
                       help="""Comma separated string of left and right window sizes **See "extractFromDoubleSidedBedtoolOut()" (default=%default)""")
     parser.add_option('--side', dest="side", type='string',default='right',
                       help="""**See "extractFromDoubleSidedBedtoolOut()". (default=%default)""")
+    parser.add_option('--bedtools', dest="bedtools", action='store_true',default=False,
+                      help="""Use windowBed/sort instead of the built-in interval index. (default=%default)""")
     
     
     (opts, args) = parser.parse_args()
@@ -61,4 +63,5 @@ in each 'side' of the double output.  'side' = keep the 'right' or
                       win=[int(x) for x in opts.win.split(',')],
                       cols=[int(x) for x in opts.cols.split(',')],
                       side=opts.side,
-                      outDir=opts.out)
+                      outDir=opts.out,
+                      useBedtools=opts.bedtools)
@@ -1,12 +1,13 @@
 import sys
 import os
 import optparse
+import shlex
 
 import pysam
 
 from rSeq.utils.errors import *
 from rSeq.utils.externals import mkdirp,runExternalApp
-from rSeq.utils.align import bowtie_align,samtools_sort,samtools_view,samtools_index
+from rSeq.utils.align import pipe_bowtie2srtd_idx_bam
 from rSeq.utils.sitRep import start_sitrep
 
 
@@ -20,7 +21,7 @@ if __name__ == "__main__":
     defaultBtOpts = '--solexa1.3-quals -v 2 -m 1 -S'
     
     #+++++++++++ File Parseing Etc +++++++++++
-    epilog = """DESCRIPTION: Runs bowtie, converts to BAM, sorts and indexes the BAM file to output directory.  Requires that BOWTIE_INDEXES environment variable be set to the home of your precompiled bowtie indexes.  Stared (*) arguments are required.  """
+    epilog = """DESCRIPTION: Runs bowtie, streams its output through conversion to BAM and sorting, then indexes the sorted BAM file in output directory.  Requires that BOWTIE_INDEXES environment variable be set to the home of your precompiled bowtie indexes.  Stared (*) arguments are required.  """
     
     usage = """python %prog --bt-index <idx_name> --bam-base <bam_name> --fastqs <fastq_files> --bt-opts <bowtie_options>"""
     parser = optparse.OptionParser(usage=usage, epilog=epilog)
@@ -45,6 +46,23 @@ if __name__ == "__main__":
     if len(sys.argv) == 1:
         parser.print_help()
         exit(0)
+    # check the mate files before anything is created
+    readArgs = shlex.split(opts.fastqs or '')
+    if ('-1' in readArgs) or ('-2' in readArgs):
+        mates = {}
+        for flag,mate in [('-1','fwd'),('-2','rev')]:
+            if flag not in readArgs:
+                parser.error('--fastqs: paired reads need both -1 and -2; the %s mate file (%s) is missing.' % (mate,flag))
+            i = readArgs.index(flag) + 1
+            if i == len(readArgs) or readArgs[i].startswith('-'):
+                parser.error('--fastqs: no %s mate file was given after %s.' % (mate,flag))
+            mates[flag] = readArgs[i]
+        fastq1 = mates['-1']
+        fastq2 = mates['-2']
+    else:
+        fastq1 = opts.fastqs
+        fastq2 = None
+    
     if opts.out_dir:
         mkdirp(opts.out_dir)
         opts.out_dir = opts.out_dir.rstrip('/')
@@ -67,37 +85,15 @@ if __name__ == "__main__":
     #   places in the file system in case of fatal errors
     os.chdir(opts.out_dir)
         
-    # Construct the bowtie comand
-    ##btResults = bowtie_align(ebwt=opts.bt_index,
-                             ##readsString=opts.fastqs,
-                             ##hit='%s.sam' % (opts.bam_base),
-                             ##runDir=opts.out_dir,
-                             ##options=opts.bt_opts)
-    
-    # +++ Convert SAM to BAM +++ #
-    samViewIn  = '%s/%s.sam' % (opts.out_dir,opts.bam_base)
-    samViewOut = '%s/%s.bam' % (opts.out_dir,opts.bam_base)
-    
-    samViewArgs = ['-b',         # output should be BAM
-                   '-S',         # input is SAM
-                   samViewIn,
-                   '-o',         # write output to file vs stdout
-                   samViewOut]
-    
-    #viewResults = pysam.view(*samViewArgs)
-    viewResults = samtools_view(samViewArgs)
-    
-    
-    # +++ Sort BAM +++ #
-    samSortIn   = samViewOut
-    samSortOut  = '%s/%s.srt' % (opts.out_dir,opts.bam_base)
-    samSortArgs = [samSortIn,samSortOut]
-    
-    sortResults = samtools_sort(samSortArgs)
-    
-    
-    # +++ Index BAM +++ #
-    samIndexArgs = [samSortOut+'.bam']
-    
-    indexResults = samtools_index(samIndexArgs)
+    # +++ bowtie | samtools view | samtools sort, then samtools index +++ #
+    # reads go straight from bowtie into the sorter: no SAM or unsorted BAM on disk
+    samSortOut = '%s/%s.srt' % (opts.out_dir,opts.bam_base)
+    pipeResults = pipe_bowtie2srtd_idx_bam(btIndex=opts.bt_index,
+                                           outPrefix=samSortOut,
+                                           fastq1=fastq1,
+                                           fastq2=fastq2,
+                                           options=opts.bt_opts)
+    
+    for stage,code in pipeResults.returncodes.iteritems():
+        print "%s exited with: %s" % (stage,code)
     
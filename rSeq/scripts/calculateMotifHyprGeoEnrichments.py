@@ -7,8 +7,9 @@ import random as r
 from time import time
 import math
 from matplotlib import pylab as pl
-from rSeq.utils.motifDiscovery.motifs import getEvalHitDict,parseSCOPEfile,parseXMSfile,motifHyprGeoEnrichment
+from rSeq.utils.motifDiscovery.motifs import getEvalHitDict,parseSCOPEfile,parseXMSfile,motifHyprGeoEnrichment,motifHyprGeoPermutations
 from rSeq.utils.motifDiscovery.rPossum import *
+from rSeq.utils.motifDiscovery.threshCache import ThreshCache
 from rSeq.utils.stats import seqStats
 from rSeq.utils.errors import *
 from rSeq.utils.externals import mkdirp
@@ -151,6 +152,12 @@ def main():
                       help="""Path to results dir -- must use full path (default=%default).""")
     parser.add_option('--plot-fdrs', dest="fdrs", type='int',default=0,
                       help="""How many random sets of genes equal in length to --genes to run for FDR estimation. (default=%default).""")
+    parser.add_option('--seed', type='int',default=None,
+                      help="""Random seed for the --plot-fdrs controls; the same seed gives the same controls with any --procs. (default=%default).""")
+    parser.add_option('--procs', type='int',default=1,
+                      help="""Number of processes used to scan the motifs and score the --plot-fdrs controls. (default=%default).""")
+    parser.add_option('--thresh-cache', dest="thresh_cache", type='string',default=None,
+                      help="""Path to a json file of motif score thresholds kept between runs; motifs already calibrated for this --thresh and background skip the threshold search. (default=%default).""")
     parser.add_option('--from-possum',default=False,
                       help="""Path to possumSearch outFile, skips motif finding step. (default=%default)""")    
     parser.add_option('--verbose',action='store_true',default=False,
@@ -214,7 +221,11 @@ def main():
         halfAT,halfGC  = getSeqFreqs(seqDict)
     
         if opts.verbose: sys.stdout.write('building hitDict...\n')
-        motifHits      = getEvalHitDict(motifList,seqDict,pThresh=opts.thresh,halfAT=halfAT,halfGC=halfGC)
+        threshCache    = None
+        if opts.thresh_cache:
+            threshCache = ThreshCache(opts.thresh_cache)
+        motifHits      = getEvalHitDict(motifList,seqDict,pThresh=opts.thresh,halfAT=halfAT,halfGC=halfGC,
+                                        procs=opts.procs,cache=threshCache)
     else:
         # -- Oh thank god, no!  All I have to do is some parseing! --
         if opts.verbose: sys.stdout.write('skipping to building hitDict step...\n')
@@ -232,14 +243,12 @@ def main():
     appendData(realData,outData)
     
     
-    for i in range(opts.fdrs):
-        if opts.verbose: sys.stdout.write('ctrl_%s:\n' % (i))
-        if opts.verbose: sys.stdout.write('\tgetting random forground...\n')
-        rForground = getRandomForground(foregroundSeqs,seqDict)
-        
-        if opts.verbose: sys.stdout.write('\tcalculating p-values...\n')
-        ctrlData   = motifHyprGeoEnrichment(motifList,motifHits,rForground,opts.expect)
-        appendData(ctrlData,outData)
+    if opts.fdrs:
+        if opts.verbose: sys.stdout.write('calculating p-values of %s random forgrounds...\n' % (opts.fdrs))
+        ctrlPvals = motifHyprGeoPermutations(motifList,motifHits,len(foregroundSeqs),opts.fdrs,expect=opts.expect,
+                                             universe=seqDict.keys(),seed=opts.seed,procs=opts.procs)
+        for j,m in enumerate(motifList):
+            outData[m.id].extend(ctrlPvals[:,j].tolist())
     
     if opts.verbose: sys.stdout.write('writting outData...\n')
     writeDataTable(outBaseStr,outData,motifList)
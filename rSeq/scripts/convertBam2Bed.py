@@ -2,7 +2,7 @@
 import os, sys, re, optparse
 
 from rSeq.utils.errors import *
-from rSeq.utils.convert import bam2bed
+from rSeq.utils.convert import bam2bed,bam2bed_sharded
 from rSeq.utils.misc import RseqHelpFormatter
 
        
@@ -27,6 +27,9 @@ If single REGIONS, it will be used for all BAMs.
 
 When avail, the jobs will be run in parallel.
 
+With --shard-size, a single indexed BAM is cut into ref/region shards of that
+many bp which are converted by NCPUS processes and merged in coord order.
+
 \nThis is modified from http://sourceforge.net/apps/mediawiki/samtools/index.php?title=SAM_protocol#Python_APIs_.28Pysam.29
 """
     
@@ -41,6 +44,12 @@ When avail, the jobs will be run in parallel.
                       help="Number of processors to use. autodetect uses all avail. [default=%default].")
     parser.add_option("-r", dest="regions", type="string", default=None,
                       help="samtools region string [default=%default].")
+    parser.add_option("--bed12", dest="bed12", action="store_true", default=False,
+                      help="Write BED12 lines with a block for each spliced (N separated) part of a read. [default=%default].")
+    parser.add_option("--collapse", dest="collapse", action="store_true", default=False,
+                      help="Write one line per distinct alignment (ref,pos,strand,blocks) with its read count in the score column. [default=%default].")
+    parser.add_option("--shard-size", dest="shard_size", type="int", default=None,
+                      help="Convert one indexed BAM in shards of this many bp across NCPUS processes. [default=%default].")
     
     (opts, args) = parser.parse_args()
     
@@ -71,8 +80,24 @@ When avail, the jobs will be run in parallel.
             raise InvalidOptionError('ERROR: NCPUS must be an integer.')
     
     # lets do this:
+    if opts.shard_size:
+        if (len(opts.bams) != 1) or (opts.beds and len(opts.beds) != 1):
+            raise InvalidOptionError('ERROR: --shard-size takes a single BAM and at most one BED.')
+        if opts.ncpus == 'autodetect':
+            opts.ncpus = None
+        bam2bed_sharded(bamPath=opts.bams[0],
+                        bedPath=opts.beds and opts.beds[0],
+                        regions=opts.regions,
+                        procs=opts.ncpus,
+                        shardSize=opts.shard_size,
+                        bed12=opts.bed12,
+                        collapse=opts.collapse)
+        exit(0)
+    
     bam2bed(bamPath=opts.bams,
             bedFile=opts.beds,
             region=opts.regions,
-            ncpus=opts.ncpus)
+            ncpus=opts.ncpus,
+            bed12=opts.bed12,
+            collapse=opts.collapse)
     
\ No newline at end of file
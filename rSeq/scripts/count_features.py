@@ -0,0 +1,78 @@
+"""
+Counts the reads of multiple sam/bam alignments in the features of a GTF/GFF
+(or BED) annotation with htseq-count's rules and writes one table:
+
+             aln_1    aln_2    aln_N
+feature_1    int      int      int
+feature_2    int      int      int
+...
+no_feature   int      int      int
+...
+
+The annotation is loaded once (from its persistent feature index) and the
+alignments are counted in parallel, one process per file.
+"""
+import sys
+
+import argparse
+
+from rSeq.utils.counting import count_features,write_count_table,OVERLAP_MODES,STRANDED_CHOICES
+
+
+def main():
+    argParser = argparse.ArgumentParser(
+        description=
+        """Counts reads of many sam/bam files per GTF/GFF feature (as htseq-count does) and
+writes the combined feature x sample table (same layout as sam2count_table.py).""")
+
+    argParser.add_argument('gff', type=str,
+                           help='GTF/GFF (or BED) file of the features to count')
+    argParser.add_argument('alignments', type=str, nargs='+',
+                           help='at least one sam/bam file (bam is much faster)')
+    argParser.add_argument('-n',dest='table_names', type=str, nargs='+',
+                           help='short names to use as table headings, otherwise file names are used; ' +
+                           'IMPORTANT: order of names must match order of the alignment files!!',
+                           default=False)
+    argParser.add_argument('-m', dest='mode', type=str, choices=OVERLAP_MODES, default='union',
+                           help='mode to handle reads overlapping more than one feature (default: %(default)s)')
+    argParser.add_argument('-s', dest='stranded', type=str, choices=STRANDED_CHOICES, default='yes',
+                           help="whether the data is from a strand-specific assay; 'reverse' means 'yes' " +
+                           "with reversed strand interpretation (default: %(default)s)")
+    argParser.add_argument('-a', dest='minaqual', type=int, default=0,
+                           help='skip all reads with alignment quality lower than this (default: %(default)s)')
+    argParser.add_argument('-t', dest='featuretype', type=str, default='exon',
+                           help='feature type (3rd column in GFF file) to be used (default: %(default)s)')
+    argParser.add_argument('-i', dest='idattr', type=str, default='gene_id',
+                           help='GFF attribute to be used as feature ID (default: %(default)s)')
+    argParser.add_argument('-p', dest='procs', type=int, default=None,
+                           help='number of alignment files counted at once (default: all cpus)')
+    argParser.add_argument('--by-ref', dest='by_ref', action='store_true',
+                           help='split each (indexed) bam into one task per reference sequence; ' +
+                           'use this to spread a few deep libraries over many cpus')
+    argParser.add_argument( "-o", type=str, dest="tableout",
+                            default = False, help = "write out combined table to file instead of standard out")
+
+    args = argParser.parse_args()
+    if args.table_names is not False:
+        if len(args.alignments) != len(args.table_names):
+            raise Exception("The number of alignment files provided do not match the number of names provided.")
+    else:
+        args.table_names = args.alignments
+
+    results = count_features(args.alignments,args.gff,mode=args.mode,stranded=args.stranded,
+                             minaqual=args.minaqual,featureType=args.featuretype,idAttr=args.idattr,
+                             procs=args.procs,byRef=args.by_ref)
+    for name,skipped in zip(args.table_names,results.skipped):
+        if skipped:
+            sys.stderr.write("Warning: %s: skipped %s reads aligned to chromosomes not in %s.\n" % (name,skipped,args.gff))
+
+    if args.tableout is not False:
+        writer = open(args.tableout,'w')
+    else:
+        writer = sys.stdout
+    write_count_table(results,args.table_names,writer)
+    if args.tableout is not False:
+        writer.close()
+
+if __name__ == "__main__":
+    main()
@@ -5,26 +5,35 @@ import multiprocessing as mp
 
 from rSeq.utils.errors import *
 from rSeq.utils.files import filter_PEfastQs
+from rSeq.utils.readFilter import compile_read_filter
 from rSeq.utils.externals import mkdirp
 
 def main():
     """Inputs:
     -- Txt table file containing some tab-delim file path inputs for files.filter_PEfastQs()
            PE_FastqPathFwd<tab>PE_FastqPathRev<tab>OutputComboBaseName<newLine>
-    -- String representing a lambda func to act as filter for fastqRecs
+    -- String representing a readFilter expression (or a lambda func) to act as filter for fastqRecs
     Outputs:
     -- Writes filtered data to paths specified in the input txt table file"""
     
-    desc  = """This script filters paired fastq files based on a provided lambda filter logic.  Input and output paths are determined by the input table file."""
+    desc  = """This script filters paired fastq files based on a provided filter expression (ex: "flag == N and meanqual >= 20")
+or lambda filter logic.  Input and output paths are determined by the input table file."""
     
     parser = argparse.ArgumentParser(description=desc)
     
     parser.add_argument('input_table', type=str,
                         help="""Path to input table file.""")
     parser.add_argument('filter_func', type=str,
-                        help="""lambda filter function (quoted string).""")
+                        help="""Filter expression (quoted string) using fields flag, header, meanqual, minqual, ncount, length;
+ops == != < <= > >= ~ !~; and/or/not/parens.  ex: "flag == N and ncount < 3".  A string starting with 'lambda' is eval'd as before.""")
     parser.add_argument('out_dir', type=str,
                         help="""Path to out directory.""")
+    parser.add_argument('--procs', type=int, default=1,
+                        help="""Number of cpus used for EACH file pair (one lane on many cores), counting the (de)compression helpers. (default: %(default)s)""")
+    parser.add_argument('--chunk-size', type=int, default=50000,
+                        help="""Number of read pairs handed to a worker at a time. (default: %(default)s)""")
+    parser.add_argument('--bgzf', action='store_true',
+                        help="""Write BGZF compressed (.fastq.gz) output files. (default: %(default)s)""")
 
 
 
@@ -47,7 +56,7 @@ def main():
     mkdirp(args.out_dir)
     
     # set up and unleash the subprocesses
-    filtFunc = eval(args.filter_func,{"__builtins__":None})
+    filtFunc = compile_read_filter(args.filter_func)
     jobs = []
     for i in inputs:
         arguments = [filtFunc, i[0], i[1]]
@@ -56,8 +65,10 @@ def main():
         arguments.append("%s/%s.filtered.mated.fastq"   % (args.out_dir.rstrip('/'),i[1].split('/')[-1].split('.fastq')[0]))  # matchedPassPath2
         arguments.append("%s/%s.filtered.singled.fastq" % (args.out_dir.rstrip('/'),i[2].split('/')[-1].split('.fastq')[0]))  # singlePassPath
         arguments.append("%s/%s.filtered.failed.fastq"  % (args.out_dir.rstrip('/'),i[2].split('/')[-1].split('.fastq')[0]))  # nonPassPath
+        if args.bgzf:
+            arguments = arguments[:3] + ['%s.gz' % (x) for x in arguments[3:]]
         
-        p = mp.Process(target=filter_PEfastQs,args=tuple(arguments))
+        p = mp.Process(target=filter_PEfastQs,args=tuple(arguments),kwargs={'procs':args.procs,'chunkSize':args.chunk_size})
         jobs.append(p)
         p.start()
     
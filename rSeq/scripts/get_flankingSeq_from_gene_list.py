@@ -16,9 +16,9 @@ import pybedtools
 import numpy as np
 
 from rSeq.utils.errors import *
-from rSeq.utils.misc import Bag
+from rSeq.utils.misc import Bag,fold_seq
 #from rSeq.utils.stats import basic_bootstrap_est
-from rSeq.utils.files import fastaRec_length_indexer,tableFile2namedTuple,mv_file_obj
+from rSeq.utils.files import GenomeStore,tableFile2namedTuple,mv_file_obj
 from rSeq.utils.expression import pearsonExpnFilter,mangle_expn_vectors
 from rSeq.utils.externals import mkdirp
 
@@ -88,18 +88,18 @@ def convert_2_bed(txDict):
     
     
     
-def get_fastas(txBed,genomeFasta,lenIndex,lenFlanks):
+def get_fastas(txBed,genome,lenIndex,lenFlanks):
     """
     GIVEN:
     1) txBed: path to TxBED tmp file
-    2) genomeFasta: species genome fasta path
+    2) genome: files.GenomeStore obj of the species genome fastas
     3) lenIndex: chrom length index path
     4) lenFlanks: length of flank regions
-    5) tmpFileDict: tmp_files dict so that the tmp beds can be recovered
     
     DO:
     1) create new bed from TxBED of flanking regions
-    2) get and write seqs defined in flankBED to fasta tmp file
+    2) get and write seqs defined in flankBED to fasta tmp file, slicing each
+       region straight out of the memory-mapped genome
     
     RETURN:
     1) BedTool obj containing flankBed coords file (flankBed.fn) and fastaSeqFilePath (flankBed.seqfn)
@@ -108,7 +108,14 @@ def get_fastas(txBed,genomeFasta,lenIndex,lenFlanks):
     # create flankBed
     txBed = pybedtools.BedTool(txBed)
     flankBed = txBed.flank(g=lenIndex,l=lenFlanks,r=0,s=True)
-    flankBed.sequence(fi=genomeFasta,name=True,s=True)
+    
+    flankFasta = NamedTemporaryFile(mode='w+b',prefix='tmpFlankFasta.',suffix=".fas",delete=False)
+    for iv in flankBed:
+        seq = genome.fetch(iv.chrom,iv.start,iv.end,strand=iv.strand)
+        flankFasta.write('>%s\n%s\n' % (iv.name,'\n'.join(fold_seq(seq))))
+    flankFasta.close()
+    
+    flankBed.seqfn = flankFasta.name
     return flankBed
             
     
@@ -233,19 +240,13 @@ FASTA for use in motif discovery."""
     tmp_files['txBedFile'] = convert_2_bed(txDict=txDict)
     
     # 2: Use GTFs, BEDtools, and genome FASTAs to extract the upstream flanking sequences into a new FASTA
-    fastaRecLengths,fastaSeqs = fastaRec_length_indexer(fastaFiles=args.genome_fastas)
+    genome = GenomeStore(fastaFiles=args.genome_fastas)
     tmpFastaRecLengthFile = NamedTemporaryFile(mode='w+b',prefix='tmpFastaRecLengthFile.',suffix=".txt")
-    for seqRec in fastaRecLengths:
-        tmpFastaRecLengthFile.write("%s\t%s\n" % (seqRec,fastaRecLengths[seqRec]))
+    for seqRec in genome.lengths:
+        tmpFastaRecLengthFile.write("%s\t%s\n" % (seqRec,genome.lengths[seqRec]))
     tmpFastaRecLengthFile.flush()
-
-    # TODO: concatonate fasta files
-    megaFastaFile = NamedTemporaryFile(mode='w+b',prefix='tmpMegaFastaFile.',suffix=".fas")
-    for fasta in fastaSeqs:
-        megaFastaFile.write('>%s\n%s\n' % (fasta,fastaSeqs[fasta]))
-    megaFastaFile.flush()
         
-    tmp_files['flankBed'] = get_fastas(txBed=tmp_files.txBedFile.name,genomeFasta=megaFastaFile.name,lenIndex=tmpFastaRecLengthFile.name,lenFlanks=args.flank_len)
+    tmp_files['flankBed'] = get_fastas(txBed=tmp_files.txBedFile.name,genome=genome,lenIndex=tmpFastaRecLengthFile.name,lenFlanks=args.flank_len)
     
     
     # CLEAN UP:
@@ -280,11 +281,11 @@ FASTA for use in motif discovery."""
     os.chmod(flankFasta,0775)
     
     if args.dump_megafasta:
-        megaFasta = "%s/megaFasta.fas" % (args.out_dir)
-        megaFastaFile.delete = False
-        megaFastaFile.close()
-        shutil.move(megaFastaFile.name, megaFasta)
-        os.chmod(megaFasta,0775)
+        megaFasta = open("%s/megaFasta.fas" % (args.out_dir),'w')
+        for fasta in genome:
+            megaFasta.write('>%s\n%s\n' % (fasta,genome[fasta]))
+        megaFasta.close()
+        os.chmod(megaFasta.name,0775)
 
     
 if __name__ == "__main__":
@@ -15,8 +15,35 @@ def invert_strand( iv ):
       raise ValueError, "Illegal strand"
    return iv2
 
+def load_features_from_index( gff_filename, stranded, feature_type, id_attribute, features, counts ):
+   # features come from the persistent index next to the GFF (built on first use)
+   from rSeq.utils.featureIndex import FeatureIndex
+   fIndex = FeatureIndex( gff_filename, kind="gtf", featureType=feature_type, idAttr=id_attribute )
+   for chrom, start, end, strand, feature_id in fIndex.iter_features():
+      if stranded != "no" and strand == ".":
+         sys.exit( "Feature %s at %s:%d-%d does not have strand information but you are "
+            "running htseq-count in stranded mode. Use '--stranded=no'." % 
+            ( feature_id, chrom, start, end ) )
+      features[ HTSeq.GenomicInterval( chrom, start, end, strand ) ] += feature_id
+      counts[ feature_id ] = 0
+   return len( fIndex )
+
+def intern_feature_steps( features, stranded ):
+   # replace the feature set of every step by a small int (see 
+   # rSeq.utils.featureSets.FeatureSetTable) so reads are assigned with cached
+   # set merges instead of new set unions
+   from rSeq.utils.featureSets import FeatureSetTable
+   set_table = FeatureSetTable()
+   step_ids = HTSeq.GenomicArray( "auto", stranded != "no", "i" )
+   for chrom in features.chrom_vectors:
+      step_ids.add_chrom( chrom )
+   for iv, fs in features.steps():
+      if len( fs ) > 0:
+         step_ids[ iv ] = set_table.intern( fs )
+   return step_ids, set_table
+
 def count_reads_in_features( sam_filename, gff_filename, stranded, 
-      overlap_mode, feature_type, id_attribute, quiet, minaqual, samout ):
+      overlap_mode, feature_type, id_attribute, quiet, minaqual, samout, use_index=False ):
       
    def write_to_samout( r, assignment ):
       if samoutfile is None:
@@ -43,8 +70,12 @@ def count_reads_in_features( sam_filename, gff_filename, stranded,
    if sam_filename != "-":
       open( sam_filename ).close()
       
-   gff = HTSeq.GFF_Reader( gff_filename )   
-   i = 0
+   if use_index:
+      i = load_features_from_index( gff_filename, stranded, feature_type, id_attribute, features, counts )
+      gff = ()
+   else:
+      gff = HTSeq.GFF_Reader( gff_filename )   
+      i = 0
    try:
       for f in gff:
          if f.type == feature_type:
@@ -67,11 +98,13 @@ def count_reads_in_features( sam_filename, gff_filename, stranded,
       raise
       
    if not quiet:
-      sys.stderr.write( "%d GFF lines processed.\n" % i )
+      sys.stderr.write( "%d %s processed.\n" % ( i, "indexed features" if use_index else "GFF lines" ) )
       
    if len( counts ) == 0 and not quiet:
       sys.stderr.write( "Warning: No features of type '%s' found.\n" % feature_type )
    
+   step_ids, set_table = intern_feature_steps( features, stranded )
+   
    try:
       if sam_filename != "-":
          try:
@@ -159,27 +192,14 @@ def count_reads_in_features( sam_filename, gff_filename, stranded,
                continue         
          
          try:
-            if overlap_mode == "union":
-               fs = set()
-               for iv in iv_seq:
-                  if iv.chrom not in features.chrom_vectors:
-                     raise UnknownChrom
-                  for iv2, fs2 in features[ iv ].steps():
-                     fs = fs.union( fs2 )
-            elif overlap_mode == "intersection-strict" or overlap_mode == "intersection-nonempty":
-               fs = None
-               for iv in iv_seq:
-                  if iv.chrom not in features.chrom_vectors:
-                     raise UnknownChrom
-                  for iv2, fs2 in features[ iv ].steps():
-                     if len(fs2) > 0 or overlap_mode == "intersection-strict":
-                        if fs is None:
-                           fs = fs2.copy()
-                        else:
-                           fs = fs.intersection( fs2 )
-            else:
-               sys.exit( "Illegal overlap mode." )
-            if fs is None or len( fs ) == 0:
+            sids = []
+            for iv in iv_seq:
+               if iv.chrom not in features.chrom_vectors:
+                  raise UnknownChrom
+               for iv2, sid in step_ids[ iv ].steps():
+                  sids.append( sid )
+            fs = set_table.sets[ set_table.merge( sids, overlap_mode ) ]
+            if len( fs ) == 0:
                write_to_samout( r, "no_feature" )
                empty += 1
             elif len( fs ) > 1:
@@ -222,6 +242,27 @@ def count_reads_in_features( sam_filename, gff_filename, stranded,
    print "not_aligned\t%d" % notaligned
    print "alignment_not_unique\t%d" % nonunique
 
+
+def count_reads_by_reference( sam_filename, gff_filename, stranded, 
+      overlap_mode, feature_type, id_attribute, quiet, minaqual, processes ):
+   # reads of each reference sequence of an indexed BAM are counted in a pool
+   # (see rSeq.utils.counting); mates are paired within each reference
+   from rSeq.utils.counting import count_features
+   results = count_features( [ sam_filename ], gff_filename, mode=overlap_mode, 
+      stranded=stranded, minaqual=minaqual, featureType=feature_type, 
+      idAttr=id_attribute, kind="gtf", procs=processes, byRef=True )
+   
+   if len( results.names ) == 0 and not quiet:
+      sys.stderr.write( "Warning: No features of type '%s' found.\n" % feature_type )
+   if results.skipped[0] and not quiet:
+      sys.stderr.write( ( "Warning: Skipped %d reads, because the chromosomes to which " +
+         "they have been aligned did not appear in the GFF file.\n" ) % results.skipped[0] )
+   
+   for fn, count in zip( results.names, results.counts[:,0].tolist() ):
+      print "%s\t%d" % ( fn, count )
+   for fn, count in results.special:
+      print "%s\t%d" % ( fn, count[0] )
+
       
 def main():
    
@@ -270,6 +311,16 @@ def main():
       "SAM file called SAMOUT, annotating each line with its feature assignment " +
       "(as an optional field with tag 'XF')" )
 
+   optParser.add_option( "-x", "--feature-index", action="store_true", dest="feature_index",
+      default = False, help = "load the features from a persistent index of the GFF file " +
+      "(GFF_FILE.ivx, built on first use and rebuilt when the GFF file changes) instead " +
+      "of parsing the GFF file on every run" )
+
+   optParser.add_option( "-p", "--processes", type="int", dest="processes",
+      default = 1, help = "count an indexed BAM file (SAM_FILE.bai must exist) in this many " +
+      "processes, one reference sequence at a time; mates aligned to different " +
+      "references are still paired. Can not be used with --samout (default: 1)" )
+
    optParser.add_option( "-q", "--quiet", action="store_true", dest="quiet",
       help = "suppress progress report and warnings" )
 
@@ -284,11 +335,21 @@ def main():
       sys.stderr.write( "  Call with '-h' to get usage information.\n" )
       sys.exit( 1 )
       
+   if opts.processes > 1 and ( opts.samout != "" or args[0] == "-" ):
+      sys.stderr.write( sys.argv[0] + ": Error: --processes needs an indexed BAM file " +
+         "and can not be used with --samout.\n" )
+      sys.exit( 1 )
+      
    warnings.showwarning = my_showwarning
    try:
-      count_reads_in_features( args[0], args[1], opts.stranded, 
-         opts.mode, opts.featuretype, opts.idattr, opts.quiet, opts.minaqual,
-         opts.samout )
+      if opts.processes > 1:
+         count_reads_by_reference( args[0], args[1], opts.stranded, 
+            opts.mode, opts.featuretype, opts.idattr, opts.quiet, opts.minaqual,
+            opts.processes )
+      else:
+         count_reads_in_features( args[0], args[1], opts.stranded, 
+            opts.mode, opts.featuretype, opts.idattr, opts.quiet, opts.minaqual,
+            opts.samout, opts.feature_index )
    except:
       sys.stderr.write( "Error: %s\n" % str( sys.exc_info()[1] ) )
       sys.stderr.write( "[Exception type: %s, raised in %s:%d]\n" % 
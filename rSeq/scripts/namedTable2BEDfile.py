@@ -1,7 +1,8 @@
 import sys
 import optparse
+import numpy as np
 from rSeq.utils.files import tableFile2namedTuple
-from rSeq.utils.align import parseCigarString
+from rSeq.utils.align import CigarBatch
 
 
 strandReps = {'+':'+',
@@ -9,6 +10,11 @@ strandReps = {'+':'+',
               '1':'+',
               '-1':'-',}
 
+# cigar ops that move along the chrom (the rest only along the feature)
+cigChrmOps = {'ensembl':'MI',
+              'EBI':'MI',
+              'exonerate':'MD'}
+
 def groupFeatureAlignments(features,opts):
     """Returns Dict with key,val mappings == (EST_ID,ChrmID),[rowsFrom_features]"""
     featureDict = {}
@@ -141,6 +147,50 @@ def printBEDline(listOfRowsByFeature,opts):
                              blkStarts]))
 
 
+def printCigarBEDlines(features,opts):
+    """Takes every row of the table, each holding a whole alignment with a
+    cigar string (opts.cigars column).  Prints one BED line per row with the
+    blocks calculated from the cigars, which are parsed all at once."""
+    features  = list(features)
+    if not features:
+        return
+    cigars    = CigarBatch.from_strs([x.__getattribute__(opts.cigars) for x in features],kind=opts.cigar_type)
+    chrmStarts = np.array([int(x.__getattribute__(opts.blkChmStrt))-1 for x in features],dtype=np.int64)
+    if opts.strand:
+        strands = [strandReps[x.__getattribute__(opts.strand)] for x in features]
+        cigars  = cigars.reversed(np.array(strands) == '-')
+    else:
+        strands = ['+'] * len(features)
+    blkStarts,blkEnds,blkOffsets = cigars.blocks(chrmStarts,refOps=cigChrmOps[opts.cigar_type],blockOps='M')
+    blkSizes  = blkEnds - blkStarts
+    blkStarts = blkStarts - np.repeat(chrmStarts,np.diff(blkOffsets))
+    
+    for i,row in enumerate(features):
+        chrmStart = str(chrmStarts[i])
+        chrmEnd   = row.__getattribute__(opts.blkChmEnd)
+        first,last = blkOffsets[i],blkOffsets[i+1]
+        if opts.thkStrt:
+            thkStart = row.__getattribute__(opts.thkStrt)
+        else:
+            thkStart = chrmStart
+        if opts.thkEnd:
+            thkEnd   = row.__getattribute__(opts.thkEnd)
+        else:
+            thkEnd   = chrmEnd
+        print '%s' % ('\t'.join([row.__getattribute__(opts.chrm),
+                                 chrmStart,
+                                 chrmEnd,
+                                 row.__getattribute__(opts.featName),
+                                 '0',
+                                 strands[i],
+                                 thkStart,
+                                 thkEnd,
+                                 opts.rgb,
+                                 str(last-first),
+                                 ','.join([str(x) for x in blkSizes[first:last]]),
+                                 ','.join([str(x) for x in blkStarts[first:last]])]))
+
+
 if __name__ == "__main__":
     
     
@@ -170,10 +220,10 @@ if __name__ == "__main__":
     parser.add_option('--rgb',dest="rgb",type="str", default="0,0,0", 
                       help="""Space-less string to assign the color for this track. Exp: 0,0,0=black; 255,0,0=red; 0,255,0=green; 0,0,255=blue (default=%default)""")
     parser.add_option('--cigars',dest="cigars",type="str", default=False, 
-                      help="""Exact Title of Column holding the cigar strings. Exp: cigar_string (default=%default)""")
-    cigTypes = ['ensembl','exonerate']
+                      help="""Exact Title of Column holding the cigar strings. Exp: cigar_string.  When given, each row is a whole alignment and its blocks come from its cigar. (default=%default)""")
+    cigTypes = sorted(cigChrmOps.keys())
     parser.add_option('--cigar-type',dest="cigar_type",type="str", default=False, 
-                      help="""Type of cigar string.  REQUIRED when using '--cigars'.  Options: %s (default=%default)""" % (cigTypes))
+                      help="""Type of cigar string.  REQUIRED when using '--cigars'.  Options: %s (default=%%default)""" % (cigTypes))
 
     
     (opts, args) = parser.parse_args()
@@ -183,11 +233,18 @@ if __name__ == "__main__":
         exit()
     
     
+    if opts.cigars and (opts.cigar_type not in cigTypes):
+        parser.error("--cigar-type must be one of %s when using '--cigars'." % (cigTypes))
+    
     features   = tableFile2namedTuple(args[0],sep=opts.sep)
-    rowsByAlgn = groupFeatureAlignments(features,opts)
     
     print """track name=%s description="%s" useScore=0""" % (opts.track_name, opts.description)
     
-    for alnmnt in rowsByAlgn:
-        printBEDline(rowsByAlgn[alnmnt],opts)
+    if opts.cigars:
+        # one row per alignment: blocks come from its cigar string
+        printCigarBEDlines(features,opts)
+    else:
+        rowsByAlgn = groupFeatureAlignments(features,opts)
+        for alnmnt in rowsByAlgn:
+            printBEDline(rowsByAlgn[alnmnt],opts)
     
\ No newline at end of file
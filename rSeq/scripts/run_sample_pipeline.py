@@ -0,0 +1,79 @@
+import sys
+import os
+import argparse
+
+from rSeq.utils.errors import *
+from rSeq.utils.externals import mkdirp
+from rSeq.utils.pipeline import Scheduler,read_sample_sheet,build_sample_pipeline
+from rSeq.utils.stepCache import StepCache
+
+
+def main():
+    """Inputs:
+    -- Tab-delim sample sheet with header: sample<tab>fastq1[<tab>fastq2]
+    -- bowtie index and GTF annotation
+    Outputs:
+    -- <out_dir>/<sample>.srt.bam(.bai), <out_dir>/<sample>.counts.txt,
+       <out_dir>/counts_table.txt and per-step logs in <out_dir>/logs"""
+    
+    desc  = """Aligns, indexes and counts every sample in a sample sheet and merges the counts into one table.
+Steps of different samples run at the same time within the --cpus/--mem budget."""
+    
+    parser = argparse.ArgumentParser(description=desc)
+    
+    parser.add_argument('sample_sheet', type=str,
+                        help="""Tab-delim file with header line: sample<tab>fastq1[<tab>fastq2].""")
+    parser.add_argument('bt_index', type=str,
+                        help="""Bowtie index name (in $BOWTIE_INDEXES) or path.""")
+    parser.add_argument('gtf', type=str,
+                        help="""GTF/GFF annotation to count reads in.""")
+    parser.add_argument('out_dir', type=str,
+                        help="""Path to out directory.""")
+    parser.add_argument('--bt-opts', type=str, default='-v 2 -m 1',
+                        help="""Quoted bowtie options ("-S", "-p" and "--mm" are added for you). (default: %(default)s)""")
+    parser.add_argument('--cpus', type=int, default=None,
+                        help="""Max cpus to keep busy at once. (default: all)""")
+    parser.add_argument('--mem', type=int, default=None,
+                        help="""Max memory (MB) to commit at once. (default: no limit)""")
+    parser.add_argument('--align-threads', type=int, default=4,
+                        help="""bowtie -p threads per sample. (default: %(default)s)""")
+    parser.add_argument('--align-mem', type=int, default=0,
+                        help="""MB reserved per bowtie run (the --mm index is shared). (default: %(default)s)""")
+    parser.add_argument('--count-mem', type=int, default=0,
+                        help="""MB reserved per counting run. (default: %(default)s)""")
+    parser.add_argument('--no-mm', action='store_true',
+                        help="""Do not pass --mm to bowtie (each run then loads its own copy of the index).""")
+    parser.add_argument('--count-opts', type=str, default='',
+                        help="""Quoted options for my_htseq_count.py (ex: "-s no -t exon"). (default: none)""")
+    parser.add_argument('--cache-dir', type=str, default=None,
+                        help="""Step cache dir: steps whose inputs, tool versions and options match an earlier run reuse its outputs. (default: no cache)""")
+    parser.add_argument('--hash-inputs', action='store_true',
+                        help="""Fingerprint cached step inputs by md5 instead of size+mtime.""")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="""Print the steps and their commands without running them.""")
+    
+    args = parser.parse_args()
+    
+    # print the called command:
+    sys.stderr.write("%s\n" % (" ".join(sys.argv)))
+    
+    mkdirp(args.out_dir)
+    samples   = read_sample_sheet(args.sample_sheet)
+    cache = None
+    if args.cache_dir:
+        cache = StepCache(args.cache_dir,useHash=args.hash_inputs)
+    scheduler = Scheduler(cpus=args.cpus,mem=args.mem,logDir=os.path.join(args.out_dir,'logs'),cache=cache)
+    build_sample_pipeline(samples,args.bt_index,args.gtf,args.out_dir,
+                          btOptions=args.bt_opts,
+                          alignThreads=args.align_threads,
+                          alignMem=args.align_mem,
+                          countMem=args.count_mem,
+                          sharedIndex=not args.no_mm,
+                          countOptions=args.count_opts.split(),
+                          scheduler=scheduler)
+    scheduler.run(dryRun=args.dry_run)
+    
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,13 @@
-from rSeq.utils.align import cigarStr2AlignCoords
+from rSeq.utils.align import cigarStr2AlignCoords,parseCigarString,CigarBatch
 cig = '2MD3M6I2D2M'
 print cigarStr2AlignCoords(cig,0,13,'+',intron='I')
 
+assert parseCigarString(cig,kind='ensembl') == [('M',2),('D',1),('M',3),('I',6),('D',2),('M',2)]
+assert parseCigarString('M 2 D 1 M 3',kind='exonerate') == [('M',2),('D',1),('M',3)]
 
+cigars = CigarBatch.from_strs(['10M200N15M','3M1I4M2D3M','4M'],kind='sam')
+blkStarts,blkEnds,blkOffsets = cigars.blocks([0,10,20])
+assert list(blkStarts) == [0,210,10,19,20]
+assert list(blkEnds)   == [10,225,17,22,24]
+assert list(blkOffsets) == [0,2,4,5]
+print 'CigarBatch blocks OK'
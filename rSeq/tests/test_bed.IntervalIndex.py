@@ -0,0 +1,79 @@
+import os
+import random
+import shutil
+import tempfile
+
+from rSeq.utils.bed import IntervalIndex,divByWindow
+
+def overlap(aStart,aEnd,bStart,bEnd):
+    return (aStart < bEnd) and (bStart < aEnd)
+
+# an empty query where two intervals touch overlaps neither of them
+index = IntervalIndex()
+index.add('chrA',0,5)
+index.add('chrA',5,10)
+assert (index.overlaps('chrA',5,5),index.find('chrA',5,5)) == (False,[])
+assert index.overlaps('chrA',4,6) and index.overlaps('chrA',5,6)
+
+# check overlaps() and find() against a scan of every interval
+random.seed(7)
+for rep in range(20):
+    ivals = []
+    index = IntervalIndex()
+    span  = random.choice([50,2000]) # small spans make touching intervals common
+    for i in range(random.randint(0,200)):
+        chrom = random.choice(['chrA','chrB'])
+        start = random.randint(0,span)
+        end   = start + random.choice([0,1,5,50,random.randint(0,500)])
+        ivals.append((chrom,start,end,i))
+        index.add(chrom,start,end,i)
+    for q in range(200):
+        chrom = random.choice(['chrA','chrB','chrC'])
+        start = random.randint(0,span+600)
+        end   = start + random.choice([0,1,random.randint(0,300)])
+        hits  = sorted([x[3] for x in ivals if (x[0] == chrom) and overlap(x[1],x[2],start,end)])
+        assert sorted(index.find(chrom,start,end)) == hits
+        assert index.overlaps(chrom,start,end) == bool(hits)
+
+# check both sides of divByWindow() against a scan of every bedA window
+def randBed(path,count):
+    lines = []
+    for i in range(count):
+        start = random.randint(0,20000)
+        lines.append('\t'.join([random.choice(['chrA','chrB']),str(start),str(start+random.randint(1,300)),
+                                'feat%s' % (i),'0',random.choice('+-')]))
+    open(path,'w').write(''.join(['%s\n' % (x) for x in lines]))
+    return [x.split('\t') for x in lines]
+
+def window(fields,win):
+    start,end = int(fields[1]),int(fields[2])
+    if fields[5] == '-':
+        return max(0,start-win[1]),end+win[0]
+    return max(0,start-win[0]),end+win[1]
+
+def dedup(lines):
+    kept = []
+    for line in lines:
+        if (not kept) or (kept[-1] != line):
+            kept.append(line)
+    return kept
+
+workDir = tempfile.mkdtemp()
+bedA = randBed(os.path.join(workDir,'A.bed'),300)
+bedB = randBed(os.path.join(workDir,'B.bed'),1000)
+win  = [500,200]
+inWin = lambda b,a: (a[0] == b[0]) and overlap(int(b[1]),int(b[2]),*window(a,win))
+for side in ['right','left']:
+    inPath,notInPath = divByWindow(os.path.join(workDir,'A.bed'),os.path.join(workDir,'B.bed'),
+                                   win=win,cols=[6,6],side=side,outDir=workDir)
+    bIn    = ['\t'.join(b) for b in bedB if [a for a in bedA if inWin(b,a)]]
+    bNotIn = ['\t'.join(b) for b in bedB if not [a for a in bedA if inWin(b,a)]]
+    aIn    = ['\t'.join(a) for a in bedA if [b for b in bedB if inWin(b,a)]]
+    assert open(notInPath).read().splitlines() == dedup(bNotIn)
+    if side == 'right':
+        assert open(inPath).read().splitlines() == dedup(bIn)
+    else:
+        assert open(inPath).read().splitlines() == aIn
+
+shutil.rmtree(workDir)
+print "IntervalIndex: all overlaps matched."
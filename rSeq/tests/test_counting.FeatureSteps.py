@@ -0,0 +1,51 @@
+import os
+import random
+import tempfile
+
+from rSeq.utils.featureIndex import FeatureIndex
+from rSeq.utils.counting import FeatureSteps
+
+# write a small stranded gtf and check read assignment against a base by base scan
+feats = []
+gtf = tempfile.NamedTemporaryFile(suffix='.gtf',delete=False)
+for i in range(200):
+    chrom  = 'chrm%s' % (random.randint(1,2))
+    start  = random.randint(0,20000)
+    end    = start + random.randint(1,1000)
+    strand = random.choice('+-')
+    gene   = 'gene%s' % (random.randint(0,80))
+    feats.append((chrom,start,end,strand,gene))
+    gtf.write('%s\ttest\texon\t%s\t%s\t.\t%s\t.\tgene_id "%s";\n' % (chrom,start+1,end,strand,gene))
+gtf.close()
+
+def idsAt(chrom,strand,pos,stranded):
+    return frozenset([f[4] for f in feats if (f[0] == chrom) and (f[1] <= pos < f[2]) and ((not stranded) or (f[3] == strand))])
+
+fIndex = FeatureIndex(gtf.name)
+for stranded in [True,False]:
+    steps = FeatureSteps(fIndex,stranded=stranded)
+    for rep in range(300):
+        chrom  = 'chrm%s' % (random.randint(1,2))
+        strand = random.choice('+-')
+        start  = random.randint(0,21000)
+        ivs    = [(chrom,strand,start,start+random.randint(1,50)),
+                  (chrom,strand,start+100,start+100+random.randint(1,50))]
+        baseSets = [idsAt(chrom,strand,pos,stranded) for iv in ivs for pos in range(iv[2],iv[3])]
+
+        union = set([fIndex.names[i] for i in steps.table.sets[steps.assign(ivs,'union')]])
+        assert union == set().union(*baseSets)
+
+        strict = steps.table.sets[steps.assign(ivs,'intersection-strict')]
+        assert set([fIndex.names[i] for i in strict]) == set(baseSets[0]).intersection(*baseSets)
+
+        nonEmpty = [s for s in baseSets if s]
+        ids = steps.table.sets[steps.assign(ivs,'intersection-nonempty')]
+        if not nonEmpty:
+            assert not ids
+        else:
+            assert set([fIndex.names[i] for i in ids]) == set(nonEmpty[0]).intersection(*nonEmpty)
+
+os.remove(gtf.name)
+os.remove(gtf.name + '.ivx')
+os.remove(gtf.name + '.ivx.json')
+print "FeatureSteps: all assignments matched."
@@ -0,0 +1,109 @@
+import os
+import random
+import tempfile
+
+import pysam
+
+from rSeq.utils.counting import count_features,unplaced_reads
+
+# write indexed bams of random reads (pairs split across references, unplaced pairs,
+# lost mates) and check that counting them by reference matches counting whole files
+refs = [('chrm1',100000),('chrm2',30000),('chrm3',20000),('chrm4',5000)] # chrm3: no features, chrm4: no reads
+header = {'HD':{'VN':'1.0','SO':'coordinate'},
+          'SQ':[{'SN':name,'LN':length} for name,length in refs]}
+
+gtf = tempfile.NamedTemporaryFile(suffix='.gtf',delete=False)
+for i in range(150):
+    chrom  = random.choice(['chrm1','chrm2'])
+    start  = random.randint(1,19000)
+    gtf.write('%s\ttest\texon\t%s\t%s\t.\t%s\t.\tgene_id "gene%s";\n' % \
+              (chrom,start,start+random.randint(1,800),random.choice('+-'),random.randint(0,60)))
+gtf.close()
+
+def randCigar():
+    cigar = [(0,random.randint(5,50))]
+    for i in range(random.randint(0,2)):
+        cigar.extend([(random.choice([1,2,3]),random.randint(1,300)),(0,random.randint(5,50))])
+    return cigar
+
+def placeRead(read,tid,pos,unmapped):
+    read.tid = tid
+    read.pos = pos
+    if unmapped:
+        read.flag |= 4
+    else:
+        read.cigar = randCigar()
+    return read
+
+def makeRead(qname,flag):
+    read = pysam.AlignedRead()
+    read.qname = qname
+    read.flag  = flag | (16 if random.random() < 0.5 else 0)
+    read.mapq  = random.choice([0,10,30,30,30])
+    read.tags  = [('NH',random.choice([1,1,1,1,2]))]
+    return read
+
+def randPlace():
+    tid = random.choice([0,0,1,2])
+    return tid,random.randint(0,19500)
+
+bamPaths = []
+for sample in range(2):
+    reads = []
+    for n in range(1500):
+        qname = 'read%s' % (n)
+        if random.random() < 0.3:
+            read = makeRead(qname,0)
+            unmapped = random.random() < 0.05
+            tid,pos = (-1,-1) if unmapped else randPlace()
+            reads.append(placeRead(read,tid,pos,unmapped))
+            continue
+        first  = makeRead(qname,1|64)
+        second = makeRead(qname,1|128)
+        unmapped = [random.random() < 0.05,random.random() < 0.05]
+        places = [randPlace(),randPlace()]
+        if unmapped[0] and unmapped[1]:
+            places = [(-1,-1),(-1,-1)]
+        elif unmapped[0] or unmapped[1]:
+            places = [places[unmapped[0]]]*2 # an unmapped mate is placed with its mate
+        elif random.random() < 0.5:
+            places[1] = (places[0][0],places[0][1] + random.randint(0,400))
+        placeRead(first,places[0][0],places[0][1],unmapped[0])
+        placeRead(second,places[1][0],places[1][1],unmapped[1])
+        first.mrnm,first.mpos   = second.tid,second.pos
+        second.mrnm,second.mpos = first.tid,first.pos
+        reads.append(first)
+        if random.random() < 0.95: # some mates are lost
+            reads.append(second)
+    reads.sort(key=lambda r: (r.tid < 0,r.tid,r.pos))
+
+    bam = tempfile.NamedTemporaryFile(suffix='.bam',delete=False)
+    bam.close()
+    outFile = pysam.Samfile(bam.name,'wb',header=header)
+    for read in reads:
+        outFile.write(read)
+    outFile.close()
+    pysam.index(bam.name)
+    bamPaths.append(bam.name)
+
+    samfile  = pysam.Samfile(bam.name,'rb')
+    unplaced = [(r.qname,r.flag) for r in unplaced_reads(samfile)]
+    samfile.close()
+    assert unplaced == [(r.qname,r.flag) for r in reads if r.tid < 0]
+
+for mode in ['union','intersection-strict','intersection-nonempty']:
+    for stranded in ['yes','no','reverse']:
+        whole = count_features(bamPaths,gtf.name,mode=mode,stranded=stranded,minaqual=10,procs=2)
+        byRef = count_features(bamPaths,gtf.name,mode=mode,stranded=stranded,minaqual=10,procs=2,byRef=True)
+        assert byRef.names == whole.names
+        assert (byRef.counts == whole.counts).all()
+        assert byRef.special == whole.special
+        assert byRef.skipped == whole.skipped
+
+for path in bamPaths:
+    os.remove(path)
+    os.remove(path + '.bai')
+os.remove(gtf.name)
+os.remove(gtf.name + '.ivx')
+os.remove(gtf.name + '.ivx.json')
+print "count_features: by-reference counts matched whole-file counts."
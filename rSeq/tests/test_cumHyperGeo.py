@@ -1,4 +1,6 @@
-from rSeq.utils.stats import cumHypergeoP
+import random
+
+from rSeq.utils.stats import cumHypergeoP,cumHypergeoP_exact,cumHypergeoPvals
 
     #Calculates the cumulative hypergeometric p-value for variables:
     #n = # of positives in population
@@ -10,5 +12,17 @@ from rSeq.utils.stats import cumHypergeoP
 
     #For more details -> http://mathworld.wolfram.com/HypergeometricDistribution.html
 
+# the log-space engine must agree with the exact big-integer sums
+for rep in range(500):
+    n = random.randint(0,300)
+    m = random.randint(0,300)
+    N = random.randint(0,n+m)
+    i = random.randint(0,N+1)
+    exact = cumHypergeoP_exact(n,i,m,N)
+    assert abs(cumHypergeoP(n,i,m,N) - exact) <= 1e-9 * max(exact,1e-300)
 
-None
\ No newline at end of file
+# arrays are scored in one call
+pVals = cumHypergeoPvals([10,20,30],[2,5,9],100,25)
+assert pVals.shape == (3,)
+assert [round(p,12) for p in pVals] == [round(cumHypergeoP_exact(n,i,100,25),12) for n,i in [(10,2),(20,5),(30,9)]]
+print "cumHypergeoP: all p-values matched."
@@ -0,0 +1,38 @@
+import os
+import random
+import tempfile
+
+from rSeq.utils.featureIndex import FeatureIndex
+
+# write a small stranded bed and check overlap queries against a brute force scan
+feats = []
+bed = tempfile.NamedTemporaryFile(suffix='.bed',delete=False)
+bed.write('track name=test\n')
+for i in range(500):
+    chrom  = 'chrm%s' % (random.randint(1,3))
+    start  = random.randint(0,50000)
+    end    = start + random.randint(1,2000)
+    strand = random.choice('+-')
+    feats.append((chrom,start,end,strand,'feat%s' % (i)))
+    bed.write('%s\t%s\t%s\tfeat%s\t0\t%s\n' % (chrom,start,end,i,strand))
+bed.close()
+
+fIndex = FeatureIndex(bed.name)
+assert len(fIndex) == len(feats)
+for rep in range(1000):
+    chrom  = 'chrm%s' % (random.randint(1,4))
+    start  = random.randint(0,50000)
+    end    = start + random.randint(1,500)
+    strand = random.choice(['+','-',None])
+    expected = sorted([f[4] for f in feats if (f[0] == chrom) and (f[1] < end) and (f[2] > start) and (strand in [None,f[3]])])
+    assert sorted(fIndex.names_of(fIndex.overlap(chrom,start,end,strand))) == expected
+
+# a fresh index is reused, not rebuilt
+mtime = os.path.getmtime(bed.name + '.ivx')
+FeatureIndex(bed.name)
+assert os.path.getmtime(bed.name + '.ivx') == mtime
+
+os.remove(bed.name)
+os.remove(bed.name + '.ivx')
+os.remove(bed.name + '.ivx.json')
+print "FeatureIndex: all overlap queries matched."
@@ -0,0 +1,49 @@
+import os
+import pickle
+import random
+import tempfile
+
+from rSeq.utils.files import GenomeStore
+from rSeq.utils.errors import InvalidFileFormatError
+from rSeq.utils.misc import fold_seq,revComp
+
+# write two multi-rec fastas and check every fetch against the seqs written
+seqs  = {}
+paths = []
+for f in range(2):
+    fasta = tempfile.NamedTemporaryFile(suffix='.fas',delete=False)
+    for i in range(20):
+        name = 'chrm%s_%s' % (f,i)
+        seqs[name] = ''.join([random.choice('ACGTNacgt') for x in range(random.randint(1,500))])
+        fasta.write('>%s some description\n%s\n' % (name,'\n'.join(fold_seq(seqs[name],60))))
+    fasta.close()
+    paths.append(fasta.name)
+
+store = GenomeStore(paths)
+assert len(store) == len(seqs)
+for copy in [store,pickle.loads(pickle.dumps(store))]:
+    for name,seq in seqs.iteritems():
+        assert copy.lengths[name] == len(seq)
+        assert copy.fetch(name) == seq
+        for rep in range(20):
+            start = random.randint(0,len(seq))
+            end   = random.randint(start,len(seq))
+            assert str(copy.slice(name,start,end)) == seq[start:end]
+            assert copy.fetch(name,start,end,'-') == revComp(seq[start:end])
+    copy.close()
+
+# gzipped fastas can not be memory-mapped so they must be refused, not skipped
+gzPath = paths[0] + '.gz'
+open(gzPath,'w').close()
+try:
+    GenomeStore([gzPath])
+    raise AssertionError("GenomeStore accepted a gzipped fasta")
+except InvalidFileFormatError as errTxt:
+    assert gzPath in str(errTxt)
+os.remove(gzPath)
+
+for p in paths:
+    os.remove(p)
+    os.remove(p + '.fai')
+    os.remove(p + '.flat')
+print "GenomeStore: all fetches matched."
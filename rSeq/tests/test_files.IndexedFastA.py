@@ -0,0 +1,29 @@
+import os
+import random
+import tempfile
+
+from rSeq.utils.files import IndexedFastA
+from rSeq.utils.misc import fold_seq,revComp
+
+# write a small multi-rec fasta with 60bp lines and a short last line
+seqs = {}
+fasta = tempfile.NamedTemporaryFile(suffix='.fas',delete=False)
+for i,length in enumerate([1,60,61,2500]):
+    seqs['chrm%s' % (i)] = ''.join([random.choice('ACGTNacgt') for x in range(length)])
+    fasta.write('>chrm%s some description\n%s\n' % (i,'\n'.join(fold_seq(seqs['chrm%s' % (i)],60))))
+fasta.close()
+
+reader = IndexedFastA(fasta.name)
+for name,seq in seqs.iteritems():
+    assert reader.lengths[name] == len(seq)
+    assert reader.fetch(name) == seq
+    for rep in range(100):
+        start = random.randint(0,len(seq))
+        end   = random.randint(start,len(seq))
+        assert reader.fetch(name,start,end) == seq[start:end]
+        assert reader.fetch(name,start,end,'-') == revComp(seq[start:end])
+reader.close()
+
+os.remove(fasta.name)
+os.remove(fasta.name + '.fai')
+print "IndexedFastA: all fetches matched."
@@ -0,0 +1,43 @@
+import os
+import random
+import tempfile
+
+import numpy as np
+
+from rSeq.utils.files import ParseFastQ
+from rSeq.utils.errors import InvalidFileFormatError
+
+# write a fastq with reads of varying length
+recs = []
+fastq = tempfile.NamedTemporaryFile(suffix='.fastq',delete=False)
+for i in range(5000):
+    length = random.randint(1,150)
+    seq  = ''.join([random.choice('ACGTN') for x in range(length)])
+    qual = ''.join([chr(33+random.randint(0,40)) for x in range(length)])
+    recs.append(('@read%s 1:N:0:ACGT' % (i),seq,'+',qual))
+    fastq.write('%s\n' % ('\n'.join(recs[-1])))
+fastq.close()
+
+# small blocks force recs to be split across reads of the file
+assert list(ParseFastQ(fastq.name,blockSize=1000)) == recs
+
+meanQuals = []
+nCounts   = []
+for batch in ParseFastQ(fastq.name,blockSize=50000).batches():
+    meanQuals.extend(batch.mean_quals())
+    nCounts.extend(batch.n_counts())
+assert np.allclose(meanQuals,[np.mean([ord(x)-33 for x in r[3]]) for r in recs])
+assert nCounts == [r[1].count('N') for r in recs]
+
+# a truncated file must be caught
+trunc = open(fastq.name,'a')
+trunc.write('@extraRead\nACGT\n')
+trunc.close()
+try:
+    list(ParseFastQ(fastq.name))
+    raise AssertionError("truncated fastq was not detected")
+except InvalidFileFormatError:
+    pass
+
+os.remove(fastq.name)
+print "ParseFastQ: per-record and batch parsing agree."
@@ -0,0 +1,33 @@
+import random
+import itertools
+
+import numpy as np
+
+from rSeq.utils.motifDiscovery.pwmScan import ScoreDistribution,PVAL_RTOL
+
+# check p-value thresholds of random int PWMs against the scores of every kmer they can match
+random.seed(11)
+np.random.seed(11)
+bgFreqs = (0.2,0.3,0.3,0.2)
+
+for rep in range(20):
+    matrix = np.random.randint(0,30,(random.randint(1,6),4)).astype(float)
+    kmers  = [(sum([matrix[j][b] for j,b in enumerate(kmer)]),np.prod([bgFreqs[b] for b in kmer]))
+              for kmer in itertools.product(range(4),repeat=len(matrix))]
+    scoreDist = ScoreDistribution(matrix,bgFreqs)
+    for pVal in [0.5,0.05,0.01,0.001,1e-6]:
+        expected = None
+        for score in sorted(set([s for s,w in kmers])):
+            tail = sum([w for s,w in kmers if s >= score])
+            if tail <= pVal*(1+PVAL_RTOL):
+                expected = (score,tail,len([s for s,w in kmers if s >= score]))
+                break
+        found = scoreDist.threshold(pVal)
+        if expected == None:
+            assert found == None
+        else:
+            assert found[0] == expected[0] and found[2] == expected[2]
+            assert abs(found[1] - expected[1]) < 1e-12
+            assert scoreDist.kmers_over(found[0]) == found[2]
+            assert abs(scoreDist.pval(found[0]) - found[1]) < 1e-12
+print "ScoreDistribution: all thresholds matched."
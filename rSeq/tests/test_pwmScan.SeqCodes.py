@@ -0,0 +1,28 @@
+import random
+
+import numpy as np
+
+from rSeq.utils.motifDiscovery.pwmScan import SeqCodes,scanPWMs
+
+# count hits of random PWMs on both strands and check them against a window by window scan
+seqs = [''.join([random.choice('ACGTN' if random.random() < 0.02 else 'ACGT') for i in range(random.randint(0,300))]) for s in range(100)]
+baseIdx = {'A':0,'C':1,'G':2,'T':3}
+
+def bruteCount(matrix,thresh,seq):
+    hits = 0
+    for p in range(len(seq)-len(matrix)+1):
+        window = seq[p:p+len(matrix)]
+        if 'N' in window:
+            continue
+        for mat in (matrix,matrix[::-1,::-1]):
+            if sum([mat[j][baseIdx[b]] for j,b in enumerate(window)]) >= thresh:
+                hits += 1
+    return hits
+
+matrices = [np.random.randint(0,20,(random.randint(1,12),4)).astype(float) for i in range(8)]
+threshs  = [m.max(1).sum()*random.uniform(0.6,0.9) for m in matrices]
+counts   = scanPWMs(SeqCodes(seqs),matrices,threshs)
+assert counts.shape == (len(seqs),len(matrices))
+for j,(matrix,thresh) in enumerate(zip(matrices,threshs)):
+    assert counts[:,j].tolist() == [bruteCount(matrix,thresh,s) for s in seqs]
+print "SeqCodes: all hit counts matched."
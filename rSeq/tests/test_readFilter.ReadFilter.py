@@ -0,0 +1,62 @@
+import os
+import re
+import random
+import tempfile
+
+import numpy as np
+
+from rSeq.utils.files import ParseFastQ
+from rSeq.utils.readFilter import ReadFilter
+
+# write fastqs with Casava 1.8 and pre-Casava headers and check filter masks against per-read tests
+def casavaHeader(i):
+    return '@HWI-ST619:70:B0BMTABXX:3:1102:%s:78621 1:%s:0:TAGCTT' % (i,random.choice('YN'))
+
+def oldHeader(i):
+    return '@HWUSI-EAS100R:6:73:%s:1973#0/%s' % (i,random.choice('12'))
+
+def mixedHeader(i):
+    return random.choice([casavaHeader,oldHeader])(i)
+
+def flagOf(header):
+    if ' ' not in header:
+        return ''
+    return header.split(' ')[-1].split(':')[1]
+
+exprs = {'flag != N'                       :lambda h,s,q: flagOf(h) != 'N',
+         'flag == N or length > 100'       :lambda h,s,q: flagOf(h) == 'N' or len(s) > 100,
+         'not header ~ "/1$" and ncount < 3':lambda h,s,q: (not re.search('/1$',h)) and s.count('N') < 3,
+         'header ~ "78621\\s1:N"'         :lambda h,s,q: bool(re.search(r'78621\s1:N',h)),
+         'header !~ "#0/1\\s"'             :lambda h,s,q: not re.search(r'#0/1\s',h),
+         'meanqual >= 20 or flag == Y'     :lambda h,s,q: np.mean([ord(x)-33 for x in q]) >= 20 or flagOf(h) == 'Y'}
+
+for makeHeader in [casavaHeader,oldHeader,mixedHeader]:
+    recs = []
+    fastq = tempfile.NamedTemporaryFile(suffix='.fastq',delete=False)
+    for i in range(500):
+        length = random.randint(1,150)
+        seq  = ''.join([random.choice('ACGTN') for x in range(length)])
+        qual = ''.join([chr(33+random.randint(0,40)) for x in range(length)])
+        recs.append((makeHeader(i),seq,'+',qual))
+        fastq.write('%s\n' % ('\n'.join(recs[-1])))
+    fastq.close()
+
+    for expr,test in exprs.iteritems():
+        readFilter = ReadFilter(expr)
+        keep = [rec for rec in recs if test(rec[0],rec[1],rec[3])]
+        masked = []
+        for batch in ParseFastQ(fastq.name,blockSize=5000).batches():
+            mask = readFilter.mask(batch)
+            assert len(mask) == len(batch)
+            masked.extend([rec for rec,k in zip(batch,mask) if k])
+        assert masked == keep,expr
+        assert [rec for rec in recs if readFilter(rec)] == keep
+
+        # the whole file through filter_SEfastQ_headings
+        outPath = fastq.name + '.filtered'
+        results = ParseFastQ(fastq.name).filter_SEfastQ_headings(outPath,key=expr)
+        assert results.filtered == 4*len(keep)
+        assert list(ParseFastQ(outPath)) == keep
+        os.remove(outPath)
+    os.remove(fastq.name)
+print "ReadFilter: all masks matched."
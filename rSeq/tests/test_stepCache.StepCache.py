@@ -0,0 +1,54 @@
+import os
+import shutil
+import tempfile
+
+from rSeq.utils.stepCache import StepCache,cached_run
+from rSeq.utils.pipeline import Scheduler,Step
+
+# steps that rewrite their outputs in place must never change what is cached
+workDir = tempfile.mkdtemp()
+cache   = StepCache(os.path.join(workDir,'cache'))
+outPath = os.path.join(workDir,'out.txt')
+
+def runEcho(word):
+    scheduler = Scheduler(cpus=1,logDir=os.path.join(workDir,'logs'),cache=cache)
+    scheduler.add(Step('echo',['echo',word],stdout=outPath))
+    steps = scheduler.run()
+    return steps['echo'].results.get('cached',False),open(outPath).read()
+
+assert runEcho('A') == (False,'A\n')
+assert runEcho('B') == (False,'B\n')
+assert runEcho('A') == (True,'A\n')
+assert runEcho('B') == (True,'B\n')
+assert runEcho('A') == (True,'A\n')
+
+# dir outputs: a miss writing into a restored dir leaves the cached copy alone
+outDir = os.path.join(workDir,'out_dir')
+def writeDir(word):
+    if not os.path.isdir(outDir):
+        os.makedirs(outDir)
+    outFile = open(os.path.join(outDir,'result.txt'),'wb')
+    outFile.write(word)
+    outFile.close()
+
+for word,cached in [('A',False),('B',False),('A',True)]:
+    results = cached_run(cache,['echo',word,outDir],[outDir],writeDir,word)
+    assert bool(results and results.get('cached')) == cached
+    assert open(os.path.join(outDir,'result.txt')).read() == word
+    writeDir('edited in place')
+results = cached_run(cache,['echo','B',outDir],[outDir],writeDir,'B')
+assert results.get('cached') and open(os.path.join(outDir,'result.txt')).read() == 'B'
+
+# only index base names given as inputs are expanded to their <name>.* files
+os.chdir(workDir)
+wordKey = cache.key(['echo','A'],[outPath])
+open('A.unrelated','w').write('x')
+assert cache.key(['echo','A'],[outPath]) == wordKey
+idxKey = cache.key(['bowtie','A'],[outPath],inputs=['A'])
+assert idxKey != cache.key(['bowtie','A'],[outPath])
+open('A.unrelated','w').write('changed')
+os.utime('A.unrelated',(0,0))
+assert cache.key(['bowtie','A'],[outPath],inputs=['A']) != idxKey
+
+shutil.rmtree(workDir)
+print "StepCache: cached outputs survived in-place rewrites."
@@ -0,0 +1,25 @@
+import os
+import shutil
+import tempfile
+
+from rSeq.utils.motifDiscovery.threshCache import ThreshCache
+
+# thresholds saved by two caches on the same file must both be found by a new one
+cacheDir  = tempfile.mkdtemp()
+cachePath = os.path.join(cacheDir,'threshs','motifs.json')
+
+first  = ThreshCache(cachePath)
+second = ThreshCache(cachePath)
+first.put('a1b2',0.01,0.2,0.3,(11.0,0.0098,12))
+second.put('c3d4',0.01,0.2,0.3,(None,None,0))
+first.save()
+second.save()
+
+cache = ThreshCache(cachePath)
+assert cache.get('a1b2',0.01,0.2,0.3) == (11.0,0.0098,12)
+assert cache.get('c3d4',0.01,0.2,0.3) == (None,None,0)
+assert cache.get('a1b2',0.01,0.3,0.2) == None
+assert cache.get('a1b2',0.001,0.2,0.3) == None
+
+shutil.rmtree(cacheDir)
+print "ThreshCache: all thresholds found."
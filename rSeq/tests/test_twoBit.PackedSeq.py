@@ -0,0 +1,68 @@
+import os
+import random
+import tempfile
+
+from rSeq.utils.twoBit import PackedSeq,TwoBitFile,write_twoBit,fasta2twoBit
+from rSeq.utils.misc import fold_seq,revComp
+from rSeq.utils.stats import seqStats
+
+# build seqs with N runs and lowercase blocks and round-trip them through a .2bit file
+def randSeq(length):
+    seq = [random.choice('ACGT') for x in range(length)]
+    for run in range(random.randint(0,4)):
+        start = random.randint(0,length)
+        end   = min(length,start+random.randint(1,30))
+        seq[start:end] = ['N']*(end-start)
+    for block in range(random.randint(0,4)):
+        start = random.randint(0,length)
+        end   = min(length,start+random.randint(1,50))
+        seq[start:end] = [b.lower() for b in seq[start:end]]
+    return ''.join(seq)
+
+seqs = dict([('chrm%s' % (i),randSeq(length)) for i,length in enumerate([0,1,3,4,5,97,1000])])
+seqs['chrm7'] = 'NNNNacgtNNNNACGTnnnn'
+
+twoBit = tempfile.NamedTemporaryFile(suffix='.2bit',delete=False)
+twoBit.close()
+write_twoBit(seqs,twoBit.name)
+reader = TwoBitFile(twoBit.name)
+assert sorted(reader) == sorted(seqs)
+for name,seq in seqs.iteritems():
+    packed = reader[name]
+    assert len(packed) == len(seq)
+    assert packed.to_str() == seq
+    assert PackedSeq.from_str(seq).to_str() == seq
+    assert packed.revComp().to_str() == revComp(seq)
+    for rep in range(50):
+        start = random.randint(0,len(seq))
+        end   = random.randint(start,len(seq))
+        assert packed[start:end].to_str() == seq[start:end]
+        assert packed[start:end].revComp().to_str() == revComp(seq[start:end])
+        if end > start:
+            assert packed[start] == seq[start]
+assert seqStats(reader.to_dict()) == seqStats(seqs)
+reader.close()
+
+# slices (aligned or not) written back out must read back the same
+sliced = dict([(name,PackedSeq.from_str(seq)[len(seq)//3:]) for name,seq in seqs.iteritems()])
+write_twoBit(sliced,twoBit.name)
+reader = TwoBitFile(twoBit.name)
+for name,seq in seqs.iteritems():
+    assert reader[name].to_str() == seq[len(seq)//3:]
+reader.close()
+
+# fasta2twoBit keeps the fasta's rec order
+fasta = tempfile.NamedTemporaryFile(suffix='.fas',delete=False)
+order = ['chrm6','chrm2','chrm7','chrm5']
+for name in order:
+    fasta.write('>%s\n%s\n' % (name,'\n'.join(fold_seq(seqs[name],60))))
+fasta.close()
+reader = TwoBitFile(fasta2twoBit(fasta.name))
+assert reader.names == order
+assert [reader[name].to_str() for name in order] == [seqs[name] for name in order]
+reader.close()
+
+os.remove(twoBit.name)
+os.remove(fasta.name)
+os.remove(fasta.name + '.2bit')
+print "PackedSeq: all round-trips matched."
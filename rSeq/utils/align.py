@@ -1,12 +1,21 @@
 import sys
+import re
+import string
 import subprocess
+import os
+import shlex
+import tempfile
+import collections
+import signal
 import pdb
 
+import numpy as np
 import pysam
 
 from rSeq.utils.errors import *
-from rSeq.utils.externals import runExternalApp,mkdirp
-from rSeq.utils.misc import whoami
+from rSeq.utils.externals import run_external,LineSink,mkdirp,whereis
+from rSeq.utils.misc import whoami,Bag
+from rSeq.utils.stepCache import cached_run
 
 # import pp if avail
 try:
@@ -26,6 +35,157 @@ except ImportError:
             #line = line.split('\t')
             #line[1] = line[1].split(':')[0],':',cnvsnDict[line[1].split(':')[1]]
 
+############################
+########## CIGARS ##########
+############################
+
+# op codes follow the BAM spec (the same ints as pysam's read.cigar tuples)
+CIGAR_OPS = 'MIDNSHP=X'
+_cigarOpCodes = np.zeros(256,dtype=np.int16) - 1
+for _i,_op in enumerate(CIGAR_OPS):
+    _cigarOpCodes[ord(_op)] = _i
+_isDigit = np.zeros(256,dtype=bool)
+_isDigit[ord('0'):ord('9')+1] = True
+_cigarLens = string.maketrans(CIGAR_OPS + '\n\t',' ' * (len(CIGAR_OPS) + 2)) # leaves only the lengths
+
+# the form of one op per kind:
+#   sam       : '10M200N15M'    every op has a length
+#   ensembl   : '2MD3M6I2D2M'   a missing length means 1
+#   EBI       : same as ensembl
+#   exonerate : 'M 10 D 2 M 5'  op then length, space-delimited
+_cigarDialects = {'sam'      :r'\d+[MIDNSHP=X]',
+                  'ensembl'  :r'\d*[MID]',
+                  'EBI'      :r'\d*[MID]',
+                  'exonerate':r'[ \t]*[MID][ \t]+\d+'}
+_cigarRegexes = {}
+
+
+def _cigar_regex(kind):
+    """Returns compiled regex matching a whole line holding one cigar of kind."""
+    if kind not in _cigarDialects:
+        raise InvalidOptionError(kind,'cigar kind',sorted(_cigarDialects.keys()))
+    if kind not in _cigarRegexes:
+        _cigarRegexes[kind] = re.compile(r'^(?:%s)*[ \t]*$' % (_cigarDialects[kind]),re.M)
+    return _cigarRegexes[kind]
+
+class CigarBatch(object):
+    """Many cigars held as flat op-code/length int arrays.
+    The i-th cigar is ops[offsets[i]:offsets[i+1]] (codes index CIGAR_OPS)
+    with lens[offsets[i]:offsets[i+1]]."""
+    def __init__(self,ops,lens,offsets):
+        self.ops     = np.asarray(ops,dtype=np.uint8)
+        self.lens    = np.asarray(lens,dtype=np.int64)
+        self.offsets = np.asarray(offsets,dtype=np.int64)
+
+    @classmethod
+    def from_strs(cls,cigars,kind='sam'):
+        """Returns CigarBatch parsed from a list of cigar strings of one kind
+        ('sam','ensembl','EBI' or 'exonerate').  The strings are validated by
+        one regex pass over all of them; ops and lengths are then pulled out
+        of the joined text with array ops."""
+        lineRegex = _cigar_regex(kind)
+        cigars = [str(c).strip() for c in cigars]
+        text   = '\n'.join(cigars)
+        if len(lineRegex.findall(text)) != len(cigars):
+            bad = [c for c in cigars if not lineRegex.match(c)][0]
+            raise InvalidOptionError(bad,'%s cigar string' % (kind),'ops of %s with their lengths' % (kind))
+        raw   = np.frombuffer(text,dtype=np.uint8)
+        codes = _cigarOpCodes[raw]
+        opIdx = np.flatnonzero(codes >= 0)
+        lens  = np.ones(len(opIdx),dtype=np.int64)
+        if len(opIdx):
+            numbers = np.fromstring(text.translate(_cigarLens),dtype=np.int64,sep=' ')
+            if kind == 'exonerate':
+                lens[:] = numbers
+            else:
+                # lengths come before their op; ensembl/EBI ops may have none
+                hasLen = _isDigit[raw[opIdx-1]] & (opIdx > 0)
+                lens[hasLen] = numbers
+        sepIdx = np.flatnonzero(raw == ord('\n'))
+        return cls(codes[opIdx],
+                   lens,
+                   np.concatenate(([0],np.searchsorted(opIdx,sepIdx),[len(opIdx)])))
+
+    @classmethod
+    def from_tuples(cls,cigarTuples):
+        """Returns CigarBatch from lists of (opCode,length) tuples (ex: pysam's read.cigar)."""
+        counts = [len(x) for x in cigarTuples]
+        flat   = np.array([tup for x in cigarTuples for tup in x],dtype=np.int64).reshape(-1,2)
+        return cls(flat[:,0],flat[:,1],np.concatenate(([0],np.cumsum(counts,dtype=np.int64))))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def counts(self):
+        """Returns int array: number of ops in each cigar."""
+        return np.diff(self.offsets)
+
+    def seg_ids(self):
+        """Returns int array: index of the cigar each op belongs to."""
+        return np.repeat(np.arange(len(self)),self.counts())
+
+    def tuples(self,i):
+        """Returns the i-th cigar as a list of (opLetter,length) tuples."""
+        start,end = self.offsets[i],self.offsets[i+1]
+        return [(CIGAR_OPS[op],int(length)) for op,length in zip(self.ops[start:end],self.lens[start:end])]
+
+    def reversed(self,mask=None):
+        """Returns new CigarBatch with the op order of each cigar (or only of
+        those where bool array <mask> is True, ex: '-' strand alignments) reversed."""
+        seg = self.seg_ids()
+        idx = np.arange(len(self.ops))
+        rev = self.offsets[seg] + self.offsets[seg+1] - 1 - idx
+        if mask is not None:
+            rev = np.where(np.asarray(mask,dtype=bool)[seg],rev,idx)
+        return CigarBatch(self.ops[rev],self.lens[rev],self.offsets)
+
+    def _opMask(self,opLetters):
+        table = np.zeros(len(CIGAR_OPS),dtype=bool)
+        table[[CIGAR_OPS.index(x) for x in opLetters]] = True
+        return table[self.ops]
+
+    def ref_lengths(self,refOps='MDN=X'):
+        """Returns int array: number of ref positions each cigar spans."""
+        seg = self.seg_ids()
+        lens = np.where(self._opMask(refOps),self.lens,0)
+        return np.bincount(seg,weights=lens,minlength=len(self)).astype(np.int64)
+
+    def blocks(self,starts=0,refOps='MDN=X',blockOps='M=X',merge=True):
+        """
+        GIVEN:
+        1) starts: ref coord (0-based) where each cigar starts (int or int array)
+        2) refOps: op letters that move along the ref
+        3) blockOps: op letters that are aligned blocks (a subset of refOps)
+        4) merge: adjacent blockOps (after dropping ops not in refOps) form
+           one block; if False every blockOp is a block of its own
+
+        RETURN:
+        1) (blkStarts,blkEnds,blkOffsets): half-open block coords of every
+           cigar; those of the i-th are blkStarts[blkOffsets[i]:blkOffsets[i+1]].
+        """
+        count = len(self)
+        seg   = self.seg_ids()
+        keep  = self._opMask(refOps)
+        seg,lens,isBlk = seg[keep],self.lens[keep],self._opMask(blockOps)[keep]
+
+        # position of every op inside its own cigar via one cumsum over all of them
+        ends    = np.cumsum(lens)
+        segBase = np.concatenate(([0],np.cumsum(np.bincount(seg,weights=lens,minlength=count).astype(np.int64))))
+        offset  = np.zeros(count,dtype=np.int64) + starts - segBase[:-1]
+        ends    = ends + offset[seg]
+        begins  = ends - lens
+
+        if merge:
+            sameAsPrev = np.concatenate(([False],(seg[1:] == seg[:-1]) & isBlk[:-1]))
+            sameAsNext = np.concatenate(((seg[:-1] == seg[1:]) & isBlk[1:],[False]))
+            firsts = isBlk & ~sameAsPrev
+            lasts  = isBlk & ~sameAsNext
+        else:
+            firsts = lasts = isBlk
+        blkCounts = np.bincount(seg[firsts],minlength=count)
+        return begins[firsts],ends[lasts],np.concatenate(([0],np.cumsum(blkCounts)))
+
+
 def cigarStr2AlignCoords(cigarString,minCoord,maxCoord,alignStrand,cigKind='ensembl',intron='I'):
     """Returns List of coordinate tuples for each block in form of:
     [
@@ -37,74 +197,25 @@ def cigarStr2AlignCoords(cigarString,minCoord,maxCoord,alignStrand,cigKind='ense
     
     NOTE: Assumes 0-referenced "in-between" coordinate system as used in BED/exonerate."""
     
-    cigInfo = parseCigarString(cigarString,kind=cigKind)
-    
-    # Reverse cigData if alignStrand is neg
-    if alignStrand == ('-' or '-1'):
-        cigInfo.reverse()
-    elif alignStrand == ('+' or '1'):
-        pass
-    else:
+    if alignStrand not in ['-','-1','+','1']:
         raise InvalidOptionError("cigarStr2AlignCoords: valid alignStrand values are %s. You gave: %s" \
                                  % (['-','+','-1','1'],alignStrand))
-    if intron == 'I':
-        ignore = 'D'
-    elif intron == 'D':
-        ignore = 'I'
-    else:
+    # the 'intron' op moves along the chrm seq; the other non-M op relates to
+    # insertions in the aligned seq and does not affect coords on the chrm seq.
+    if intron not in ['I','D']:
         raise InvalidOptionError("cigarStr2AlignCoords: valid intron values are %s. You gave: %s" \
                                  % (['I','D'],intron)) 
     
-    # 1: remove all 'ignore' info since these seem to relate to insertions in the aligned seq
-    # and do not affect coords on the chrm seq.
-    cigNoIgnores = []
-    for elem in cigInfo:
-        if elem[0] == ignore:
-            continue
-        else:
-            cigNoIgnores.append(elem)
-            
-    # 2: combine any 'M' info that are adjacent to each other after cleaning out the 'ignore' info.
-    cigCmbnMs = []
-    while 1:
-        if not len(cigNoIgnores) > 0:
-            break
-        Ms = []
-        while 1:
-            try:
-                if cigNoIgnores[0][0] == 'M':
-                    Ms.append(cigNoIgnores.pop(0))
-                else:
-                    break
-            except IndexError:
-                break
-        cigCmbnMs.append(('M',sum([x[1] for x in Ms])))
-        if len(cigNoIgnores) > 0:
-            cigCmbnMs.append(cigNoIgnores.pop(0))
-        else:
-            break
-    
-    # 3: walk the cig, keeping track of where on Chrm you are and logging boundaries.
-    blkCoordsRelative = []
-    i = 0
-    while i < len(cigCmbnMs):
-        if cigCmbnMs[i][0] == 'M':
-            end   = sum([x[1] for x in cigCmbnMs[:i+1]]) 
-            start = end - cigCmbnMs[i][1]
-            blkCoordsRelative.append((start,end))
-            i += 1
-        else:
-            i += 1
-    blkCoordsAbsolute = []
-    for coord in blkCoordsRelative:
-        blkCoordsAbsolute.append((coord[0]+minCoord,coord[1]+minCoord))
+    cigars = CigarBatch.from_strs([cigarString],kind=cigKind)
+    if alignStrand in ['-','-1']:
+        cigars = cigars.reversed()
+    blkStarts,blkEnds,blkOffsets = cigars.blocks(minCoord,refOps='M'+intron,blockOps='M')
     
     # Confirm that calculated max coord == maxCoord
-    calcMax = max([x[1] for x in blkCoordsAbsolute])
-    if calcMax != maxCoord:
+    if (not len(blkEnds)) or (blkEnds.max() != maxCoord):
         raise UnexpectedValueError("cigarStr2AlignCoords: calculated max coord != maxCoord.  My code may not be correct, but check that you used the correct 'intron' value first.")
     else:
-        return blkCoordsAbsolute
+        return [(int(s),int(e)) for s,e in zip(blkStarts,blkEnds)]
     
 def parseCigarString(cigarString,kind='ensembl'):
     """Returns cigarInfo from cigarString in form:
@@ -118,38 +229,22 @@ def parseCigarString(cigarString,kind='ensembl'):
     
     validParserKinds  = {'ensembl':parseEnsemblCigar,
                          'exonerate':parseExonerateCigar,
-                         'EBI':parseEBIcigar}
+                         'EBI':parseEBIcigar,
+                         'sam':parseSamCigar}
     
-    validCigOps = ['M','D','I']
     if kind not in validParserKinds.keys():
-        raise InvalidOptionError('parseCigarString: valid kinds are: %s.  You gave: %s' % (validKinds,kind))
+        raise InvalidOptionError('parseCigarString: valid kinds are: %s.  You gave: %s' % (validParserKinds.keys(),kind))
     if not type(cigarString) == type(''):
         raise InvalidOptionError('parseCigarString: type(cigarString) != type(""): %s' % (kind))
     
-    cigData = validParserKinds[kind](cigarString)
-
-    
-    # Do some validation of cigar operation letters:
-    cigOps = list(set([x[0] for x in cigData]))
-    for op in cigOps:
-        if not op in validCigOps:
-            raise InvalidOptionError("parseCigarString: valid cigar operation letters are %s.  malformed cigarString (%s)." \
-                                     % (validCigOps,cigarString))
-    return cigData
+    # op letters are validated by the dialect's regex
+    return validParserKinds[kind](cigarString)
     
 
 def parseExonerateCigar(cigarString):
     """Given exonerate style cigar string, return list of lists representing
     [[letter,number],[letter,number],...]."""
-    cigarList = cigarString.split()
-    
-    # Format cigar info for easy use:
-    cigar = []
-    if not len(cigarList)%2==0:
-        raise InvalidOptionError('parseExonerateCigar: cigarList var is not a list with an even number of indexes.')
-    while cigarList:
-        cigar.append((cigarList.pop(0),int(cigarList.pop(0))))
-    return cigar
+    return CigarBatch.from_strs([cigarString],kind='exonerate').tuples(0)
 
 def parseEBIcigar(cigStr):
     """
@@ -157,63 +252,23 @@ def parseEBIcigar(cigStr):
     1) cigStr: cigar string in form '524MI15MD51MD43MD14M'
     
     DO:
-    1) add a ' ' after every M,I,D and then split string.
-    2) break the number-letter into parts and add '1' to
-       solo letters.
+    1) parse the number-letter parts, using '1' for solo letters.
     
     RETURN:
     1) cigTup: a tuple of tuples representing the operation
        letter followed by the number.
     """
-    
-    cigList = cigStr.replace('D','D ').replace('M','M ').replace('I','I ').split()
-    
-    for i in range(len(cigList)):
-        if len(cigList[i]) == 1:
-            cigList[i] = (cigList[i],1)
-        else:
-            cigList[i] = (cigList[i][-1],int(cigList[i][:-1]))
-    return tuple(cigList)
+    return tuple(CigarBatch.from_strs([cigStr],kind='EBI').tuples(0))
 
 def parseEnsemblCigar(cigarString):
     """Given ensembl style cigar line, return list of lists representing
     [[letter,number],[letter,number],...]."""
-    def getNumEnd(cigString,index):
-        try:
-            int(cigString[index])
-            index+=1
-            end = getNumEnd(cigString,index)
-        except ValueError:
-            return index
-        return end
-    
-    cigList = []
-    i=0
-    while i < len(cigarString):
-        num = None
-        let = None
-        
-        try:
-            int(cigarString[i])
-            try:
-                end = getNumEnd(cigarString,i)
-                num = int(cigarString[i:end])
-                i = end
-            except ValueError:
-                raise Exception('parseEnsemblCigar.getNumEnd: failed check code.')
-        except ValueError:
-            let = cigarString[i]
-            i+=1
-            
-        if num:
-            let = cigarString[i]
-            i+=1
-            cigList.append((let,num))
-        elif let:
-            cigList.append((let,1))
-        else:
-            raise InvalidOptionError('parseEnsemblCigar: passed through a cycle without assigning let OR num. Check for valid cigarString: %s' % (cigarString))
-    return cigList
+    return CigarBatch.from_strs([cigarString],kind='ensembl').tuples(0)
+
+def parseSamCigar(cigarString):
+    """Given SAM style cigar string, return list of lists representing
+    [[letter,number],[letter,number],...]."""
+    return CigarBatch.from_strs([cigarString],kind='sam').tuples(0)
             
 
 def exonerateCigar2BEDline(cigarLine,rgb="0,0,0"):
@@ -236,47 +291,32 @@ def exonerateCigar2BEDline(cigarLine,rgb="0,0,0"):
     cigInfo = ' '.join(line[10:])  # actual CIGAR encoding converted back to string for parser.
     
     # Format cigar info for easy use:
-    cigar = parseCigarString(cigInfo,type='exonerate')
-    if "I" in [x[0] for x in cigar]:
-        sys.stderr.write('warn: just encountered a cigar containing "I".  Skipping.\n')
-        return '' # for now just do nothing
-
-        #raise UnexpectedValueError('cigar info includeds "I" and I have not been taught how to deal with this!')
+    # 'D' moves along the target; 'I' only along the query so it does not break a block.
+    cigar = CigarBatch.from_strs([cigInfo],kind='exonerate')
     
     # If match is to '-' strand of target, reverse the cigar info
     if tStrand == '-':
-        cigar.reverse()
+        cigar = cigar.reversed()
         
-    # Bed Terms
-    chrom       = target
     chromStart  = min(int(tStart),int(tEnd))
     chromEnd    = max(int(tStart),int(tEnd))
-    name        = query
-    score       = 0
-    strand      = tStrand
-    thickStart  = chromStart
-    thickEnd    = chromEnd
-    itemRgb     = rgb
-    blockCount  = len([x[0] for x in cigar if x[0]=="M"])
-    blockSizes  = ','.join([x[1] for x in cigar if x[0]=="M"])
-    blockStarts = ['0']  # for now.  See below.
-    
-    # Calculate blockStarts
-    i = 0
-    while 1:
-        if i < len(cigar)-1:
-            blockStarts.append(str(int(cigar[i][1])+int(cigar[i+1][1])))
-            i += 2
-        else:
-            break
-    blockStarts = ','.join(blockStarts)
+    blkStarts,blkEnds,blkOffsets = cigar.blocks(chromStart,refOps='MD',blockOps='M')
     
-    # Formulate and return BedLine
+    return blocks2BEDline(target,chromStart,chromEnd,query,0,tStrand,
+                          blkStarts.tolist(),blkEnds.tolist(),rgb=rgb)
+
+def blocks2BEDline(chrom,chromStart,chromEnd,name,score,strand,blkStarts,blkEnds,rgb="0,0,0"):
+    """Returns a BED12 line (with '\n') for an alignment whose blocks span
+    [blkStarts[i],blkEnds[i]) on chrom.  thickStart/thickEnd are set to
+    chromStart/chromEnd."""
+    blockSizes  = ','.join([str(e-s) for s,e in zip(blkStarts,blkEnds)])
+    blockStarts = ','.join([str(s-chromStart) for s in blkStarts])
     return "%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\n" % \
            (chrom,chromStart,chromEnd,name,score,strand,
-            thickStart,thickEnd,itemRgb,blockCount,blockSizes,blockStarts)
+            chromStart,chromEnd,rgb,len(blkStarts),blockSizes,blockStarts)
     
 
+
 ############################
 ########## BOWTIE ##########
 ############################
@@ -384,47 +424,136 @@ def pipe_bowtie2bam(btIndex,outPath,fastq1,fastq2=None,options=None):
       -h/--help          print this usage message
 
     """
-    Popen = subprocess.Popen
-    PIPE = subprocess.PIPE
-    
     # example:
     # bowtie --solexa1.3-quals -v 2 -m 1 -S $BINDX -p 2 --mm "${RBA},${RBB}" | samtools view -bS - > $RB_BAM
     
-    # Prepare the command line args
-    options = options.split()
-    #pdb.set_trace()
-    if fastq2 == None:
-        btArgs = ['bowtie'] + options + [btIndex] + [fastq1]
-        samArgs = ['samtools','view','-bS','-']
-        print "running: \nbowtie with cmd: '%s'\nsamtools with cmd: '%s'\noutfile:%s" \
-              % (' '.join(btArgs),' '.join(samArgs),outPath)
-        
-        bowtieStep  = Popen(btArgs,
-                            stdout=PIPE)
-        
-        samViewStep = Popen(samArgs,
-                            stdin=bowtieStep.stdout,
-                            stdout=open(outPath,'w'))
+    stages = [('bowtie',_bowtie_args(btIndex,fastq1,fastq2,options)),
+              ('samtools view',['samtools','view','-bS','-'])]
+    print "running: \n%s\noutfile:%s" % (' | '.join([' '.join(args) for name,args in stages]),outPath)
+    
+    outFile = open(outPath,'wb')
+    try:
+        return run_pipe(stages,stdout=outFile)
+    finally:
+        outFile.close()
 
-        bowtieStep.stdout.close()
-        samViewStep.stdout.close()
+def pipe_bowtie2srtd_idx_bam(btIndex,outPrefix,fastq1,fastq2=None,options=None,sortMem=None,index=True):
+    """Stream bowtie's SAM through samtools view (uncompressed BAM) into
+    samtools sort and then index the sorted BAM.  No SAM or unsorted BAM is
+    written to disk.
+    
+    btIndex: valid bowtie index residing in $BOWTIE_INDEXES
+    outPrefix: path prefix of the sorted BAM (writes outPrefix.bam[.bai])
+    fastq1: path(s) to upstream mates or single reads (if fastq2=None) ["p1,p2...pN"]
+    fastq2: path(s) to downstream mates ["p1,p2...pN"]
+    options: valid cmd line options string for bowtie ("-S" is added if missing)
+    sortMem: max memory per samtools sort thread (passed as "-m")
+    index: run "samtools index" on the sorted BAM
+    
+    Returns Bag(bam=path, returncodes={stage:exitCode}, stderr={stage:txt}).
+    Raises SystemCallError naming every failed stage if any exit code is non-zero.
+    
+    Equivalent to:
+    bowtie <opts> -S <idx> <reads> | samtools view -bSu - | samtools sort - <outPrefix> && samtools index <outPrefix>.bam
+    """
+    btArgs = _bowtie_args(btIndex,fastq1,fastq2,options)
+    if not [x for x in btArgs if x in ['-S','--sam']]:
+        btArgs.insert(1,'-S')
+    sortArgs = ['samtools','sort']
+    if sortMem:
+        sortArgs += ['-m',str(sortMem)]
+    sortArgs += ['-',outPrefix]
+    
+    stages = [('bowtie',btArgs),
+              ('samtools view',['samtools','view','-bSu','-']),
+              ('samtools sort',sortArgs)]
+    print "running: \n%s" % (' | '.join([' '.join(args) for name,args in stages]))
+    results = run_pipe(stages)
+    results.bam = '%s.bam' % (outPrefix)
+    
+    if index:
+        indexResults = run_pipe([('samtools index',['samtools','index',results.bam])])
+        results.returncodes.update(indexResults.returncodes)
+        results.stderr.update(indexResults.stderr)
+    
+    for name,txt in results.stderr.iteritems():
+        for line in txt.splitlines():
+            sys.stderr.write('[%s:%s] %s\n' % (whoami(),name,line))
+    return results
+
+def _bowtie_args(btIndex,fastq1,fastq2=None,options=None):
+    """Returns the bowtie argument list used by the pipe_bowtie* funcs."""
+    if options:
+        options = options.split()
     else:
-        btArgs = ['bowtie'] + options + [btIndex] + ['-1'] + [fastq1] + ['-2'] + [fastq2]
-        samArgs = ['samtools','view','-bS','-']
-        print "running: \nbowtie with cmd: '%s'\nsamtools with cmd: '%s'\noutfile:%s" \
-              % (' '.join(btArgs),' '.join(samArgs),outPath)
-        
-        bowtieStep  = Popen(args,
-                            stdout=PIPE)
-        
-        samViewStep = Popen(samArgs,
-                            stdin=bowtieStep.stdout,
-                            stdout=open(outPath,'w'))
+        options = []
+    if fastq2 == None:
+        return ['bowtie'] + options + [btIndex] + [fastq1]
+    return ['bowtie'] + options + [btIndex] + ['-1'] + [fastq1] + ['-2'] + [fastq2]
 
-        bowtieStep.stdout.close()
-        samViewStep.stdout.close()
-        
+def _default_sigpipe():
+    """python ignores SIGPIPE and children inherit that; restore the default
+    so an upstream stage exits quietly when a downstream stage quits."""
+    signal.signal(signal.SIGPIPE,signal.SIG_DFL)
+
+def run_pipe(stages,stdout=None):
+    """Runs external programs connected by OS pipes (stage i's stdout feeds stage i+1)
+    and waits on ALL of them.
     
+    stages : list of (stageName,argsList) tuples
+    stdout : file obj for the last stage's stdout (default: inherited)
+    
+    Each stage's stderr is spooled to a temp file so that a chatty stage can not
+    block the pipe.  Returns Bag(returncodes={stage:exitCode},stderr={stage:txt}).
+    Raises SystemCallError listing the exit code of every stage if any failed.
+    """
+    for name,args in stages:
+        if not whereis(args[0]):
+            raise SystemCallError(None,'"%s" command not found in your PATH environmental variable.' % (args[0]))
+    
+    procs  = []
+    errs   = []
+    stdin  = None
+    for i,(name,args) in enumerate(stages):
+        err = tempfile.TemporaryFile()
+        if i == len(stages)-1:
+            out = stdout
+        else:
+            out = subprocess.PIPE
+        try:
+            proc = subprocess.Popen(args,stdin=stdin,stdout=out,stderr=err,preexec_fn=_default_sigpipe)
+        except OSError:
+            for p in procs:
+                p.kill()
+                p.wait()
+            raise
+        if stdin:
+            # drop our copy so the upstream stage gets SIGPIPE if this one dies
+            stdin.close()
+        stdin = proc.stdout
+        procs.append(proc)
+        errs.append(err)
+    
+    results = Bag({'returncodes':collections.OrderedDict(),
+                   'stderr':collections.OrderedDict()})
+    for (name,args),proc,err in zip(stages,procs,errs):
+        results.returncodes[name] = proc.wait()
+        err.seek(0)
+        results.stderr[name] = err.read()
+        err.close()
+    
+    # a stage killed by SIGPIPE only failed if a stage downstream of it did
+    codes  = results.returncodes.values()
+    failed = [name for i,(name,code) in enumerate(results.returncodes.iteritems())
+              if code != 0 and not ((code == -signal.SIGPIPE) and not any(codes[i+1:]))]
+    if failed:
+        report = ', '.join(['%s=%s' % (name,code) for name,code in results.returncodes.iteritems()])
+        details = '\n'.join(['[%s] %s' % (name,results.stderr[name].strip()) for name in failed])
+        raise SystemCallError(results.returncodes[failed[0]],
+                              'pipeline failed (exit codes: %s)\n%s' % (report,details),
+                              ' | '.join(failed))
+    return results
+        
 
 def bowtie_index(reference_in,ebwt_outfile_base,runDir,options=None):
     """Create bowtie indexes from new fasta set.
@@ -466,24 +595,25 @@ def bowtie_index(reference_in,ebwt_outfile_base,runDir,options=None):
     mkdirp(runDir)
     
     # Construct cmdArgs
+    cmdArgs = ['bowtie-build']
     if options:
-        cmdArgs = "%s %s %s" % (options,reference_in,ebwt_outfile_base)
-    # Run bowtie-build and capture output
-    btBuildResults = runExternalApp('bowtie-build',cmdArgs)
-    
-    # Report bowtie-build stdout and stderr
-    if btBuildResults[0]:
-        print('[%s] %s' % (whoami(),btBuildResults[0]))
-    if btBuildResults[1]:
-        sys.stderr('[%s] %s' % (whoami(),btBuildResults[1]))
+        cmdArgs += shlex.split(options)
+    cmdArgs += [reference_in,ebwt_outfile_base]
+    
+    # Run bowtie-build streaming its stdout and stderr to ours
+    btBuildResults = run_external(cmdArgs,
+                                  stdout=LineSink('[%s] ' % (whoami()),sys.stdout),
+                                  stderr=LineSink('[%s] ' % (whoami()),sys.stderr))
         
     return btBuildResults
     
-def bowtie_align(ebwt,readsString,hit,runDir,options=None):
+def bowtie_align(ebwt,readsString,hit,runDir,options=None,cache=None):
     """Run alignment of fastQ to bowtie index.
     options     : quoted string representing valid cmd line bowtie-build options
     runDir      : path to dir to place stdErr/stdOut logs - all steps of pipeline scripts should share same runDir
     readsString : appropriate quoted string representing which fastq files to use (see bowtie -h).
+    cache       : stepCache.StepCache; if this exact alignment (same index, reads, bowtie
+                  version and options) was cached, <hit> is restored from it instead.
     
     ----------
     bowtie help text:
@@ -579,23 +709,19 @@ def bowtie_align(ebwt,readsString,hit,runDir,options=None):
     mkdirp(runDir)
     
     # Construct cmdArgs
+    cmdArgs = ['bowtie']
     if options:
-        cmdArgs = "%s %s  %s %s" % (options,ebwt,readsString,hit)
-    else:
-        cmdArgs = "%s %s %s" % (ebwt,readsString,hit)
+        cmdArgs += shlex.split(options)
+    cmdArgs += [ebwt] + shlex.split(readsString) + [hit]
         
-    # Run and capture output
-    print "Setting up bowtie call with the following cmd:\n\t\tbowtie %s" % (cmdArgs)
-    btResults = runExternalApp('bowtie',cmdArgs)
-    
-    # Report stdout and stderr
-    if btResults[0]:
-        for line in btResults[0].split('\n'):
-            print('[%s] %s' % (whoami(),line))
-        
-    if btResults[1]:
-        for line in btResults[1].split('\n'):
-            sys.stderr.write('[%s] %s' % (whoami(),line))
+    # Run and stream output
+    print "Setting up bowtie call with the following cmd:\n\t\t%s" % (' '.join(cmdArgs))
+    btResults = cached_run(cache,cmdArgs,[hit],
+                           run_external,cmdArgs,inputs=[ebwt],
+                           stdout=LineSink('[%s] ' % (whoami()),sys.stdout),
+                           stderr=LineSink('[%s] ' % (whoami()),sys.stderr))
+    if not btResults.get('cached'):
+        print "[%s] bowtie: cpu %.1fs, peak RSS %s kB" % (whoami(),btResults.cpuTime,btResults.peakRSS)
         
     return btResults
 
@@ -603,29 +729,27 @@ def bowtie_align(ebwt,readsString,hit,runDir,options=None):
 ########## SAMTOOLS ##########
 ##############################
 
-def run_samtools(tool,argsList):
+def run_samtools(tool,argsList,cache=None,outputs=None):
     """Core wrapper for calls to samtools and associated
     stderr/stdout reporting.  See specific func defs for each
     tool's samtool's help text.
     
     tool     : sort,view,index,etc...
     argsList : list obj with appropriatly structured args for samtools "tool"
+    cache    : stepCache.StepCache to reuse <outputs> of an identical earlier call
+    outputs  : paths the call writes (needed with cache)
     """
     # Construct cmdArgs
-    cmdArgs = "%s %s" % (tool," ".join(argsList))
-        
-    # Run and capture output
-    print "Setting up samtools call with the following cmd:\n\tsamtools %s" % (cmdArgs)
-    results = runExternalApp('samtools',cmdArgs)
-    
-    # Report stdout and stderr
-    if results[0]:
-        for line in results[0].split('\n'):
-            print('[%s] %s' % (whoami(),line))
+    cmdArgs = ['samtools',tool] + list(argsList)
         
-    if results[1]:
-        for line in results[1].split('\n'):
-            sys.stderr.write('[%s] %s' % (whoami(),line))
+    # Run and stream output
+    print "Setting up samtools call with the following cmd:\n\t%s" % (' '.join(cmdArgs))
+    if cache and not outputs:
+        raise MissingArgumentError('run_samtools: outputs must be given to use a cache.')
+    results = cached_run(cache,cmdArgs,outputs,
+                         run_external,cmdArgs,
+                         stdout=LineSink('[%s] ' % (whoami()),sys.stdout),
+                         stderr=LineSink('[%s] ' % (whoami()),sys.stderr))
         
     return results
 
@@ -663,10 +787,11 @@ def samtools_view(argsList):
         
     return run_samtools('view',argsList)
 
-def samtools_sort(argsList):
+def samtools_sort(argsList,cache=None):
     """Wrapper for samtools "sort".
     
     argsList  :  list obj with appropriatly structured args for samtools "sort".
+    cache     :  stepCache.StepCache; reuse <out.prefix>.bam of an identical earlier sort.
     
     ----------
     samtools sort help text:
@@ -674,7 +799,7 @@ def samtools_sort(argsList):
     Usage: samtools sort [-on] [-m <maxMem>] <in.bam> <out.prefix>
     """
     
-    return run_samtools('sort',argsList)
+    return run_samtools('sort',argsList,cache=cache,outputs=['%s.bam' % (argsList[-1])])
 
 def samtools_index(argsList):
     """Wrapper for samtools "index".
@@ -729,7 +854,7 @@ def pysamtools_call(funcName,argsList):
 ########## TOPHAT ##########
 ############################
 
-def tophat_align(bowtie_index,readsA,readsB=None,qualsA=None,qualsB=None,options=None,runDir=None):
+def tophat_align(bowtie_index,readsA,readsB=None,qualsA=None,qualsB=None,options=None,runDir=None,cache=None):
     # TODO: eliminate "Reconstituting reference FASTA file from Bowtie index \ [FAILED] \ Error: bowtie-inspect returned an error."
 
     """
@@ -743,6 +868,8 @@ def tophat_align(bowtie_index,readsA,readsB=None,qualsA=None,qualsB=None,options
     qualsA       : List/None
     qualsB       : List/None
     options      : String      quoted comma-sep str of CLI tophat options
+    runDir       : String      tophat out dir (tophat's default: ./tophat_out)
+    cache        : StepCache   reuse the out dir of an identical earlier run
     ------------------
     
     **NOTES**
@@ -860,15 +987,12 @@ SAM Header Options (for embedding sequencing run metadata in output):
     else:
         qualsB = ''
     
-    # format runDir
-    if runDir:
-        runDir = ' -o %s' % (runDir)
-    else:
-        runDir = ''
-    
     # format cmdArgs
-    if options == None:
-        options = ''
+    cmdArgs = ['tophat']
+    if options:
+        cmdArgs += shlex.split(options)
+    if runDir:
+        cmdArgs += ['-o',runDir]
         
     # format bowtie_index
     #   This seems needed or tophat cant reconstitute the fasta files for some reason
@@ -877,23 +1001,20 @@ SAM Header Options (for embedding sequencing run metadata in output):
     #    *  [FAILED]
     #    *  Error: bowtie-inspect returned an error.
     if not bowtie_index.startswith('/'):
-        bowtie_index = "$BOWTIE_INDEXES/%s" % (bowtie_index)
+        bowtie_index = os.path.join(os.environ.get('BOWTIE_INDEXES',''),bowtie_index)
         
-    cmdArgs = "%s %s %s %s %s %s" % (options+runDir,bowtie_index,readsA,readsB,qualsA,qualsB)
+    cmdArgs += [bowtie_index] + [x for x in [readsA,readsB,qualsA,qualsB] if x]
 
         
-    # Run and capture output
-    print "Setting up tophat call with the following cmd:\n\t\ttophat %s" % (cmdArgs)
-    thResults = runExternalApp('tophat',cmdArgs)
-    
-    # Report stdout and stderr
-    if thResults[0]:
-        for line in thResults[0].split('\n'):
-            print('[%s] %s' % (whoami(),line))
-        
-    if thResults[1]:
-        for line in thResults[1].split('\n'):
-            sys.stderr.write('[%s] %s' % (whoami(),line))
+    # Run and stream output
+    print "Setting up tophat call with the following cmd:\n\t\t%s" % (' '.join(cmdArgs))
+    # with a cache, the whole tophat out dir is the cached unit
+    thResults = cached_run(cache,cmdArgs,[runDir or 'tophat_out'],
+                           run_external,cmdArgs,inputs=[bowtie_index],
+                           stdout=LineSink('[%s] ' % (whoami()),sys.stdout),
+                           stderr=LineSink('[%s] ' % (whoami()),sys.stderr))
+    if not thResults.get('cached'):
+        print "[%s] tophat: cpu %.1fs, peak RSS %s kB" % (whoami(),thResults.cpuTime,thResults.peakRSS)
         
     return thResults
 
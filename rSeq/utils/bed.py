@@ -1,6 +1,88 @@
+import bisect
+
 from rSeq.utils.errors import *
 from rSeq.utils.externals import runExternalApp,mkdirp
 from rSeq.utils.files import onlyInA
+from rSeq.utils.misc import Bag
+
+def isHeaderLine(line):
+    """Returns TRUE for BED 'track'/'browser' lines, comments and blank lines."""
+    return line.startswith(('track','browser','#')) or not line.strip()
+
+def bedWindow(start,end,strand,win,stranded=True):
+    """Returns (winStart,winEnd) of the area win[0] upstrm and win[1] dwnstrm of a
+    feature: on the feature's strand if <stranded>, else on the plus strand
+    (same as windowBed -l -r [-sw]).  winStart is not allowed below 0."""
+    if stranded and (strand == '-'):
+        return max(0,start-win[1]),end+win[0]
+    return max(0,start-win[0]),end+win[1]
+
+class IntervalIndex(object):
+    """In-memory index of 0-based, half-open intervals by chrom.
+    Exmpl: idx = IntervalIndex()
+           idx.add('chr1',100,200,'geneA')
+           idx.overlaps('chr1',150,160) -> True
+           idx.find('chr1',150,160)     -> ['geneA']
+    Intervals are kept in per-chrom lists sorted by start and searched with
+    bisect; overlaps() uses the merged intervals and find() the running max
+    of the interval ends, so neither scans intervals that can not overlap."""
+    def __init__(self):
+        self._added  = {} # chrom: list of (start,end,item)
+        self._chroms = None
+
+    def add(self,chrom,start,end,item=None):
+        self._added.setdefault(chrom,[]).append((start,end,item))
+        self._chroms = None
+
+    def _freeze(self):
+        self._chroms = {}
+        for chrom,ivals in self._added.iteritems():
+            ivals.sort(key=lambda x: (x[0],x[1]))
+            starts  = [x[0] for x in ivals]
+            maxEnds = []
+            mergedS = []
+            mergedE = []
+            maxEnd  = None
+            for start,end,item in ivals:
+                maxEnd = end if maxEnd == None else max(maxEnd,end)
+                maxEnds.append(maxEnd)
+                if mergedE and (start < mergedE[-1]):
+                    # merge only true overlaps: an empty query where two intervals touch hits neither
+                    mergedE[-1] = max(mergedE[-1],end)
+                else:
+                    mergedS.append(start)
+                    mergedE.append(end)
+            self._chroms[chrom] = Bag({'starts':starts,'maxEnds':maxEnds,'ivals':ivals,
+                                       'mergedStarts':mergedS,'mergedEnds':mergedE})
+
+    def _chrom(self,chrom):
+        if self._chroms == None:
+            self._freeze()
+        return self._chroms.get(chrom)
+
+    def overlaps(self,chrom,start,end):
+        """Returns TRUE if [start,end) overlaps any interval on chrom."""
+        data = self._chrom(chrom)
+        if not data:
+            return False
+        i = bisect.bisect_left(data.mergedStarts,end) - 1
+        return (i >= 0) and (data.mergedEnds[i] > start)
+
+    def find(self,chrom,start,end):
+        """Returns list of the items of the intervals overlapping [start,end) on chrom."""
+        data = self._chrom(chrom)
+        if not data:
+            return []
+        hits = []
+        i = bisect.bisect_left(data.starts,end) - 1
+        while (i >= 0) and (data.maxEnds[i] > start):
+            if data.ivals[i][1] > start:
+                hits.append(data.ivals[i][2])
+            i -= 1
+        hits.reverse()
+        return hits
+
+
 def isBEDline(line):
     """Returns TRUE if line 'looks' like a MINIMAL BED formated line."""
     line = line.strip('\n').split('\t')
@@ -73,28 +155,25 @@ def extractFromDoubleSidedBedtoolOut(filePath,cols,side='right',outDir='.'):
     return outFilePath
     
     
-def divByWindow(bedA_Path,bedB_Path,win=[500,500],cols=[6,6],side='right',outDir='.'):
+def divByWindow(bedA_Path,bedB_Path,win=[500,500],cols=[6,6],side='right',outDir='.',useBedtools=False):
     """Create files separating features in bedB by those alling within the area defined
     by <win> and those outside this area in bedA.  If A.bed is stranded, the area is defined
     by win[0] upstrm and win[1] dwnstrm on the FEATURE's strand.  Otherwise its 
     win[0] upstrm and win[1] dwnstrm on the CONTIG/CHROM's plus strand.  Files ouput
     to outDir.
     
+    The windows of bedA are held in an IntervalIndex and bedB is read once,
+    each line going to the 'featsIn' or 'featsNotIn' file, so memory use only
+    depends on bedA and no temp files are made.  Lines keep bedB's order
+    (repeats of the line just written are dropped).  With side='left' the
+    'featsIn' file holds the bedA lines with a bedB feature in their window.
+    useBedtools=True runs the original windowBed/sort/onlyInA version instead.
+    
     NOTE: See DOC for extractFromDoubleSidedBedtoolOut() regarding 'cols' and 'side'"""
 
     # Prepare outDir if it doesnt already exist
     mkdirp(outDir)
     
-    # Collect some useful info
-    bedA_name           = bedA_Path.split('/')[-1].replace('.bed','')
-    bedB_name           = bedB_Path.split('/')[-1].replace('.bed','')
-    B_in_A_winComboPath = '%s/%s_featsIn_%s_Win%sl%sr_combo.bed' % (outDir,
-                                                                    bedB_name,
-                                                                    bedA_name,
-                                                                    win[0],
-                                                                    win[1])
-    
-    
     # Establish whether inputs look like BED files:
     testA = open(bedA_Path,'rU')
     testB = open(bedB_Path,'rU')
@@ -110,11 +189,110 @@ def divByWindow(bedA_Path,bedB_Path,win=[500,500],cols=[6,6],side='right',outDir
         raise InvalidFileFormatError('%s does not seem to be in BED format.' % (bedA_Path))
     if not isBEDline(linesB[1]):
         raise InvalidFileFormatError('%s does not seem to be in BED format.' % (bedB_Path))
+    if side not in ['right','left']:
+        raise InvalidOptionError('option "side" must be one of %s. Was: %s.' % \
+                                 (['right','left'], side))
+    
+    if useBedtools:
+        return _divByWindow_bedtools(bedA_Path,bedB_Path,win,cols,side,outDir)
+    
+    # Collect some useful info
+    bedA_name = bedA_Path.split('/')[-1].replace('.bed','')
+    bedB_name = bedB_Path.split('/')[-1].replace('.bed','')
+    inWinPath = '%s/%s_featsIn_%s_Win%sl%sr_cleaned_%s.bed' % (outDir,
+                                                              bedB_name,
+                                                              bedA_name,
+                                                              win[0],
+                                                              win[1],
+                                                              side)
+    notInWinPath = inWinPath.replace('_featsIn_','_featsNotIn_')
+    
+    # Index the windows around bedA's features
+    stranded = isStranded(linesA[1])
+    windows  = IntervalIndex()
+    linesA   = []
+    for line in open(bedA_Path,'rU'):
+        if isHeaderLine(line):
+            continue
+        fields = line.rstrip('\n').split('\t')
+        strand = fields[5] if len(fields) > 5 else '+'
+        winStart,winEnd = bedWindow(int(fields[1]),int(fields[2]),strand,win,stranded)
+        windows.add(fields[0],winStart,winEnd,len(linesA))
+        linesA.append(fields)
+    hitA = [False] * len(linesA)
+    
+    # Stream bedB into the two files
+    inWinFile    = open(inWinPath,'w')
+    notInWinFile = open(notInWinPath,'w')
+    lastIn,lastNotIn = None,None
+    lineNum = 0
+    for line in open(bedB_Path,'rU'):
+        lineNum += 1
+        if isHeaderLine(line):
+            continue
+        line   = line.rstrip('\n')
+        fields = line.split('\t')
+        chrom,start,end = fields[0],int(fields[1]),int(fields[2])
+        if side == 'right':
+            inWin = windows.overlaps(chrom,start,end)
+        else:
+            hits = windows.find(chrom,start,end)
+            for i in hits:
+                hitA[i] = True
+            inWin = bool(hits)
+        
+        if inWin:
+            if (side == 'right') and (len(fields) != cols[1]):
+                raise InvalidFileFormatError('line %s in file %s has unexpected number of columns or the values in "cols" is incorrect.' % \
+                                             (lineNum,bedB_Path))
+            if (side == 'right') and (line != lastIn):
+                inWinFile.write('%s\n' % (line))
+                lastIn = line
+        elif line != lastNotIn:
+            notInWinFile.write('%s\n' % (line))
+            lastNotIn = line
+    
+    if side == 'left':
+        for i,fields in enumerate(linesA):
+            if not hitA[i]:
+                continue
+            if len(fields) != cols[0]:
+                raise InvalidFileFormatError('a bedA feature (%s) in file %s has unexpected number of columns or the values in "cols" is incorrect.' % \
+                                             ('\t'.join(fields[:4]),bedA_Path))
+            inWinFile.write('%s\n' % ('\t'.join(fields)))
+    
+    inWinFile.close()
+    notInWinFile.close()
+    
+    # Return Filenames of divided bed files
+    return (inWinPath,notInWinPath)
+
+
+def _divByWindow_bedtools(bedA_Path,bedB_Path,win,cols,side,outDir):
+    """divByWindow() done with windowBed, sort and onlyInA (the original way)."""
+
+    # Prepare outDir if it doesnt already exist
+    mkdirp(outDir)
+    
+    # Collect some useful info
+    bedA_name           = bedA_Path.split('/')[-1].replace('.bed','')
+    bedB_name           = bedB_Path.split('/')[-1].replace('.bed','')
+    B_in_A_winComboPath = '%s/%s_featsIn_%s_Win%sl%sr_combo.bed' % (outDir,
+                                                                    bedB_name,
+                                                                    bedA_name,
+                                                                    win[0],
+                                                                    win[1])
+    
+    
+    testA = open(bedA_Path,'rU')
+    testA.readline()
+    secondA = testA.readline()
+    testA.close()
     
     # If bedA is stranded: use windowBed with -sw option, otherwise with only -l,-r options
     # to create file from bedB features INSIDE window around features in bedA.
 
-    if isStranded(linesA[1]):
+    if isStranded(secondA):
         resultWinBed = runExternalApp('windowBed',
                                       '-a %s -b %s -l %s -r %s -sw > %s' % \
                                       (bedA_Path,
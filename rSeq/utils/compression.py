@@ -0,0 +1,324 @@
+"""
+####################
+compression.py
+####################
+Compressed-stream layer used by the file parsers and writers.
+
+Reading: ".gz" files are decompressed by a helper process (pigz, or gzip if
+pigz is not in PATH) and read through its stdout pipe.  Inflating can not be
+split up, so pigz gets a single thread unless the caller asks for more.  If neither program is
+available, a helper thread decompresses with the gzip module and hands blocks
+over through a queue so that parsing and inflating overlap.
+
+Writing: BgzfWriter writes block-gzip (BGZF) files as used by samtools/tabix.
+Blocks are deflated in a pool of threads (zlib releases the GIL) and written
+in order.  Writers not given their own thread count share one pool per
+process, so opening many of them does not multiply the threads.  BGZF files are valid multi-member gzip files, so every gzip reader
+(including the ones above) can read them.
+"""
+import os
+import sys
+import gzip
+import zlib
+import struct
+import threading
+import subprocess
+import Queue
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+from rSeq.utils.errors import *
+from rSeq.utils.externals import whereis
+
+# ++++++++ useful constants ++++++++
+BGZF_BLOCK_SIZE = 0xff00 # max uncompressed bytes per block (same as htslib)
+BGZF_EOF = '\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+_bgzfHeader = struct.Struct('<4sIBBHccHH') # magic,mtime,xfl,os,xlen,'B','C',slen,bsize-1
+_bgzfFooter = struct.Struct('<II')         # crc32,isize
+
+
+# ++++++++ helper defs ++++++++
+def _bgzf_block(data,level=6):
+    """Returns data compressed as one complete BGZF block."""
+    deflator = zlib.compressobj(level,zlib.DEFLATED,-15)
+    cData = deflator.compress(data) + deflator.flush()
+    if len(cData) > len(data):
+        # incompressible: store it instead
+        deflator = zlib.compressobj(0,zlib.DEFLATED,-15)
+        cData = deflator.compress(data) + deflator.flush()
+    header = _bgzfHeader.pack('\x1f\x8b\x08\x04',0,0,0xff,6,'B','C',2,len(cData)+25)
+    footer = _bgzfFooter.pack(zlib.crc32(data) & 0xffffffff,len(data))
+    return header + cData + footer
+
+_sharedPool = None
+_sharedPoolPid = None
+_sharedPoolLock = threading.Lock()
+
+def _shared_pool():
+    """Returns this process's deflating ThreadPool (cpus - 1 threads) shared
+    by every BgzfWriter that was not given its own threads or pool."""
+    global _sharedPool,_sharedPoolPid
+    _sharedPoolLock.acquire()
+    try:
+        if _sharedPoolPid != os.getpid():
+            # the threads of a pool made before a fork do not exist in the child
+            _sharedPool = ThreadPool(max(1,cpu_count()-1))
+            _sharedPoolPid = os.getpid()
+        return _sharedPool
+    finally:
+        _sharedPoolLock.release()
+
+
+# ++++++++ classes ++++++++
+class _ProcessReader(object):
+    """File-like reader of the stdout of a decompressing helper process."""
+    def __init__(self,filePath,cmd):
+        self.name = filePath
+        self._cmd = cmd
+        self._proc = subprocess.Popen(cmd,stdout=subprocess.PIPE,bufsize=-1)
+        self._file = self._proc.stdout
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self._file.readline()
+        if not line:
+            self._check()
+            raise StopIteration
+        return line
+
+    def read(self,size=-1):
+        data = self._file.read(size)
+        if not data:
+            self._check()
+        return data
+
+    def readline(self):
+        line = self._file.readline()
+        if not line:
+            self._check()
+        return line
+
+    def _check(self):
+        """Raises SystemCallError if the helper died with an error.
+        Exit status 2 is a warning (ex: trailing garbage ignored) and the
+        data read is complete, so it counts as success."""
+        if self._proc.wait() not in (0,2):
+            raise SystemCallError(self._proc.returncode,'failed to decompress %s' % (self.name),self._cmd[0])
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._file.close()
+        if self._proc.poll() == None:
+            self._proc.terminate() # we stopped reading early
+        self._proc.wait()
+
+
+class _ThreadedGzipReader(object):
+    """File-like gzip reader whose decompression runs in a read-ahead thread."""
+    def __init__(self,filePath,blockSize=1024*1024,queueSize=8):
+        self.name = filePath
+        self._queue = Queue.Queue(queueSize)
+        self._buffer = ''
+        self._done = False
+        self._error = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._inflate,args=(filePath,blockSize))
+        self._thread.daemon = True
+        self._thread.start()
+        self.closed = False
+
+    def _inflate(self,filePath,blockSize):
+        try:
+            gzFile = gzip.open(filePath,'rb')
+            while not self._stop.is_set():
+                block = gzFile.read(blockSize)
+                self._queue.put(block)
+                if not block:
+                    break
+            gzFile.close()
+        except Exception as err:
+            self._error = err
+            self._queue.put('')
+
+    def _fill(self,size):
+        """Pulls blocks off the queue until the buffer holds size bytes
+        (or everything, if size < 0) or the stream is done."""
+        chunks = [self._buffer]
+        have = len(self._buffer)
+        while (not self._done) and ((size < 0) or (have < size)):
+            block = self._queue.get()
+            if not block:
+                self._done = True
+                if self._error:
+                    raise self._error
+                break
+            chunks.append(block)
+            have += len(block)
+        self._buffer = ''.join(chunks)
+
+    def read(self,size=-1):
+        self._fill(size)
+        if size < 0:
+            data,self._buffer = self._buffer,''
+        else:
+            data,self._buffer = self._buffer[:size],self._buffer[size:]
+        return data
+
+    def readline(self):
+        end = self._buffer.find('\n')
+        while (end == -1) and not self._done:
+            self._fill(len(self._buffer)+1)
+            end = self._buffer.find('\n')
+        if end == -1:
+            end = len(self._buffer)
+        else:
+            end += 1
+        line,self._buffer = self._buffer[:end],self._buffer[end:]
+        return line
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._stop.set()
+        # drain so the thread is not left blocking on a full queue
+        while self._thread.is_alive():
+            try:
+                self._queue.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+
+
+class BgzfWriter(object):
+    """File-like writer of BGZF (block gzip) files with multi-threaded compression."""
+    def __init__(self,filePath,threads=None,level=6,blocksPerBatch=64,pool=None):
+        """Returns a BGZF writer.
+        Exmpl: out = BgzfWriter('reads.fastq.gz',threads=4)
+               out.write(fastqTxt)
+               out.close()
+
+        <threads> number of deflating threads of this writer's own pool
+        (default: use the pool shared by this process's writers, cpus - 1).
+        <pool> ThreadPool to deflate in instead (ex: one shared by the writers
+        of a single job); it is left open by close().
+        <level> zlib compression level.
+        <blocksPerBatch> number of 64KB blocks buffered before they are
+        compressed in parallel and written.
+        """
+        self.name = filePath
+        self._file = open(filePath,'wb')
+        self._level = level
+        if pool != None:
+            self._pool = pool
+            self._ownPool = False
+        elif threads:
+            self._pool = ThreadPool(threads)
+            self._ownPool = True
+        else:
+            self._pool = _shared_pool()
+            self._ownPool = False
+        self._batchSize = BGZF_BLOCK_SIZE * blocksPerBatch
+        self._chunks = []
+        self._buffered = 0
+        self.closed = False
+
+    def write(self,data):
+        self._chunks.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self._batchSize:
+            self._flushBlocks(final=False)
+
+    def writelines(self,lines):
+        for line in lines:
+            self.write(line)
+
+    def _flushBlocks(self,final):
+        data = ''.join(self._chunks)
+        cut = len(data)
+        if not final:
+            # hold back the partial last block so that all written blocks are full
+            cut -= cut % BGZF_BLOCK_SIZE
+        blocks = [data[i:i+BGZF_BLOCK_SIZE] for i in xrange(0,cut,BGZF_BLOCK_SIZE)]
+        level = self._level
+        for block in self._pool.imap(lambda x: _bgzf_block(x,level),blocks):
+            self._file.write(block)
+        self._chunks = [data[cut:]]
+        self._buffered = len(data) - cut
+
+    def flush(self):
+        self._flushBlocks(final=True)
+        self._file.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        self._flushBlocks(final=True)
+        self._file.write(BGZF_EOF)
+        self._file.close()
+        if self._ownPool:
+            self._pool.close()
+            self._pool.join()
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+
+# ++++++++ meta functions ++++++++
+def open_gzip_stream(filePath,threads=None):
+    """Returns a file-like reader of the decompressed contents of filePath.
+    Uses pigz (or gzip) in a helper process if found in PATH, otherwise a
+    read-ahead decompression thread.  <threads> is passed to pigz (default: 1)."""
+    pigz = whereis('pigz')
+    if pigz:
+        return _ProcessReader(filePath,[pigz,'-dc','-p',str(threads or 1),filePath])
+    gz = whereis('gzip')
+    if gz:
+        return _ProcessReader(filePath,[gz,'-dc',filePath])
+    return _ThreadedGzipReader(filePath)
+
+def open_stream(filePath,mode='r',compress=None,threads=None,pool=None):
+    """
+    GIVEN:
+    1) filePath: path to open
+    2) mode: 'r' or 'w' ('rU','rb','wb' etc are passed on for uncompressed files)
+    3) compress: write BGZF (True) or plain text (False);
+       None means BGZF only if filePath ends with '.gz'.
+    4) threads: number of helper threads to use for (de)compression
+       (default: 1 for reading; the process-wide shared pool for writing)
+    5) pool: ThreadPool to deflate BGZF blocks in (see BgzfWriter)
+
+    DO:
+    1) open filePath with the fastest (de)compressing stream available
+
+    RETURN:
+    1) file-like obj
+    """
+    if mode.startswith('r'):
+        if filePath.endswith('.gz'):
+            return open_gzip_stream(filePath,threads=threads)
+        return open(filePath,mode)
+    elif mode.startswith('w'):
+        if compress == None:
+            compress = filePath.endswith('.gz')
+        if compress:
+            return BgzfWriter(filePath,threads=threads,pool=pool)
+        return open(filePath,mode)
+    raise InvalidOptionError(mode,'mode',['r','w'])
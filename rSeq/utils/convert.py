@@ -1,10 +1,17 @@
-import sys, pdb
-
+import os, sys, pdb
+import re
+import shutil
+import tempfile
+import itertools
+import collections
+import multiprocessing
+
+import numpy as np
 import pysam
 
 from rSeq.utils.errors import *
 from rSeq.utils.files import tableFile2namedTuple
-from rSeq.utils.align import parseCigarString
+from rSeq.utils.align import CigarBatch,blocks2BEDline
 
 # import pp if avail
 try:
@@ -15,7 +22,121 @@ except ImportError:
 
 
 
-def bam2bed(bamPath,bedFile,region=None,ncpus="autodetect"):
+# ++++++++ useful constants ++++++++
+BED_BUFFER_SIZE = 4*1024*1024 # bytes buffered per bed writer
+BED_SHARD_SIZE  = 10000000    # bp of ref per bam2bed_sharded() shard
+
+_shardBam = None # pysam.Samfile opened by each bam2bed_sharded() worker
+
+
+# ++++++++ helper defs ++++++++
+def _collapse_reads(reads):
+    """Yields (read,count) for the first read of every distinct alignment
+    (same ref, pos, strand and ref-consuming cigar ops) in pos sorted <reads>."""
+    refOps = (0,2,3,7,8) # M,D,N,=,X
+    for pos,group in itertools.groupby(reads,key=lambda read: (read.rname,read.pos)):
+        seen = collections.OrderedDict()
+        for read in group:
+            key = (read.is_reverse,tuple([x for x in read.cigar if x[0] in refOps]))
+            if key in seen:
+                seen[key][1] += 1
+            else:
+                seen[key] = [read,1]
+        for read,count in seen.itervalues():
+            yield read,count
+
+def _bed_lines(samfile,batch,bed12=False):
+    """Returns the BED6 (or BED12) lines of a list of (read,score) tuples as one str.
+    The cigars of the whole batch are turned into ref spans/blocks at once."""
+    cigars = CigarBatch.from_tuples([read.cigar or [] for read,score in batch])
+    starts = np.array([read.pos for read,score in batch],dtype=np.int64)
+    lines  = []
+    if bed12:
+        # N (intron) splits blocks; D stays inside its block
+        blkStarts,blkEnds,blkOffsets = cigars.blocks(starts,refOps='MDN=X',blockOps='MD=X')
+        blkStarts,blkEnds,blkOffsets = blkStarts.tolist(),blkEnds.tolist(),blkOffsets.tolist()
+        for i,(read,score) in enumerate(batch):
+            first,last = blkOffsets[i],blkOffsets[i+1]
+            end = blkEnds[last-1] if last > first else read.pos
+            lines.append(blocks2BEDline(samfile.getrname(read.rname),read.pos,end,read.qname,score,
+                                        "-" if read.is_reverse else "+",
+                                        blkStarts[first:last],blkEnds[first:last]))
+    else:
+        ends = (starts + cigars.ref_lengths(refOps='MDN=X')).tolist()
+        for i,(read,score) in enumerate(batch):
+            lines.append("%s\t%d\t%d\t%s\t%d\t%c\n" %\
+                         (samfile.getrname(read.rname),
+                          read.pos, ends[i], read.qname,
+                          score, "-" if read.is_reverse else "+"))
+    return ''.join(lines)
+
+def _reads2bed(samfile,reads,outFile,minPos=None,linesPerWrite=10000,bed12=False,collapse=False):
+    """Writes a BED line for every mapped read in <reads> to outFile, a few
+    thousand lines per write() call.  Reads starting before minPos are skipped.
+    The score column holds the mapq, or with <collapse> the number of reads
+    sharing the line's alignment (only the first of them is written).
+    Returns the number of lines written."""
+    reads = (read for read in reads
+             if (not read.is_unmapped) and ((minPos == None) or (read.pos >= minPos)))
+    if collapse:
+        scored = _collapse_reads(reads)
+    else:
+        scored = ((read,read.mapq) for read in reads)
+    count = 0
+    while True:
+        batch = list(itertools.islice(scored,linesPerWrite))
+        if not batch:
+            break
+        outFile.write(_bed_lines(samfile,batch,bed12))
+        count += len(batch)
+    return count
+
+def _parse_region(region,refLengths):
+    """Returns (ref,start,end) of samtools region str (1-based, inclusive) as 0-based half-open coords."""
+    m = re.match(r'^([^:]+)(?::([\d,]+)(?:-([\d,]+))?)?$',region)
+    if (not m) or (m.group(1) not in refLengths):
+        raise InvalidOptionError(region,'region','"ref", "ref:start" or "ref:start-end" with ref in the BAM header')
+    ref,start,end = m.groups()
+    start = int(start.replace(',','')) - 1 if start else 0
+    end   = int(end.replace(',','')) if end else refLengths[ref]
+    return ref,max(start,0),min(end,refLengths[ref])
+
+def _bam_shards(references,lengths,regions=None,shardSize=BED_SHARD_SIZE):
+    """Returns list of (ref,start,end,minPos) shards in BAM header order.
+    minPos is None for the first shard of each region so that it also gets
+    the reads that start before the region (as samtools does) and the shard
+    start for the others so each read is reported by one shard only."""
+    refLengths = dict(zip(references,lengths))
+    if regions:
+        spans = [_parse_region(r,refLengths) for r in regions]
+    else:
+        spans = [(ref,0,length) for ref,length in zip(references,lengths)]
+    shards = []
+    for ref,start,end in spans:
+        for shardStart in xrange(start,max(end,start+1),shardSize):
+            shards.append((ref,shardStart,min(shardStart+shardSize,end),
+                           None if shardStart == start else shardStart))
+    return shards
+
+def _init_bam2bed_worker(bamPath):
+    global _shardBam
+    _shardBam = pysam.Samfile(bamPath,"rb")
+
+def _bam2bed_shard(args):
+    """Writes the reads of one shard to a temp bed file; returns (tmpPath,count)."""
+    ref,start,end,minPos,tmpDir,bed12,collapse = args
+    fd,tmpPath = tempfile.mkstemp(suffix='.bed',dir=tmpDir)
+    outFile = os.fdopen(fd,'w',BED_BUFFER_SIZE)
+    try:
+        count = _reads2bed(_shardBam,_shardBam.fetch(ref,start,end),outFile,minPos=minPos,
+                           bed12=bed12,collapse=collapse)
+    finally:
+        outFile.close()
+    return tmpPath,count
+
+
+# ++++++++ meta functions ++++++++
+def bam2bed(bamPath,bedFile,region=None,ncpus="autodetect",bed12=False,collapse=False):
     """Opens bamPath with pysam to access its contents then converts
     each read's info to bed format and writes to bedFile.
 
@@ -23,6 +144,8 @@ def bam2bed(bamPath,bedFile,region=None,ncpus="autodetect"):
     bedFile: an open file obj or stdOut obj or a list of open file objs
     region:  samtools region string or list of region strings
     ncpus: num of processors to use if parallel job is run (autodetect -> all avail)
+    bed12: write BED12 lines with one block per spliced (N separated) part of a read
+    collapse: write one line per distinct alignment with its read count as score
 
     If list is given for bamPath only, all BAMs are written to the same
     bedFile
@@ -38,10 +161,12 @@ def bam2bed(bamPath,bedFile,region=None,ncpus="autodetect"):
     modified from http://sourceforge.net/apps/mediawiki/samtools/index.php?title=SAM_protocol#Python_APIs_.28Pysam.29
     """
     #pdb.set_trace()
-    def convertBAM(bamPath,bedFile,region=None):
-        # Check to see if the file is closed if so, open it for appending
-        #pdb.set_trace()
-        bedFile = open(bedFile,'a')
+    def convertBAM(bamPath,bedFile,region=None,bed12=False,collapse=False):
+        # imported here so that pp workers can find it
+        from rSeq.utils.convert import _reads2bed
+        # open for appending, unbuffered: other jobs may append to the same file
+        # so _reads2bed's whole-line chunks must each go out as one write
+        bedFile = open(bedFile,'a',0)
         # Report convertion files:
         print "Converting %s to %s..." % (bamPath,bedFile.name) 
         # open BAM and get the iterator
@@ -50,24 +175,8 @@ def bam2bed(bamPath,bedFile,region=None,ncpus="autodetect"):
             it = samfile.fetch(region=region)
         else:
             it = samfile.fetch()
-
-        # calculate the end position and print out BED
-        take = (0, 2, 3) # CIGAR operation (M/match, D/del, N/ref_skip)
-        outfile = bedFile
-        for read in it:
-            if read.is_unmapped: continue
-            # compute total length on reference
-            t = sum([l for op,l in read.cigar if op in take])
-            if read.is_reverse: strand = "-"
-            else: strand = "+"
-            outfile.write("%s\t%d\t%d\t%s\t%d\t%c\n" %\
-                          (samfile.getrname(read.rname),
-                           read.pos, read.pos+t, read.qname,
-                           read.mapq, strand))
-            if outfile.name != "<stdout>":
-                outfile.flush()
-            else:
-                outfile.close()
+        _reads2bed(samfile,it,bedFile,bed12=bed12,collapse=collapse)
+        bedFile.close()
 
     # # Do some validation and set up # #
 
@@ -121,7 +230,7 @@ def bam2bed(bamPath,bedFile,region=None,ncpus="autodetect"):
         #pdb.set_trace()
         for i in range(len(bamPath)):
             jobs.append(job_server.submit(func=convertBAM,
-                                          args=(bamPath[i],bedFile[i],region[i]),
+                                          args=(bamPath[i],bedFile[i],region[i],bed12,collapse),
                                           depfuncs=(),
                                           modules=('pysam','pdb'),
                                           callback=None,
@@ -135,11 +244,78 @@ def bam2bed(bamPath,bedFile,region=None,ncpus="autodetect"):
 
     except NameError as err:
         # if no pp: run sequencially
-        if err[0] == "name 'pp' is not defined":
+        if "name 'pp' is not defined" in str(err):
             print "Alert: pp module not found, not running parallel."
             for i in range(len(bamPath)):
-                convertBAM(bamPath[i],bedFile[i],region[i])
+                convertBAM(bamPath[i],bedFile[i],region[i],bed12,collapse)
+        else:
+            raise
+
+
+
+def bam2bed_sharded(bamPath,bedPath=None,regions=None,procs=None,shardSize=BED_SHARD_SIZE,tmpDir=None,
+                    bed12=False,collapse=False):
+    """
+    GIVEN:
+    1) bamPath: path to an indexed (samtools index) BAM
+    2) bedPath: path to write the BED6 lines to (default: sys.stdout)
+    3) regions: list of samtools region strings (default: every ref)
+    4) procs: number of worker processes (default: all cpus)
+    5) shardSize: bp of ref converted per task
+    6) tmpDir: where shard outputs are kept until merged (default: next to bedPath)
+    7) bed12: write BED12 lines with one block per spliced (N separated) part of a read
+    8) collapse: write one line per distinct alignment with its read count as score
+
+    DO:
+    1) cut the refs (or regions) into shards and convert them in a process
+       pool; every worker opens the BAM once and fetches its shards through
+       the index, writing to a buffered temp file
+    2) concatenate the shard files in ref/coord order into bedPath as they finish
 
+    RETURN:
+    1) number of bed lines written
+    """
+    if not os.path.exists(bamPath + '.bai'):
+        raise MissingArgumentError("bam2bed_sharded: %s must be indexed first (samtools index %s)." % (bamPath,bamPath))
+    samfile = pysam.Samfile(bamPath,"rb")
+    shards  = _bam_shards(samfile.references,samfile.lengths,regions,shardSize)
+    samfile.close()
+
+    if bedPath:
+        bedFile = open(bedPath,'w',BED_BUFFER_SIZE)
+        tmpDir  = tmpDir or os.path.dirname(os.path.abspath(bedPath))
+    else:
+        bedFile = sys.stdout
+    tmpDir = tempfile.mkdtemp(prefix='bam2bed.',dir=tmpDir)
+    tasks  = [shard + (tmpDir,bed12,collapse) for shard in shards]
+
+    procs = procs or multiprocessing.cpu_count()
+    if procs > 1:
+        pool    = multiprocessing.Pool(procs,initializer=_init_bam2bed_worker,initargs=(bamPath,))
+        results = pool.imap(_bam2bed_shard,tasks)
+    else:
+        pool    = None
+        _init_bam2bed_worker(bamPath)
+        results = itertools.imap(_bam2bed_shard,tasks)
+
+    total = 0
+    try:
+        for tmpPath,count in results:
+            shardFile = open(tmpPath,'rb')
+            shutil.copyfileobj(shardFile,bedFile,BED_BUFFER_SIZE)
+            shardFile.close()
+            os.remove(tmpPath)
+            total += count
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+        shutil.rmtree(tmpDir,ignore_errors=True)
+        if bedPath:
+            bedFile.close()
+        else:
+            bedFile.flush()
+    return total
 
 
 def genephred2refflat(genePhredPath,refFlatPath):
@@ -222,88 +398,47 @@ def vectorBaseESTs_2_gff3(resultTablePath,gff3Path):
     
     1) Full path of gffPath.
     """
-    # helper defs
-    def match(current_loc,value):
-        """
-        """      
-        left  = current_loc + 1
-        right = left + value - 1
-        
-        current_loc = right 
-        
-        return (current_loc,left,right)
-    
-    def insertion(current_loc,value):
-        """
-        """
-        left  = current_loc + 1
-        right = left + value - 1
-        current_loc = right 
-        
-        return (current_loc, None, None)
-        
-    def deletion(current_loc,value):
-        """
-        """
-        current_loc = current_loc
-        
-        return (current_loc, None, None)
-    
-    cigar_operations = {'I':insertion,
-                        'M':match,
-                        'D':deletion}
     strandConvertions = {'1':'+',
                          '-1':'-'}
     
     gff3_lines = []
     
-    est_table = tableFile2namedTuple(resultTablePath,sep=',')
+    est_table = list(tableFile2namedTuple(resultTablePath,sep=','))
     
-    for align_feat in est_table:
-        cig_tupl = parseCigarString(align_feat.cigar_line,kind='EBI')
-        #cig_tupl = parseCigarString("5M3D6M2I3M",kind='EBI')
-        align_feat_lines = []
-        
-        far_left  = int(align_feat.seq_region_start)
-        far_right = int(align_feat.seq_region_end)
-        #far_left  = 1
-        #far_right = 16        
-        
-        current_loc = far_left - 1 
-        
-        for op,value in cig_tupl:
-            current_loc, left, right = cigar_operations[op.upper()](current_loc,int(value))
-            if left != None:
-                #pass
-                # Construct the gff line for the match feature and append it to gff_lines
-                gff3_seqid = align_feat.chr
-                gff3_source = 'Exonerate'
-                gff3_type = 'EST_match'
-                gff3_start = left
-                gff3_end = right
-                gff3_score = align_feat.score
-                gff3_strand = strandConvertions[align_feat.seq_region_strand]
-                gff3_phase = '.'
-                gff3_attributes = 'ID=%s;Alias=%s' % (align_feat.dna_align_feature_id, align_feat.hit_name)
-                
-                align_feat_lines.append([gff3_seqid,
-                                         gff3_source,
-                                         gff3_type,
-                                         gff3_start,
-                                         gff3_end,
-                                         gff3_score,
-                                         gff3_strand,
-                                         gff3_phase,
-                                         gff3_attributes])
-            else:
-                pass
+    # parse every cigar_line at once: 'M' blocks are the matches, 'I' moves
+    # along the chrom between them and 'D' does not touch chrom coords.
+    # (ops may be lowercase in these tables)
+    cigars    = CigarBatch.from_strs([x.cigar_line.upper() for x in est_table],kind='EBI')
+    far_lefts = np.array([int(x.seq_region_start) for x in est_table],dtype=np.int64)
+    blkStarts,blkEnds,blkOffsets = cigars.blocks(far_lefts - 1,refOps='MI',blockOps='M',merge=False)
+    
+    # sanity check for each align_feat: does the final location == far_right?
+    far_rights = np.array([int(x.seq_region_end) for x in est_table],dtype=np.int64)
+    if (far_lefts - 1 + cigars.ref_lengths(refOps='MI') != far_rights).any():
+        raise SanityCheckError()
+    
+    for i,align_feat in enumerate(est_table):
+        for left,right in zip(blkStarts[blkOffsets[i]:blkOffsets[i+1]],blkEnds[blkOffsets[i]:blkOffsets[i+1]]):
+            # Construct the gff line for the match feature and append it to gff_lines
+            gff3_seqid = align_feat.chr
+            gff3_source = 'Exonerate'
+            gff3_type = 'EST_match'
+            gff3_start = left + 1
+            gff3_end = right
+            gff3_score = align_feat.score
+            gff3_strand = strandConvertions[align_feat.seq_region_strand]
+            gff3_phase = '.'
+            gff3_attributes = 'ID=%s;Alias=%s' % (align_feat.dna_align_feature_id, align_feat.hit_name)
             
-        # sanity check after each align_feat: does the final location == far_right?
-        if not current_loc == far_right:
-            raise SanityCheckError()
-        #else:
-            #raise Exception('YAY!')
-        gff3_lines.extend(align_feat_lines)
+            gff3_lines.append([gff3_seqid,
+                               gff3_source,
+                               gff3_type,
+                               gff3_start,
+                               gff3_end,
+                               gff3_score,
+                               gff3_strand,
+                               gff3_phase,
+                               gff3_attributes])
         
     # Add sort code here if needed
     #  ---- sort code here ----
@@ -313,4 +448,4 @@ def vectorBaseESTs_2_gff3(resultTablePath,gff3Path):
         gff3out.write('%s\n' % ('\t'.join([str(x) for x in line])))
         
     gff3out.close()
-    
\ No newline at end of file
+    return gff3Path
@@ -0,0 +1,392 @@
+"""
+####################
+counting.py
+####################
+Native multi-sample read counting with htseq-count semantics.
+
+The features are loaded once from a FeatureIndex and cut into disjoint
+"steps": stretches of a chrom (and strand, when stranded) covered by the same
+set of feature ids, as in HTSeq's GenomicArrayOfSets.  The sets are interned
+as small ints with cached unions/intersections (featureSets.FeatureSetTable),
+so a read is assigned with a few int lookups.  Each BAM is then counted in
+its own worker process with pysam and the per-sample counts come back as the columns of one
+feature x sample table, so no per-sample tables need to be merged.  An
+indexed BAM can also be split into one task per reference sequence; mates
+are paired within each task and only the pairs split across references are
+paired by the parent.
+
+Reads are assigned exactly like htseq-count does: only the 'M' blocks of a
+read count, mates are paired and the second mate's strand is inverted, and
+the union, intersection-strict and intersection-nonempty modes give the same
+no_feature/ambiguous calls.
+"""
+import os
+import sys
+import bisect
+import collections
+import itertools
+import multiprocessing
+
+import numpy as np
+import pysam
+
+from rSeq.utils.errors import *
+from rSeq.utils.misc import Bag
+from rSeq.utils.featureIndex import FeatureIndex,STRAND_CODES
+from rSeq.utils.featureSets import FeatureSetTable,OVERLAP_MODES
+
+# ++++++++ useful constants ++++++++
+STRANDED_CHOICES = ['yes','no','reverse']
+SPECIAL_FEATURES = ('no_feature',
+                    'ambiguous',
+                    'too_low_aQual',
+                    'not_aligned',
+                    'alignment_not_unique')
+Alignment = collections.namedtuple('Alignment','qname is_paired is_read1 tid pos mrnm mpos is_unmapped nh mapq ivs')
+_refAdvancingOps = set([0,2,3,7,8]) # M,D,N,=,X
+_countSteps = None
+_countOpts  = None
+
+
+# ++++++++ helper defs ++++++++
+def _nh(read):
+    try:
+        return read.opt('NH')
+    except KeyError:
+        return 1
+
+def match_blocks(read):
+    """Returns list of (start,end) ref coords of the 'M' ops of a pysam read."""
+    blocks = []
+    pos = read.pos
+    for op,length in read.cigar:
+        if op == 0:
+            blocks.append((pos,pos+length))
+        if op in _refAdvancingOps:
+            pos += length
+    return blocks
+
+def pair_reads(reads,leftovers=None):
+    """Yields (first,second) mates of paired reads in any order; a read whose
+    mate never shows up is yielded as (read,None) or (None,read) once all
+    reads are seen, or appended to the list <leftovers> if one is given.
+    Unpaired reads are yielded as (read,None)."""
+    waiting = {}
+    for read in reads:
+        if not read.is_paired:
+            yield read,None
+            continue
+        mateKey = (read.qname,not read.is_read1,read.mrnm,read.mpos,read.tid,read.pos)
+        mate = waiting.pop(mateKey,None)
+        if mate is None:
+            waiting[(read.qname,read.is_read1,read.tid,read.pos,read.mrnm,read.mpos)] = read
+        elif read.is_read1:
+            yield read,mate
+        else:
+            yield mate,read
+    if leftovers is not None:
+        leftovers.extend(waiting.itervalues())
+        return
+    for read in waiting.itervalues():
+        if read.is_read1:
+            yield read,None
+        else:
+            yield None,read
+
+def summarize_read(samfile,read,stranded):
+    """Returns a picklable Alignment of a pysam read holding its 'M' blocks as
+    (chrom,strand,start,end) ivs; the strand of a second mate is inverted (that
+    of a first/unpaired read with stranded='reverse')."""
+    ivs = ()
+    if not read.is_unmapped:
+        invert = (stranded == 'reverse') != (read.is_paired and not read.is_read1)
+        chrom  = samfile.getrname(read.tid)
+        strand = '-' if (read.is_reverse != invert) else '+'
+        ivs    = [(chrom,strand,start,end) for start,end in match_blocks(read)]
+    return Alignment(read.qname,read.is_paired,read.is_read1,read.tid,read.pos,read.mrnm,read.mpos,
+                     read.is_unmapped,_nh(read),read.mapq,ivs)
+
+def _end_of_ref(samfile,ref,length):
+    """Returns the file offset just past the last read placed on ref of an
+    indexed BAM, or None if ref has no reads.  The pos of that read is found by
+    bisection: each probe fetches from a pos until one read starting there or
+    later shows up, so only a few reads are read per probe."""
+    def startsFrom(pos):
+        for read in samfile.fetch(ref,pos,length):
+            if read.pos >= pos:
+                return True
+        return False
+    if (length < 1) or not startsFrom(0):
+        return None
+    lo,hi = 0,length  # a read starts at >= lo, none at >= hi
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if startsFrom(mid):
+            lo = mid
+        else:
+            hi = mid
+    # the reads starting at lo come last among those overlapping it
+    for read in samfile.fetch(ref,lo,length):
+        offset = samfile.tell()
+    return offset
+
+def unplaced_reads(samfile):
+    """Returns iterator of the reads without coordinates of an indexed BAM
+    (stored after every placed read).  Instead of reading the file from the
+    top, reading resumes just past the last read of the last reference that
+    has any (see _end_of_ref()).  samfile must not have been read from yet."""
+    offset = samfile.tell() # the first read: all of them are unplaced if no ref has any
+    for tid in reversed(xrange(len(samfile.references))):
+        refEnd = _end_of_ref(samfile,samfile.references[tid],samfile.lengths[tid])
+        if refEnd is not None:
+            offset = refEnd
+            break
+    samfile.seek(offset)
+    return itertools.ifilter(lambda r: r.tid < 0,samfile.fetch(until_eof=True))
+
+def _open_alignments(path):
+    if path.endswith('.sam'):
+        return pysam.Samfile(path,'r')
+    return pysam.Samfile(path,'rb')
+
+
+# ++++++++ classes ++++++++
+class FeatureSteps(object):
+    """Disjoint steps of the features of a FeatureIndex, each holding the id
+    (in self.table, a FeatureSetTable) of the set of features covering it."""
+    def __init__(self,fIndex,stranded=True):
+        """
+        fIndex   : FeatureIndex of the features to count
+        stranded : keep the steps of each strand apart
+        """
+        self.names    = fIndex.names
+        self.stranded = stranded
+        self.chroms   = set(fIndex.chroms)
+        self.table    = FeatureSetTable()
+        self._steps   = {}
+        for chrom in fIndex.chroms:
+            first,last = fIndex.span(chrom)
+            recs = fIndex.recs[first:last]
+            if not stranded:
+                self._steps[(chrom,0)] = self._buildSteps(recs)
+                continue
+            if (recs['strand'] == 0).any():
+                rec = fIndex.feature(first + np.flatnonzero(recs['strand'] == 0)[0])
+                raise InvalidFileFormatError("Feature %s at %s:%s-%s does not have strand information; count it unstranded." % \
+                                             (rec.name,rec.chrom,rec.start,rec.end))
+            for strand in ['+','-']:
+                code = STRAND_CODES[strand]
+                self._steps[(chrom,code)] = self._buildSteps(recs[recs['strand'] == code])
+
+    def _buildSteps(self,recs):
+        """Returns (bounds,setIds): setIds[k] covers [bounds[k-1],bounds[k]);
+        setIds[0] and setIds[-1] are the empty steps before and after every feature."""
+        bounds = np.unique(np.concatenate((recs['start'],recs['end'])))
+        sets   = [set() for x in xrange(len(bounds)+1)]
+        firsts = np.searchsorted(bounds,recs['start']) + 1
+        lasts  = np.searchsorted(bounds,recs['end']) + 1
+        for first,last,nameId in zip(firsts.tolist(),lasts.tolist(),recs['name'].tolist()):
+            for k in xrange(first,last):
+                sets[k].add(nameId)
+        # intern the sets and drop bounds between steps with the same set
+        stepBounds = []
+        stepIds    = [0]
+        for bound,ids in zip(bounds.tolist(),sets[1:]):
+            setId = self.table.intern(ids)
+            if setId != stepIds[-1]:
+                stepBounds.append(bound)
+                stepIds.append(setId)
+        return stepBounds,stepIds
+
+    def step_ids(self,chrom,strand,start,end):
+        """Returns list of the set ids of the steps overlapping [start,end)."""
+        bounds,setIds = self._steps.get((chrom,STRAND_CODES[strand] if self.stranded else 0),([],[0]))
+        return setIds[bisect.bisect_right(bounds,start):bisect.bisect_left(bounds,end)+1]
+
+    def steps(self,chrom,strand,start,end):
+        """Returns list of the feature id sets of the steps overlapping [start,end)."""
+        return [self.table.sets[x] for x in self.step_ids(chrom,strand,start,end)]
+
+    def assign(self,ivs,mode='union'):
+        """Returns the set id (see self.table) that a read made of <ivs> (list
+        of (chrom,strand,start,end)) is assigned to under <mode>: 0 means
+        no_feature and a set with more than one feature means ambiguous."""
+        if len(ivs) == 1:
+            return self.table.merge(self.step_ids(*ivs[0]),mode)
+        setIds = []
+        for iv in ivs:
+            setIds.extend(self.step_ids(*iv))
+        return self.table.merge(setIds,mode)
+
+
+class _Tally(object):
+    """Counts of one sample (or of one shard of it)."""
+    def __init__(self,steps):
+        self.counts  = [0] * len(steps.names)
+        self.special = dict.fromkeys(SPECIAL_FEATURES,0)
+        self.skipped = 0
+
+    def add(self,steps,opts,first,second):
+        """Assigns the fragment made of the Alignments first and second (either may be None)."""
+        present = [r for r in (first,second) if r is not None]
+        if not [r for r in present if not r.is_unmapped]:
+            self.special['not_aligned'] += 1
+            return
+        if [r for r in present if r.nh > 1]:
+            self.special['alignment_not_unique'] += 1
+            return
+        if [r for r in present if r.mapq < opts.minaqual]:
+            self.special['too_low_aQual'] += 1
+            return
+        ivs = [iv for r in present for iv in r.ivs]
+        if [iv for iv in ivs if iv[0] not in steps.chroms]:
+            self.skipped += 1
+            return
+        setId   = steps.assign(ivs,opts.mode)
+        feature = steps.table.sole[setId]
+        if feature is not None:
+            self.counts[feature] += 1
+        elif setId == 0:
+            self.special['no_feature'] += 1
+        else:
+            self.special['ambiguous'] += 1
+
+    def update(self,other):
+        """Adds the counts of another _Tally of the same features."""
+        self.counts = [x + y for x,y in itertools.izip(self.counts,other.counts)]
+        for row in SPECIAL_FEATURES:
+            self.special[row] += other.special[row]
+        self.skipped += other.skipped
+
+
+# ++++++++ meta functions ++++++++
+def _init_count_worker(steps,opts):
+    global _countSteps,_countOpts
+    _countSteps = steps
+    _countOpts  = opts
+
+def _count_task(task):
+    """Counts the reads of one task: (sampleIdx,bamPath,ref) where ref is a
+    reference name, None for the reads without coordinates or False for the
+    whole file.  Returns (sampleIdx,_Tally,leftovers); leftovers are the
+    Alignments of a shard whose mates are on another reference."""
+    sampleIdx,bamPath,ref = task
+    steps,opts = _countSteps,_countOpts
+    tally   = _Tally(steps)
+    samfile = _open_alignments(bamPath)
+    if ref is False:
+        reads = samfile
+    elif ref is None:
+        reads = unplaced_reads(samfile)
+    else:
+        reads = samfile.fetch(ref)
+    waiting = [] if ref else None
+    stranded = opts.stranded
+    for first,second in pair_reads(itertools.imap(lambda r: summarize_read(samfile,r,stranded),reads),waiting):
+        tally.add(steps,opts,first,second)
+    samfile.close()
+
+    leftovers = []
+    for read in waiting or []:
+        if read.mrnm != read.tid:
+            leftovers.append(read)
+        elif read.is_read1:
+            tally.add(steps,opts,read,None)
+        else:
+            tally.add(steps,opts,None,read)
+    return sampleIdx,tally,leftovers
+
+def _ref_tasks(sampleIdx,bamPath):
+    """Returns one task per reference of an indexed BAM (longest first), plus one
+    for the reads without coordinates if the index does not rule them out (the
+    index of older pysams can not tell; that task then finds none, cheaply)."""
+    if not os.path.exists(bamPath + '.bai'):
+        raise MissingArgumentError("count_features: %s must be indexed to be counted by reference (samtools index %s)." % \
+                                   (bamPath,bamPath))
+    samfile = pysam.Samfile(bamPath,'rb')
+    refs    = sorted(zip(samfile.lengths,samfile.references),reverse=True)
+    tasks   = [(sampleIdx,bamPath,ref) for length,ref in refs]
+    if getattr(samfile,'nocoordinate',1):
+        tasks.append((sampleIdx,bamPath,None))
+    samfile.close()
+    return tasks
+
+def count_features(bamPaths,featurePath,mode='union',stranded='yes',minaqual=0,featureType='exon',
+                   idAttr='gene_id',kind=None,procs=None,byRef=False):
+    """
+    GIVEN:
+    1) bamPaths: list of SAM/BAM files (one sample each)
+    2) featurePath: GTF/GFF or BED file of the features (see FeatureIndex)
+    3) mode: one of OVERLAP_MODES (see htseq-count)
+    4) stranded: 'yes', 'no' or 'reverse'
+    5) minaqual: skip fragments with a mate whose mapq is lower than this
+    6) featureType, idAttr, kind: passed to FeatureIndex
+    7) procs: number of worker processes (default: all cpus)
+    8) byRef: split every (indexed) BAM into one task per reference sequence
+       instead of counting each file in one task
+
+    DO:
+    1) load the feature index once and cut it into FeatureSteps
+    2) count the tasks in a pool of workers.  Mates are paired within each
+       task; with byRef, mates aligned to different references are sent back
+       and paired here before they are counted.
+
+    RETURN:
+    1) Bag with:
+       names   : sorted feature ids
+       counts  : int array (len(names) x len(bamPaths))
+       special : list of (row,[count per sample]) of SPECIAL_FEATURES in order
+       skipped : per sample number of fragments on chroms without features
+    """
+    if mode not in OVERLAP_MODES:
+        raise InvalidOptionError(mode,'mode',OVERLAP_MODES)
+    if stranded not in STRANDED_CHOICES:
+        raise InvalidOptionError(stranded,'stranded',STRANDED_CHOICES)
+    if byRef:
+        tasks = []
+        for i,bamPath in enumerate(bamPaths):
+            tasks.extend(_ref_tasks(i,bamPath))
+    else:
+        tasks = [(i,bamPath,False) for i,bamPath in enumerate(bamPaths)]
+    fIndex = FeatureIndex(featurePath,kind=kind,featureType=featureType,idAttr=idAttr)
+    steps  = FeatureSteps(fIndex,stranded=stranded != 'no')
+    opts   = Bag({'mode':mode,'stranded':stranded,'minaqual':minaqual})
+
+    procs = min(procs or multiprocessing.cpu_count(),len(tasks))
+    if procs > 1:
+        pool    = multiprocessing.Pool(procs,initializer=_init_count_worker,initargs=(steps,opts))
+        results = pool.imap_unordered(_count_task,tasks)
+    else:
+        pool    = None
+        _init_count_worker(steps,opts)
+        results = itertools.imap(_count_task,tasks)
+
+    tallies   = [_Tally(steps) for x in bamPaths]
+    leftovers = [[] for x in bamPaths]
+    try:
+        for sampleIdx,tally,waiting in results:
+            tallies[sampleIdx].update(tally)
+            leftovers[sampleIdx].extend(waiting)
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+    for tally,waiting in zip(tallies,leftovers):
+        for first,second in pair_reads(waiting):
+            tally.add(steps,opts,first,second)
+
+    order  = sorted(xrange(len(steps.names)),key=lambda i: steps.names[i])
+    counts = np.array([t.counts for t in tallies],dtype=np.int64).reshape(len(bamPaths),-1).T
+    return Bag({'names':[steps.names[i] for i in order],
+                'counts':counts[order],
+                'special':[(row,[t.special[row] for t in tallies]) for row in SPECIAL_FEATURES],
+                'skipped':[t.skipped for t in tallies]})
+
+def write_count_table(results,sampleNames,outFile):
+    """Writes the count_features() results as a sam2count_table.py table:
+    a 'feature_id' header line, the sorted features and then the special rows."""
+    outFile.write('feature_id\t%s\n' % ('\t'.join(sampleNames)))
+    for name,row in itertools.izip(results.names,results.counts.tolist()):
+        outFile.write('%s\t%s\n' % (name,'\t'.join([str(x) for x in row])))
+    for name,row in results.special:
+        outFile.write('%s\t%s\n' % (name,'\t'.join([str(x) for x in row])))
@@ -1,7 +1,11 @@
 import subprocess
 import os
 import sys
+import time
+import signal
+import threading
 from rSeq.utils.errors import *
+from rSeq.utils.misc import Bag
 
 # ++++++++ Verifiying/preparing external environment ++++++++
 def whereis(program):
@@ -49,3 +53,138 @@ def runExternalApp(progName,argStr):
     
     # Return result
     return result
+
+class LineSink(object):
+    """Log sink for run_external(): writes each line it is given to <outFile>
+    (default: sys.stdout) behind <prefix>, flushing as it goes."""
+    def __init__(self,prefix='',outFile=None):
+        self.prefix  = prefix
+        self.outFile = outFile
+    
+    def __call__(self,line):
+        outFile = self.outFile or sys.stdout
+        outFile.write('%s%s\n' % (self.prefix,line.rstrip('\n')))
+        outFile.flush()
+
+def _pump(pipe,sink):
+    """Hands pipe's lines to sink (a callable or file-like obj) until EOF."""
+    if callable(sink):
+        write = sink
+    else:
+        write = sink.write
+    for line in iter(pipe.readline,''):
+        write(line)
+    pipe.close()
+
+def _as_stream(sink,mode='a'):
+    """Returns (popenArg,pumpSink,fileToClose) for a run_external() sink."""
+    if sink == None:
+        return None,None,None                         # inherit ours
+    if isinstance(sink,basestring):
+        f = open(sink,mode)
+        return f,None,f                               # child writes the file itself
+    if hasattr(sink,'fileno'):
+        try:
+            sink.flush()
+            sink.fileno()
+            return sink,None,None                     # real file: no copying through python
+        except (IOError,ValueError,AttributeError):
+            pass
+    return subprocess.PIPE,sink,None                  # pumped line by line
+
+def run_external(argsList,stdout=None,stderr=None,timeout=None,cwd=None,env=None,stdin=None):
+    """
+    GIVEN:
+    1) argsList: program and its args as a list (no shell is involved)
+    2) stdout, stderr: where the child's output goes; each can be
+        - None: inherit this process's stream
+        - a path: the file is opened for appending and handed to the child
+        - an open file obj: handed to the child (nothing passes through python)
+        - a callable (ex: LineSink) or obj with .write(): fed one line at a time
+          by a helper thread as the child writes it
+    3) timeout: seconds to wait before the child is killed (None: wait forever);
+       the child is started in its own process group so anything it spawned
+       is killed along with it
+    4) cwd, env, stdin: passed to subprocess.Popen
+    
+    DO:
+    1) run the program without buffering its output in memory
+    2) reap it with os.wait4() to collect its resource usage
+    
+    RETURN:
+    1) Bag(returncode, wallTime, userTime, sysTime, cpuTime, peakRSS (kB), timedOut)
+    
+    Raises SystemCallError if the program is not found, exits non-zero or times out.
+    """
+    progName = argsList[0]
+    if not whereis(progName) and not os.path.isfile(progName):
+        raise SystemCallError(None,'"%s" command not found in your PATH environmental variable.' % (progName))
+    
+    outArg,outPump,outClose = _as_stream(stdout)
+    errArg,errPump,errClose = _as_stream(stderr)
+    
+    startTime = time.time()
+    process = subprocess.Popen([str(x) for x in argsList],
+                               stdin=stdin,
+                               stdout=outArg,
+                               stderr=errArg,
+                               cwd=cwd,
+                               env=env,
+                               preexec_fn=(os.setsid if timeout else None))
+    pumps = []
+    for pipe,sink in [(process.stdout,outPump),(process.stderr,errPump)]:
+        if sink != None:
+            t = threading.Thread(target=_pump,args=(pipe,sink))
+            t.daemon = True
+            t.start()
+            pumps.append(t)
+    
+    # reap with wait4 (not Popen.wait) to get the child's rusage
+    timedOut = False
+    delay = 0.01
+    while 1:
+        pid,status,rusage = os.wait4(process.pid,os.WNOHANG)
+        if pid:
+            break
+        if timeout and (time.time() - startTime > timeout):
+            timedOut = True
+            # kill the whole group: grandchildren would otherwise hold our pipes open
+            try:
+                os.killpg(process.pid,signal.SIGKILL)
+            except OSError:
+                process.kill()
+            pid,status,rusage = os.wait4(process.pid,0)
+            break
+        time.sleep(delay)
+        delay = min(delay*2,0.5)
+    wallTime = time.time() - startTime
+    
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    
+    for t in pumps:
+        if timedOut:
+            t.join(5)   # a descendant that left our process group may still hold the pipe
+        else:
+            t.join()
+    for f in [outClose,errClose]:
+        if f:
+            f.close()
+    
+    results = Bag({'returncode':process.returncode,
+                   'wallTime':wallTime,
+                   'userTime':rusage.ru_utime,
+                   'sysTime':rusage.ru_stime,
+                   'cpuTime':rusage.ru_utime + rusage.ru_stime,
+                   'peakRSS':rusage.ru_maxrss,
+                   'timedOut':timedOut})
+    
+    if timedOut:
+        raise SystemCallError(process.returncode,'killed after running longer than %s seconds' % (timeout),progName)
+    if process.returncode != 0:
+        raise SystemCallError(process.returncode,'exited with a non-zero status (see its log output)',progName)
+    
+    return results
+
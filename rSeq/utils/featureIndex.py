@@ -0,0 +1,277 @@
+"""
+####################
+featureIndex.py
+####################
+Persistent, memory-mapped interval index of the features in a BED or GTF/GFF
+file.  It is built once next to the annotation ("<file>.ivx" plus
+"<file>.ivx.json") and loaded by every later run without re-parsing it:
+the feature records are a numpy record array sorted by chrom and start that
+is memory-mapped read-only, so processes using the same annotation share one
+page-cached copy.
+
+Records hold 0-based, half-open coords, strand, a name id and the byte offset
+of the source line.  A running max of the feature ends lets overlap queries
+find their hits with two binary searches and no scan.
+"""
+import os
+import re
+import json
+import tempfile
+
+import numpy as np
+
+from rSeq.utils.errors import *
+from rSeq.utils.misc import Bag
+from rSeq.utils.bed import bedWindow
+
+# ++++++++ useful constants ++++++++
+INDEX_VERSION = 1
+RECORD_DTYPE  = np.dtype([('start','<i8'),
+                          ('end','<i8'),
+                          ('maxEnd','<i8'),   # max end of the chrom's recs up to this one
+                          ('name','<i4'),     # index into FeatureIndex.names
+                          ('strand','i1'),    # 1,-1 or 0 for '.'
+                          ('line','<i8')])    # byte offset of the source line
+STRAND_CODES  = {'+':1,'-':-1,'.':0}
+STRAND_CHARS  = {1:'+',-1:'-',0:'.'}
+_kindsByExt   = {'.bed':'bed','.gtf':'gtf','.gff':'gtf','.gff3':'gtf'}
+
+
+# ++++++++ helper defs ++++++++
+def _guess_kind(filePath):
+    ext = os.path.splitext(filePath)[1].lower()
+    if ext not in _kindsByExt:
+        raise InvalidOptionError(filePath,'feature file','a file ending with one of %s (or pass kind=)' % (sorted(_kindsByExt.keys())))
+    return _kindsByExt[ext]
+
+def _attr_regex(idAttr):
+    """Returns regex pulling idAttr's value from GTF ('gene_id "x";') or GFF3 ('ID=x;') attributes."""
+    return re.compile(r'(?:^|;)\s*%s(?:\s+|=)"?([^";]+)"?' % (re.escape(idAttr)))
+
+def _index_meta(kind,featureType,idAttr):
+    return {'version':INDEX_VERSION,'kind':kind,'featureType':featureType,'idAttr':idAttr}
+
+
+# ++++++++ meta functions ++++++++
+def build_feature_index(filePath,indexPath=None,kind=None,featureType='exon',idAttr='gene_id'):
+    """
+    GIVEN:
+    1) filePath: BED or GTF/GFF file
+    2) indexPath: where to write the index (default: filePath + '.ivx');
+       indexPath + '.json' gets the chrom and feature names
+    3) kind: 'bed' or 'gtf' (default: from filePath's extension)
+    4) featureType: GTF only, 3rd column value of the features to index
+    5) idAttr: GTF only, attribute holding the feature's name (ex: gene_id, ID)
+
+    DO:
+    1) read filePath once collecting every feature (BED name: 4th column or
+       'chrom:start-end'); GTF coords are converted to 0-based half-open
+    2) sort them by chrom and start, record each chrom's running max end
+    3) write the records with np.save (so they can be mmap'd) and the names
+       as json, both via temp files that are renamed into place
+
+    RETURN:
+    1) indexPath
+    """
+    if not indexPath:
+        indexPath = filePath + '.ivx'
+    kind = kind or _guess_kind(filePath)
+    if kind not in ['bed','gtf']:
+        raise InvalidOptionError(kind,'kind',['bed','gtf'])
+    attrRegex = _attr_regex(idAttr)
+
+    byChrom  = {}   # chrom: list of (start,end,nameId,strand,lineOffset)
+    chroms   = []
+    names    = []
+    nameIds  = {}
+    inFile   = open(filePath,'rb')
+    offset   = 0
+    lineNum  = 0
+    for line in inFile:
+        lineOffset = offset
+        offset  += len(line)
+        lineNum += 1
+        if line.startswith(('track','browser','#')) or not line.strip():
+            continue
+        fields = line.rstrip('\r\n').split('\t')
+        try:
+            if kind == 'bed':
+                chrom,start,end = fields[0],int(fields[1]),int(fields[2])
+                name   = fields[3] if len(fields) > 3 else '%s:%s-%s' % (chrom,start,end)
+                strand = fields[5] if len(fields) > 5 else '.'
+            else:
+                if fields[2] != featureType:
+                    continue
+                chrom,start,end,strand = fields[0],int(fields[3])-1,int(fields[4]),fields[6]
+                m = attrRegex.search(fields[8])
+                if not m:
+                    raise InvalidFileFormatError("build_feature_index: the %s on line %s of %s does not have a '%s' attribute." % \
+                                                 (featureType,lineNum,filePath,idAttr))
+                name = m.group(1)
+        except (IndexError,ValueError):
+            raise InvalidFileFormatError("build_feature_index: line %s of %s is not valid %s." % (lineNum,filePath,kind))
+        if strand not in STRAND_CODES:
+            strand = '.'
+        if name not in nameIds:
+            nameIds[name] = len(names)
+            names.append(name)
+        if chrom not in byChrom:
+            byChrom[chrom] = []
+            chroms.append(chrom)
+        byChrom[chrom].append((start,end,nameIds[name],STRAND_CODES[strand],lineOffset))
+    inFile.close()
+
+    recs = np.zeros(sum([len(x) for x in byChrom.itervalues()]),dtype=RECORD_DTYPE)
+    chromOffsets = [0]
+    for chrom in chroms:
+        feats = np.array(byChrom.pop(chrom),dtype=np.int64).reshape(-1,5)
+        feats = feats[np.lexsort((feats[:,1],feats[:,0]))]
+        block = recs[chromOffsets[-1]:chromOffsets[-1]+len(feats)]
+        block['start']  = feats[:,0]
+        block['end']    = feats[:,1]
+        block['maxEnd'] = np.maximum.accumulate(feats[:,1])
+        block['name']   = feats[:,2]
+        block['strand'] = feats[:,3]
+        block['line']   = feats[:,4]
+        chromOffsets.append(chromOffsets[-1]+len(feats))
+
+    meta = _index_meta(kind,featureType,idAttr)
+    meta.update({'source':os.path.abspath(filePath),
+                 'chroms':chroms,
+                 'chromOffsets':chromOffsets,
+                 'names':names})
+    indexDir = os.path.dirname(os.path.abspath(indexPath))
+    tmpFd,tmpPath = tempfile.mkstemp(dir=indexDir,suffix='.tmp')
+    tmpFile = os.fdopen(tmpFd,'wb')
+    np.save(tmpFile,recs)
+    tmpFile.close()
+    os.rename(tmpPath,indexPath)
+    tmpFd,tmpPath = tempfile.mkstemp(dir=indexDir,suffix='.tmp')
+    tmpFile = os.fdopen(tmpFd,'w')
+    json.dump(meta,tmpFile)
+    tmpFile.close()
+    os.rename(tmpPath,indexPath + '.json')
+    return indexPath
+
+
+# ++++++++ classes ++++++++
+class FeatureIndex(object):
+    """Memory-mapped overlap/window index of a BED or GTF feature set."""
+    def __init__(self,filePath,indexPath=None,kind=None,featureType='exon',idAttr='gene_id',rebuild=False):
+        """Returns a FeatureIndex of filePath, building its index first if needed.
+        Exmpl: fIndex = FeatureIndex('AaegL1.2.gtf')
+               fIndex.names_of(fIndex.overlap('supercont1.1',1000,3000,'+'))
+
+        <indexPath> is the index file to use (default: filePath + '.ivx').
+        If it does not exist, is older than filePath, was built with other
+        kind/featureType/idAttr values or <rebuild> is True, it is (re)built
+        with build_feature_index().
+        """
+        if not indexPath:
+            indexPath = filePath + '.ivx'
+        kind = kind or _guess_kind(filePath)
+        self.name      = os.path.abspath(filePath)
+        self.indexPath = indexPath
+
+        wanted = _index_meta(kind,featureType,idAttr)
+        stale  = (not os.path.exists(indexPath)) or (not os.path.exists(indexPath + '.json')) or \
+                 (os.path.getmtime(indexPath) < os.path.getmtime(filePath))
+        if not (rebuild or stale):
+            meta  = json.load(open(indexPath + '.json'))
+            stale = [k for k,v in wanted.iteritems() if meta.get(k) != v]
+        if rebuild or stale:
+            build_feature_index(filePath,indexPath,kind=kind,featureType=featureType,idAttr=idAttr)
+            meta = json.load(open(indexPath + '.json'))
+
+        self.kind         = kind
+        self.chroms       = [str(x) for x in meta['chroms']]
+        self.names        = [str(x) for x in meta['names']]
+        self.chromOffsets = meta['chromOffsets']
+        self._chromIdx    = dict([(c,i) for i,c in enumerate(self.chroms)])
+        self._openRecs()
+
+    def _openRecs(self):
+        if self.chromOffsets[-1]:
+            self.recs = np.load(self.indexPath,mmap_mode='r')
+        else:
+            self.recs = np.zeros(0,dtype=RECORD_DTYPE) # can not mmap an empty array
+        if (self.recs.dtype != RECORD_DTYPE) or (len(self.recs) != self.chromOffsets[-1]):
+            raise SanityCheckError("FeatureIndex: %s does not agree with %s.json; delete them and try again." % \
+                                   (self.indexPath,self.indexPath))
+
+    def __getstate__(self):
+        """memmaps are not pickled: workers re-map the index file on arrival."""
+        state = self.__dict__.copy()
+        del state['recs']
+        return state
+
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+        self._openRecs()
+
+    def __len__(self):
+        return len(self.recs)
+
+    def __contains__(self,chrom):
+        return chrom in self._chromIdx
+
+    def span(self,chrom):
+        """Returns (first,last) rec indexes (half-open) of chrom's features."""
+        i = self._chromIdx.get(chrom)
+        if i == None:
+            return 0,0
+        return self.chromOffsets[i],self.chromOffsets[i+1]
+
+    def overlap(self,chrom,start,end,strand=None):
+        """Returns int array of the rec indexes (in start order) of the features
+        overlapping [start,end) on chrom; only those on <strand> if it is given."""
+        first,last = self.span(chrom)
+        recs = self.recs[first:last]
+        # recs[:right] start before end; recs[left:] may still reach past start
+        right = np.searchsorted(recs['start'],end,side='left')
+        left  = np.searchsorted(recs['maxEnd'][:right],start,side='right')
+        hits  = np.flatnonzero(recs['end'][left:right] > start) + left
+        if strand not in [None,'.']:
+            hits = hits[recs['strand'][hits] == STRAND_CODES[strand]]
+        return hits + first
+
+    def window(self,chrom,start,end,win,strand='+',stranded=True,sameStrand=False):
+        """Returns int array of the rec indexes of the features within the window
+        win[0] upstrm and win[1] dwnstrm of [start,end) (see bed.bedWindow()).
+        With <sameStrand> only features on <strand> are returned."""
+        winStart,winEnd = bedWindow(start,end,strand,win,stranded)
+        return self.overlap(chrom,winStart,winEnd,strand if sameStrand else None)
+
+    def names_of(self,recIdxs):
+        """Returns list of the feature names of recIdxs."""
+        return [self.names[i] for i in self.recs['name'][recIdxs]]
+
+    def chrom_of(self,recIdx):
+        return self.chroms[np.searchsorted(self.chromOffsets,recIdx,side='right')-1]
+
+    def feature(self,recIdx):
+        """Returns Bag(chrom,start,end,strand,name) of one rec."""
+        rec = self.recs[recIdx]
+        return Bag({'chrom':self.chrom_of(recIdx),
+                    'start':int(rec['start']),
+                    'end':int(rec['end']),
+                    'strand':STRAND_CHARS[int(rec['strand'])],
+                    'name':self.names[rec['name']]})
+
+    def iter_features(self):
+        """Yields (chrom,start,end,strand,name) of every feature in chrom/start order."""
+        for i,chrom in enumerate(self.chroms):
+            recs = self.recs[self.chromOffsets[i]:self.chromOffsets[i+1]]
+            for start,end,nameId,strand in zip(recs['start'].tolist(),recs['end'].tolist(),
+                                                recs['name'].tolist(),recs['strand'].tolist()):
+                yield chrom,start,end,STRAND_CHARS[strand],self.names[nameId]
+
+    def source_lines(self,recIdxs):
+        """Returns list of the source file lines (without '\\n') of recIdxs."""
+        lines = []
+        source = open(self.name,'rb')
+        for offset in self.recs['line'][recIdxs].tolist():
+            source.seek(offset)
+            lines.append(source.readline().rstrip('\r\n'))
+        source.close()
+        return lines
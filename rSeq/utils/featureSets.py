@@ -0,0 +1,72 @@
+"""
+####################
+featureSets.py
+####################
+Interned sets of feature ids for htseq-count style read assignment.
+
+Every distinct set of features covering a stretch of the genome gets a
+small int id (0 is the empty set) and the unions/intersections of those ids
+are cached, so a read is assigned to features with a few int lookups.  Kept
+apart from counting.py so that HTSeq-based counting does not need pysam.
+"""
+from rSeq.utils.errors import *
+
+# ++++++++ useful constants ++++++++
+OVERLAP_MODES = ['union','intersection-strict','intersection-nonempty']
+EMPTY_SET     = frozenset()
+
+
+# ++++++++ classes ++++++++
+class FeatureSetTable(object):
+    """Interns sets of feature ids as small ints (0 is the empty set) and
+    caches the unions and intersections of interned sets, so that assigning
+    a read takes a few int lookups instead of building new sets."""
+    def __init__(self):
+        self.sets  = [EMPTY_SET]
+        self.sole  = [None]     # the only member of each set, or None
+        self._ids  = {EMPTY_SET:0}
+        self._unions = {}
+        self._intersections = {}
+
+    def __len__(self):
+        return len(self.sets)
+
+    def intern(self,ids):
+        """Returns the int id of the set of <ids>."""
+        ids = frozenset(ids)
+        setId = self._ids.get(ids)
+        if setId is None:
+            setId = self._ids[ids] = len(self.sets)
+            self.sets.append(ids)
+            self.sole.append(iter(ids).next() if len(ids) == 1 else None)
+        return setId
+
+    def _merge(self,setIds,cache,op,skip):
+        result = setIds[0]
+        for setId in setIds[1:]:
+            if (setId == result) or (setId == skip):
+                continue
+            key = (result,setId) if result < setId else (setId,result)
+            merged = cache.get(key)
+            if merged is None:
+                merged = cache[key] = self.intern(op(self.sets[result],self.sets[setId]))
+            result = merged
+        return result
+
+    def merge(self,setIds,mode='union'):
+        """Returns the id of the set that a read covering steps with the ids
+        <setIds> is assigned to under <mode> (see htseq-count)."""
+        if not setIds:
+            return 0
+        # fast path: the whole read lies in one step (or in steps with the same set)
+        if setIds.count(setIds[0]) == len(setIds):
+            return setIds[0]
+        if mode == 'union':
+            return self._merge(setIds,self._unions,frozenset.union,0)
+        if mode == 'intersection-nonempty':
+            setIds = [x for x in setIds if x] or [0]
+        elif mode != 'intersection-strict':
+            raise InvalidOptionError(mode,'mode',OVERLAP_MODES)
+        if 0 in setIds:
+            return 0
+        return self._merge(setIds,self._intersections,frozenset.intersection,None)
@@ -2,14 +2,25 @@ import os
 import sys
 import csv
 import collections
-import gzip
 import shutil
 import tempfile
+import mmap
+import itertools
+import heapq
+import zlib
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
 
 
 from rSeq.utils.errors import *
-from rSeq.utils.misc import Bag,fold_seq
+from rSeq.utils.misc import Bag,fold_seq,revComp
 from rSeq.utils.externals import runExternalApp
+from rSeq.utils.twoBit import PackedSeq
+from rSeq.utils.compression import open_stream
+from rSeq.utils.readFilter import ReadFilter,compile_read_filter
 
 
 def mv_file_obj(fileObj,newPath='',chmod=False):
@@ -120,8 +131,97 @@ def fastaRec_length_indexer(fastaFiles):
     return (recDict,seqDict)
     
     
+def _expand_fasta_paths(fastaFiles):
+    """Returns list of file paths from a list of fasta files or dirs containing
+    fasta files (subdirs and the index/companion files written here are ignored)."""
+    paths = []
+    for each in fastaFiles:
+        if os.path.isdir(each):
+            for p in sorted(os.listdir(each)):
+                p = os.path.join(each,p)
+                if os.path.isfile(p) and not p.endswith(('.fai','.flat')):
+                    paths.append(p)
+        else:
+            paths.append(each)
+    return paths
+
+
+# ++++ helpers for filter_PEfastQs() ++++
+_peFilterFunc = None
+
+def _init_PEfilter_worker(filterFunc):
+    """Pool initializer: stores filterFunc in the worker (lambdas can not be
+    pickled, but forked workers inherit them through initargs)."""
+    global _peFilterFunc
+    _peFilterFunc = filterFunc
 
-def filter_PEfastQs(filterFunc,fwdMatePath,revMatePath,matchedPassPath1,matchedPassPath2,singlePassPath,nonPassPath):
+def _filter_mask(filterFunc,batch):
+    """Returns bool array: True where filterFunc says to KEEP the rec.
+    ReadFilters test the whole batch at once; other funcs are called per rec."""
+    if isinstance(filterFunc,ReadFilter):
+        return filterFunc.mask(batch)
+    return np.fromiter((bool(filterFunc(rec)) for rec in batch),dtype=bool,count=len(batch))
+
+def _filter_PEchunk(chunk):
+    """Filters one chunk of mate pairs.
+    chunk is ((fwdTxt,fwdFirstLine),(revTxt,revFirstLine)) as from ParseFastQ.next_chunk_str().
+    Returns ((mPassF_txt,mPassR_txt,sPass_txt,nPass_txt),counts dict)."""
+    fwd = FastQBatch.from_str(chunk[0][0],firstLineNumber=chunk[0][1])
+    rev = FastQBatch.from_str(chunk[1][0],firstLineNumber=chunk[1][1])
+    if len(fwd) != len(rev):
+        raise SanityCheckError("filter_PEfastQs: mate files do not contain the same number of reads (near line %s)." % \
+                               (chunk[0][1]))
+    keepFwd = _filter_mask(_peFilterFunc,fwd)
+    keepRev = _filter_mask(_peFilterFunc,rev)
+    
+    both     = keepFwd & keepRev
+    fwdOnly  = keepFwd & ~keepRev
+    revOnly  = ~keepFwd & keepRev
+    # interleave single/failed recs in pair order as the serial writer did
+    fwdLines = (fwd.headers,fwd.seqs,fwd.qualHeaders,fwd.quals)
+    revLines = (rev.headers,rev.seqs,rev.qualHeaders,rev.quals)
+    singles  = FastQBatch(*[list(itertools.chain(*zip(f,r))) for f,r in zip(fwdLines,revLines)])
+    sMask    = np.empty(2*len(fwd),dtype=bool)
+    sMask[0::2] = fwdOnly
+    sMask[1::2] = revOnly
+    
+    texts = (fwd.to_str(both),
+             rev.to_str(both),
+             singles.to_str(sMask),
+             singles.to_str(~np.repeat(both,2) & ~sMask))
+    counts = {'pairs_passed':int(both.sum()),
+              'fwd_passed_as_single':int(fwdOnly.sum()),
+              'rev_passed_as_single':int(revOnly.sum()),
+              'fwd_failed':int((~keepFwd).sum()),
+              'rev_failed':int((~keepRev).sum()),
+              'total':len(fwd) + len(rev)}
+    return texts,counts
+
+def _iter_PEchunks(fwdMates,revMates,chunkSize,throttle=None):
+    """Yields ((fwdTxt,fwdFirstLine),(revTxt,revFirstLine)) chunks of chunkSize mate pairs.
+    Only the raw text is cut here; parsing happens in _filter_PEchunk().
+    If throttle (a semaphore) is given, it is acquired before each chunk is yielded
+    so that reading can not race ahead of writing."""
+    while 1:
+        try:
+            fwd = fwdMates.next_chunk_str(chunkSize)
+        except StopIteration:
+            fwd = None
+        try:
+            rev = revMates.next_chunk_str(chunkSize)
+        except StopIteration:
+            rev = None
+        if (fwd == None) and (rev == None):
+            return
+        if (fwd == None) or (rev == None):
+            raise SanityCheckError("filter_PEfastQs: %s and %s do not contain the same number of reads." % \
+                                   (fwdMates._file.name,revMates._file.name))
+        if throttle:
+            throttle.acquire()
+        yield (fwd,rev)
+
+def filter_PEfastQs(filterFunc,fwdMatePath,revMatePath,matchedPassPath1,matchedPassPath2,singlePassPath,nonPassPath,compress=None,
+                    procs=1,chunkSize=50000):
     """
     Takes the paths to mated PE fastq files with coordinated read-ordering.
     Tests whether paired reads satisfy the provided filterFunc.
@@ -138,6 +238,10 @@ def filter_PEfastQs(filterFunc,fwdMatePath,revMatePath,matchedPassPath1,matchedP
     The filterFunc for this case might be:
     lambda x: x[0].split(' ')[-1].split(':')[1] == "N"
     
+    -OR- much faster, a readFilter expression (str or ReadFilter) that is tested on
+    whole chunks of reads at once:
+    "flag == N and meanqual >= 20"
+    
     If both mates satisfy the filter, the fwd mate is written to matchedPassPath1 and rev mate to matchedPassPath2.
     If only one mate satisfies the filter, it is written to singlePassPath regardles of fwd/rev.
     All reads that do not satisfy the filter are written to nonPassPath.
@@ -146,15 +250,38 @@ def filter_PEfastQs(filterFunc,fwdMatePath,revMatePath,matchedPassPath1,matchedP
     * The filterFunc does not have to be a simple lambda, but even something like "testMeanQualScore()",
       as long as it returns a True/False with True meaning that the read should be KEPT.
     * Write-files are overwritten if they exist, created otherwise.
+    * compress=True writes BGZF compressed output; compress=None does so only
+      for out paths ending in '.gz' (see compression.open_stream()).
+    * The mates are read <chunkSize> pairs at a time.  With procs > 1 the chunks
+      are filtered by a pool of worker processes while this process reads
+      and writes; output order is the same as with procs=1.
+    * <procs> is the whole cpu budget of the call: each gzipped mate file takes
+      one decompressing helper process and, when compressing, the four writers
+      share one pool of procs/4 deflating threads; the filter workers get what
+      is left.  At least one of each is always used, so procs=1 with gzipped
+      input and output still runs a helper per mate and one deflating thread.
     """
     
     
+    if isinstance(filterFunc,basestring):
+        filterFunc = compile_read_filter(filterFunc)
+    
+    # split procs between the (de)compression helpers and the filter workers
+    outPaths = [matchedPassPath1,matchedPassPath2,singlePassPath,nonPassPath]
+    readers  = len([x for x in [fwdMatePath,revMatePath] if x.endswith('.gz')])
+    deflaters   = 0
+    deflatePool = None
+    if compress or ((compress == None) and [x for x in outPaths if x.endswith('.gz')]):
+        deflaters   = max(1,procs // 4)
+        deflatePool = ThreadPool(deflaters)
+    procs = max(1,procs - readers - deflaters)
+    
     fwdMates = ParseFastQ(fwdMatePath)
     revMates = ParseFastQ(revMatePath)
-    mPassF_file = open(matchedPassPath1, 'w')
-    mPassR_file = open(matchedPassPath2, 'w')
-    sPass_file  = open(singlePassPath, 'w')
-    nPass_file  = open(nonPassPath, 'w')
+    mPassF_file = open_stream(matchedPassPath1, 'w', compress=compress, pool=deflatePool)
+    mPassR_file = open_stream(matchedPassPath2, 'w', compress=compress, pool=deflatePool)
+    sPass_file  = open_stream(singlePassPath, 'w', compress=compress, pool=deflatePool)
+    nPass_file  = open_stream(nonPassPath, 'w', compress=compress, pool=deflatePool)
     
     outFiles = [mPassF_file,
                 mPassR_file,
@@ -168,60 +295,38 @@ def filter_PEfastQs(filterFunc,fwdMatePath,revMatePath,matchedPassPath1,matchedP
                   'rev_failed':0,
                   'total':0})
     
-    while 1:
-        # get next fastq Records or set mates to None
-        try:
-            fwdMate = fwdMates.next()
-            counts.total += 1
-        except StopIteration:
-            fwdMate = None
-        
-        try:
-            revMate = revMates.next()
-            counts.total += 1
-        except StopIteration:
-            revMate = None
-        
-        # break out if both files are empty 
-        if (fwdMate == None) and (revMate == None):
-            break
-
-        # set up logical switches to guide the outWriting/counting
-        if fwdMate == None:
-            keepFwd = None
-        else:
-            keepFwd = filterFunc(fwdMate)
-        if revMate == None:
-            keepRev = None
-        else:
-            keepRev = filterFunc(revMate)
-            
-        #print "fwdMate %s\nkeepFwd %s\nrevMate %s\nkeepRev %s" % (fwdMate[0],keepFwd,revMate[0],keepRev)
-        #break
-            
-        # write fwd and rev to appropriate files and += respective counts
-        if keepFwd and keepRev:
-            mPassF_file.write('%s\n' % ('\n'.join(fwdMate)))
-            mPassR_file.write('%s\n' % ('\n'.join(revMate)))
-            counts.pairs_passed += 1
-        if keepFwd and not keepRev:
-            sPass_file.write('%s\n' % ('\n'.join(fwdMate)))
-            nPass_file.write('%s\n' % ('\n'.join(revMate)))
-            counts.fwd_passed_as_single += 1
-            counts.rev_failed += 1
-        if not keepFwd and keepRev:
-            nPass_file.write('%s\n' % ('\n'.join(fwdMate)))
-            sPass_file.write('%s\n' % ('\n'.join(revMate)))
-            counts.fwd_failed += 1
-            counts.rev_passed_as_single += 1
-        if not keepFwd and not keepRev:
-            nPass_file.write('%s\n' % ('\n'.join(fwdMate)))
-            nPass_file.write('%s\n' % ('\n'.join(revMate)))
-            counts.fwd_failed += 1
-            counts.rev_failed += 1
+    if procs > 1:
+        throttle = threading.Semaphore(procs*2)
+        pool     = multiprocessing.Pool(procs,initializer=_init_PEfilter_worker,initargs=(filterFunc,))
+        results  = pool.imap(_filter_PEchunk,_iter_PEchunks(fwdMates,revMates,chunkSize,throttle))
+    else:
+        throttle = None
+        pool     = None
+        _init_PEfilter_worker(filterFunc)
+        results  = itertools.imap(_filter_PEchunk,_iter_PEchunks(fwdMates,revMates,chunkSize))
+    
+    try:
+        for texts,chunkCounts in results:
+            for outFile,txt in zip(outFiles,texts):
+                if txt:
+                    outFile.write(txt)
+            for k,v in chunkCounts.iteritems():
+                counts[k] += v
+            if throttle:
+                throttle.release()
+    finally:
+        if pool:
+            # unblock the chunk reader so the pool's task thread can exit
+            for i in range(procs*2):
+                throttle.release()
+            pool.terminate()
+            pool.join()
     
     for f in outFiles:
         f.close()
+    if deflatePool:
+        deflatePool.close()
+        deflatePool.join()
     
     reportTxt = '''================
 Filtered your files using the supplied filter function:
@@ -241,6 +346,8 @@ nonPassPath:\t\t%s\n----\n''' % (fwdMatePath,revMatePath,matchedPassPath1,matche
                                                                                                                            counts.rev_failed)
     sys.stderr.write("%s\n" % (reportTxt))
     
+    return counts
+    
 
 #def strip_str_of_comments(string,commentStr='#'):
     #"""
@@ -316,7 +423,7 @@ class ParseFastA(object):
         """
         
         if filePath.endswith('.gz'):
-            self._file = gzip.open(filePath)
+            self._file = open_stream(filePath)
         else:
             self._file = open(filePath, 'rU')
             
@@ -385,9 +492,12 @@ class ParseFastA(object):
             recHead = self._key(recHead)
             return (recHead,self.joinWith.join(recData))   
     
-    def to_dict(self):
+    def to_dict(self,packed=False):
         """Returns a single Dict populated with the fastaRecs
-        contained in self._file."""
+        contained in self._file.
+        
+        If packed, the values are twoBit.PackedSeq objs (2 bits per base)
+        instead of strings."""
         fasDict = {}
         while 1:
             try:
@@ -396,7 +506,10 @@ class ParseFastA(object):
                 break
             if fasRec:
                 if not fasRec[0] in fasDict:
-                    fasDict[fasRec[0]] = fasRec[1]
+                    if packed:
+                        fasDict[fasRec[0]] = PackedSeq.from_str(fasRec[1])
+                    else:
+                        fasDict[fasRec[0]] = fasRec[1]
                 else:
                     raise InvalidFileFormatError, "DuplicateFastaRec: %s occurs in your file more than once."
             else:
@@ -457,9 +570,440 @@ class ParseFastA(object):
 
 
 
+def build_fasta_index(fastaPath,indexPath=None,key=None):
+    """
+    GIVEN:
+    1) fastaPath: path to an uncompressed fasta file
+    2) indexPath: path to write the index to (default: fastaPath + '.fai')
+    3) key: func used to parse the recName from HeaderInfo (see ParseFastA)
+    
+    DO:
+    1) walk fastaPath once, recording for each rec: recName, seqLength, byte offset
+       of the first base, bases per line and bytes per line.
+    2) write this info to indexPath as tab-delim lines (same layout as "samtools faidx")
+    
+    RETURN:
+    1) indexPath
+    
+    NOTES:
+    1) All seq lines of a rec except the last must have the same length or the
+       byte offsets can not be calculated; InvalidFileFormatError is raised if not.
+    """
+    if fastaPath.endswith('.gz'):
+        raise InvalidFileFormatError("build_fasta_index: can not index a gzipped file: %s" % (fastaPath))
+    if not indexPath:
+        indexPath = fastaPath + '.fai'
+    if not key:
+        key = lambda x:x[1:].split()[0]
+    
+    recs   = []
+    fasta  = open(fastaPath,'rb')
+    offset = 0
+    rec    = None
+    for line in fasta:
+        lineLen = len(line)
+        if line.startswith('>'):
+            rec = {'name':key(line.rstrip('\r\n')),'length':0,'offset':offset+lineLen,
+                   'lineBases':0,'lineWidth':0,'sawShort':False}
+            recs.append(rec)
+        elif rec == None:
+            if line.strip():
+                raise InvalidFileFormatError('build_fasta_index: The first line containing text in %s does not start with ">".' % \
+                                             (fastaPath))
+        else:
+            bases = len(line.rstrip('\r\n'))
+            if bases and rec['sawShort']:
+                raise InvalidFileFormatError("build_fasta_index: rec %s in %s has seq lines of differing lengths." % \
+                                             (rec['name'],fastaPath))
+            if rec['lineBases'] == 0:
+                rec['lineBases'] = bases
+                rec['lineWidth'] = lineLen
+            elif (bases > rec['lineBases']) or ((bases == rec['lineBases']) and (lineLen != rec['lineWidth']) and line.endswith('\n')):
+                raise InvalidFileFormatError("build_fasta_index: rec %s in %s has seq lines of differing lengths." % \
+                                             (rec['name'],fastaPath))
+            elif bases < rec['lineBases']:
+                # only the last line of a rec may be short
+                rec['sawShort'] = True
+            rec['length'] += bases
+        offset += lineLen
+    fasta.close()
+    
+    indexFile = open(indexPath,'w')
+    for rec in recs:
+        indexFile.write("%s\t%s\t%s\t%s\t%s\n" % (rec['name'],rec['length'],rec['offset'],
+                                                   rec['lineBases'],rec['lineWidth']))
+    indexFile.close()
+    
+    return indexPath
+
+
+class IndexedFastA(object):
+    """Returns a random-access fastA reader that seeks straight to the bytes of a
+    requested region using a samtools-style ".fai" index."""
+    def __init__(self,filePath,indexPath=None,key=None,rebuild=False):
+        """Returns a random-access fastA reader.
+        Exmpl: reader.fetch('supercont1.1',1000,3000,'-')
+        
+        <indexPath> is the ".fai" file to use (default: filePath + '.fai').
+        If it does not exist, is older than filePath or <rebuild> is True,
+        it is (re)built with build_fasta_index().
+        
+        <key> is func used to parse the recName from HeaderInfo.
+        """
+        if filePath.endswith('.gz'):
+            raise InvalidFileFormatError("IndexedFastA: gzipped fasta files can not be seeked: %s" % (filePath))
+        if not indexPath:
+            indexPath = filePath + '.fai'
+        
+        self._file = open(filePath,'rb')
+        self.name  = os.path.abspath(filePath)
+        self.indexPath = indexPath
+        
+        stale = (not os.path.exists(indexPath)) or (os.path.getmtime(indexPath) < os.path.getmtime(filePath))
+        if rebuild or stale:
+            build_fasta_index(filePath,indexPath,key=key)
+        
+        self.index   = collections.OrderedDict()
+        self.lengths = collections.OrderedDict()
+        for line in open(indexPath,'rU'):
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 5:
+                raise InvalidFileFormatError("IndexedFastA: malformed index line in %s: %s" % (indexPath,line))
+            name = fields[0]
+            self.index[name]   = tuple([int(x) for x in fields[1:5]]) # (length,offset,lineBases,lineWidth)
+            self.lengths[name] = self.index[name][0]
+    
+    def __contains__(self,chrom):
+        return chrom in self.index
+    
+    def __iter__(self):
+        return iter(self.index)
+    
+    def __getitem__(self,chrom):
+        """Returns the full seqStr of chrom."""
+        return self.fetch(chrom)
+    
+    def _byteOffset(self,chrom,pos):
+        length,offset,lineBases,lineWidth = self.index[chrom]
+        return offset + (pos // lineBases)*lineWidth + (pos % lineBases)
+    
+    def fetch(self,chrom,start=0,end=None,strand='+'):
+        """Returns seqStr of chrom from start to end.
+        
+        Coords are 0-referenced "in-between" as used in BED files.
+        end=None means the end of chrom.  If strand is '-' the reverse
+        complement is returned."""
+        try:
+            length = self.index[chrom][0]
+        except KeyError:
+            raise InvalidOptionError(chrom,'chrom')
+        if end == None:
+            end = length
+        if (start < 0) or (end > length) or (start > end):
+            raise InvalidOptionError('%s:%s-%s' % (chrom,start,end),'start/end','0 <= start <= end <= %s' % (length))
+        if start == end:
+            return ''
+        
+        startByte = self._byteOffset(chrom,start)
+        endByte   = self._byteOffset(chrom,end-1) + 1
+        self._file.seek(startByte)
+        seq = self._file.read(endByte-startByte).replace('\n','').replace('\r','')
+        
+        if strand in ['-','-1',-1]:
+            seq = revComp(seq)
+        elif strand not in ['+','1',1,'.']:
+            raise InvalidOptionError(strand,'strand',['+','-','.'])
+        return seq
+    
+    def close(self):
+        self._file.close()
+
+
+def build_flat_seq_file(fastaPath,flatPath=None):
+    """
+    GIVEN:
+    1) fastaPath: path to an uncompressed fasta file
+    2) flatPath: path to write to (default: fastaPath + '.flat')
+    
+    DO:
+    1) write every seq of fastaPath back to back with no headers or line breaks
+       so that rec i starts at sum(lengths[:i]) in the order of fastaPath's ".fai"
+    
+    RETURN:
+    1) flatPath
+    """
+    if not flatPath:
+        flatPath = fastaPath + '.flat'
+    fasta    = open(fastaPath,'rb')
+    flatFile = open(flatPath,'wb')
+    for line in fasta:
+        if not line.startswith('>'):
+            flatFile.write(line.rstrip('\r\n'))
+    fasta.close()
+    flatFile.close()
+    return flatPath
+
+
+class GenomeStore(object):
+    """Read-only, memory-mapped store of the seqs in a set of fasta files.
+    
+    Each fasta gets a ".fai" index and a ".flat" companion file holding only its
+    bases.  The companion files are mmap'd read-only, so worker processes opening
+    (or inheriting) the same store share one page-cached copy of the genome and
+    resident memory does not grow with genome size."""
+    def __init__(self,fastaFiles,key=None,rebuild=False):
+        """Returns a memory-mapped genome store.
+        Exmpl: store.slice('supercont1.1',1000,3000)  # zero-copy buffer
+               store.fetch('supercont1.1',1000,3000,'-')  # str
+        
+        <fastaFiles> is a list of fasta files or dirs containing fasta files.
+        <key> is func used to parse the recName from HeaderInfo.
+        <rebuild> forces the ".fai" and ".flat" files to be rewritten.
+        """
+        self.fastaFiles = fastaFiles
+        self._key       = key
+        self.lengths    = collections.OrderedDict()
+        self._recs      = {}   # recName:(mmapIndex,offset)
+        self._maps      = []
+        
+        for p in _expand_fasta_paths(fastaFiles):
+            if p.endswith('.gz'):
+                raise InvalidFileFormatError("GenomeStore: %s is gzipped; its seqs can not be memory-mapped, gunzip it first." % (p))
+            try:
+                reader = IndexedFastA(p,key=key,rebuild=rebuild)
+            except InvalidFileFormatError as errTxt:
+                # most likely p is not a fasta file (ex: a README in a genome dir)
+                sys.stderr.write("Warning: GenomeStore: skipping %s: %s\n" % (p,errTxt))
+                continue
+            reader.close()
+            
+            flatPath = p + '.flat'
+            stale = (not os.path.exists(flatPath)) or (os.path.getmtime(flatPath) < os.path.getmtime(p))
+            if rebuild or stale:
+                build_flat_seq_file(p,flatPath)
+            if os.path.getsize(flatPath) != sum(reader.lengths.values()):
+                raise SanityCheckError("GenomeStore: %s does not agree with %s; delete it and try again." % (flatPath,reader.indexPath))
+            
+            self._maps.append(flatPath)
+            offset = 0
+            for name,length in reader.lengths.iteritems(): # fai (and .flat) order
+                if (name in self.lengths) and (self.lengths[name] != length):
+                    # SANITY_CHECK: make sure that any duplicate fastaRecs gave the same length, if not: complain and die
+                    raise SanityCheckError("Encountered fastaRec with lengths that do not agree: %s:%s" % \
+                                           (name,[self.lengths[name],length]))
+                self.lengths[name] = length
+                self._recs[name]   = (len(self._maps)-1,offset)
+                offset += length
+        
+        self._openMaps()
+    
+    def _openMaps(self):
+        """mmap every ".flat" file read-only."""
+        maps = []
+        for flatPath in self._maps:
+            if os.path.getsize(flatPath) == 0:
+                maps.append('') # can not mmap an empty file
+                continue
+            flatFile = open(flatPath,'rb')
+            maps.append(mmap.mmap(flatFile.fileno(),0,access=mmap.ACCESS_READ))
+            flatFile.close()
+        self._mmaps = maps
+    
+    def __getstate__(self):
+        """mmaps can not be pickled: ship only the paths and re-map on arrival
+        (workers then share the parent's page-cached pages)."""
+        state = self.__dict__.copy()
+        del state['_mmaps']
+        return state
+    
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+        self._openMaps()
+    
+    def __contains__(self,chrom):
+        return chrom in self.lengths
+    
+    def __iter__(self):
+        return iter(self.lengths)
+    
+    def __len__(self):
+        return len(self.lengths)
+    
+    def keys(self):
+        return self.lengths.keys()
+    
+    def __getitem__(self,chrom):
+        """Returns zero-copy buffer of the full seq of chrom."""
+        return self.slice(chrom)
+    
+    def slice(self,chrom,start=0,end=None):
+        """Returns a zero-copy, read-only buffer of chrom[start:end].
+        
+        Coords are 0-referenced "in-between" as used in BED files."""
+        try:
+            mapIndex,offset = self._recs[chrom]
+        except KeyError:
+            raise InvalidOptionError(chrom,'chrom')
+        length = self.lengths[chrom]
+        if end == None:
+            end = length
+        if (start < 0) or (end > length) or (start > end):
+            raise InvalidOptionError('%s:%s-%s' % (chrom,start,end),'start/end','0 <= start <= end <= %s' % (length))
+        return buffer(self._mmaps[mapIndex],offset+start,end-start)
+    
+    def fetch(self,chrom,start=0,end=None,strand='+'):
+        """Returns seqStr of chrom from start to end (copied out of the mmap).
+        If strand is '-' the reverse complement is returned."""
+        seq = str(self.slice(chrom,start,end))
+        if strand in ['-','-1',-1]:
+            seq = revComp(seq)
+        elif strand not in ['+','1',1,'.']:
+            raise InvalidOptionError(strand,'strand',['+','-','.'])
+        return seq
+    
+    def close(self):
+        for m in self._mmaps:
+            if m:
+                m.close()
+
+
+def _bad_fastq_rec(problem,lineNumber):
+    raise InvalidFileFormatError("** ERROR: %s.\n\
+               Please check FastQ file near line number %s (plus or minus ~4 lines) and try again**" % (problem,lineNumber))
+
+def _check_fastq_recs(headers,seqs,qualHeaders,quals,firstLine,headerSymbols=['@','+']):
+    """Checks a whole batch of recs at once; on failure finds the first bad rec
+    and raises InvalidFileFormatError with its line number."""
+    seqLens  = map(len,seqs)
+    qualLens = map(len,quals)
+    hdSym,qualSym = headerSymbols
+    # -- Make sure we got 4 full lines of data --
+    if (0 in seqLens) or (0 in qualLens):
+        for i,(s,q) in enumerate(zip(seqLens,qualLens)):
+            if not (s and q):
+                _bad_fastq_rec("It looks like I encountered a premature EOF or empty line",firstLine + 4*i)
+    # -- Make sure we are in the correct "register" --
+    if ''.join([h[:1] for h in headers]).count(hdSym) != len(headers):
+        for i,h in enumerate(headers):
+            if not h.startswith(hdSym):
+                _bad_fastq_rec("The 1st line in fastq element does not start with '%s'" % (hdSym),firstLine + 4*i)
+    if ''.join([h[:1] for h in qualHeaders]).count(qualSym) != len(qualHeaders):
+        for i,h in enumerate(qualHeaders):
+            if not h.startswith(qualSym):
+                _bad_fastq_rec("The 3rd line in fastq element does not start with '%s'" % (qualSym),firstLine + 4*i + 2)
+    # -- Make sure the seq line and qual line have equal lengths --
+    if seqLens != qualLens:
+        for i,(s,q) in enumerate(zip(seqLens,qualLens)):
+            if s != q:
+                _bad_fastq_rec("The length of Sequence data and Quality data of the last record aren't equal",
+                               firstLine + 4*i + 3)
+
+
+class FastQBatch(object):
+    """A block of consecutive fastQ recs held column-wise.
+    
+    The four lines of each rec are kept as lists of str (headers, seqs,
+    qualHeaders, quals).  seqArray and qualArray hold every seq/qual of the batch
+    back to back as flat uint8 arrays (quals already converted to Phred scores)
+    with rec i at [offsets[i]:offsets[i]+lengths[i]], so per-read stats can be
+    taken with numpy ufunc.reduceat() instead of python loops.  The arrays are
+    only built the first time they are asked for."""
+    def __init__(self,headers,seqs,qualHeaders,quals,phredOffset=33,firstLineNumber=1):
+        self.headers     = headers
+        self.seqs        = seqs
+        self.qualHeaders = qualHeaders
+        self.quals       = quals
+        self.phredOffset = phredOffset
+        self.firstLineNumber = firstLineNumber
+        self.lengths = np.fromiter((len(s) for s in seqs),dtype=np.int64,count=len(seqs))
+        self.offsets = np.zeros(len(seqs),dtype=np.int64)
+        np.cumsum(self.lengths[:-1],out=self.offsets[1:])
+        self._seqArray  = None
+        self._qualArray = None
+    
+    @classmethod
+    def from_lines(cls,lines,headerSymbols=['@','+'],phredOffset=33,firstLineNumber=1):
+        """Returns a checked FastQBatch built from a list of complete fastQ lines
+        (no line endings, len(lines) a multiple of 4)."""
+        headers     = lines[0::4]
+        seqs        = lines[1::4]
+        qualHeaders = lines[2::4]
+        quals       = lines[3::4]
+        _check_fastq_recs(headers,seqs,qualHeaders,quals,firstLineNumber,headerSymbols)
+        return cls(headers,seqs,qualHeaders,quals,phredOffset=phredOffset,firstLineNumber=firstLineNumber)
+    
+    @classmethod
+    def from_str(cls,txt,headerSymbols=['@','+'],phredOffset=33,firstLineNumber=1):
+        """Returns a checked FastQBatch built from a str of complete fastQ recs
+        (as returned by ParseFastQ.next_chunk_str())."""
+        if '\r' in txt:
+            txt = txt.replace('\r\n','\n')
+        lines = txt.split('\n')
+        while lines and not lines[-1]:
+            lines.pop()
+        if len(lines) % 4:
+            _bad_fastq_rec("It looks like I encountered a premature EOF or empty line",firstLineNumber + len(lines))
+        return cls.from_lines(lines,headerSymbols,phredOffset,firstLineNumber)
+    
+    def __len__(self):
+        return len(self.headers)
+    
+    def __iter__(self):
+        """Yields rec tuples: (seqHeader,seqStr,qualHeader,qualStr)"""
+        return itertools.izip(self.headers,self.seqs,self.qualHeaders,self.quals)
+    
+    @property
+    def seqArray(self):
+        if self._seqArray is None:
+            self._seqArray = np.frombuffer(''.join(self.seqs),dtype=np.uint8)
+        return self._seqArray
+    
+    @property
+    def qualArray(self):
+        if self._qualArray is None:
+            self._qualArray = np.frombuffer(''.join(self.quals),dtype=np.uint8) - np.uint8(self.phredOffset)
+        return self._qualArray
+    
+    def _reduce(self,ufunc,values):
+        if not len(self):
+            return np.zeros(0,dtype=values.dtype)
+        return ufunc.reduceat(values,self.offsets)
+    
+    def mean_quals(self):
+        """Returns float array of the mean Phred score of each read."""
+        return self._reduce(np.add,self.qualArray.astype(np.int64)) / self.lengths.astype(np.float64)
+    
+    def min_quals(self):
+        """Returns int array of the lowest Phred score of each read."""
+        return self._reduce(np.minimum,self.qualArray).astype(np.int64)
+    
+    def n_counts(self):
+        """Returns int array of the number of N/n in each read."""
+        seqs = self.seqArray
+        return self._reduce(np.add,((seqs == ord('N')) | (seqs == ord('n'))).astype(np.int64))
+    
+    def subset(self,mask):
+        """Returns FastQBatch of only the recs where bool array <mask> is True."""
+        keep = np.flatnonzero(mask)
+        pick = lambda items: [items[i] for i in keep]
+        return FastQBatch(pick(self.headers),pick(self.seqs),pick(self.qualHeaders),pick(self.quals),
+                          phredOffset=self.phredOffset)
+    
+    def to_str(self,mask=None):
+        """Returns the recs (only those where <mask> is True if given) as a
+        single fastQ formatted str ready to be written in one call."""
+        if mask is None:
+            recs = self
+        else:
+            recs = self.subset(mask)
+        if not len(recs):
+            return ''
+        return '\n'.join(['\n'.join(rec) for rec in recs]) + '\n'
+
+
 class ParseFastQ(object):
     """Returns a read-by-read fastQ parser analogous to file.readline()"""
-    def __init__(self,filePath,headerSymbols=['@','+']):
+    def __init__(self,filePath,headerSymbols=['@','+'],blockSize=4*1024*1024,phredOffset=33):
         """Returns a read-by-read fastQ parser analogous to file.readline().
         Exmpl: parser.next()
         -OR-
@@ -468,53 +1012,111 @@ class ParseFastQ(object):
             ... do something with rec ...
 
         rec is tuple: (seqHeader,seqStr,qualHeader,qualStr)
+        
+        -OR- in batch mode:
+        for batch in parser.batches():
+            keep = batch.mean_quals() >= 20
+            outFile.write(batch.to_str(keep))
+        
+        The file is read <blockSize> bytes at a time and split into recs in
+        bulk; next() just hands out the recs of the current batch.
+        <phredOffset> is subtracted from the qual chars of a batch's qualArray.
         """
-        if filePath.endswith('.gz'):
-            self._file = gzip.open(filePath)
-        else:
-            self._file = open(filePath, 'rU')
+        self._file = open_stream(filePath,'rb')
         self._currentLineNumber = 0
         self._hdSyms = headerSymbols
+        self._blockSize = blockSize
+        self._phredOffset = phredOffset
+        self._tail  = ''    # partial recs left over from the last block
+        self._eof   = False
+        self._batch = None  # batch being handed out by next()
+        self._batchPos = 0
         
     def __iter__(self):
         return self
     
     def next(self):
-        """Reads in next element, parses, and does minimal verification.
+        """Returns next rec after minimal verification (done per batch).
         Returns: tuple: (seqHeader,seqStr,qualHeader,qualStr)"""
-        # ++++ Get Next Four Lines ++++
-        elemList = []
-        for i in range(4):
-            line = self._file.readline()
-            self._currentLineNumber += 1 ## increment file position
-            if line:
-                elemList.append(line.strip('\n'))
-            else: 
-                elemList.append(None)
-        
-        # ++++ Check Lines For Expected Form ++++
-        trues = [bool(x) for x in elemList].count(True)
-        nones = elemList.count(None)
-        # -- Check for acceptable end of file --
-        if nones == 4:
+        while (self._batch == None) or (self._batchPos >= len(self._batch)):
+            self._batch = self.next_batch()
+            self._batchPos = 0
+        i = self._batchPos
+        self._batchPos += 1
+        batch = self._batch
+        return (batch.headers[i],batch.seqs[i],batch.qualHeaders[i],batch.quals[i])
+    
+    def batches(self):
+        """Yields FastQBatch objects until the file is exhausted.
+        Do not mix with next() (recs already handed to next() are not repeated
+        but the rest of its current batch would be skipped)."""
+        while 1:
+            try:
+                yield self.next_batch()
+            except StopIteration:
+                return
+    
+    def next_batch(self):
+        """Reads the next block of the file and returns all of the complete recs
+        in it as a FastQBatch.  Raises StopIteration at EOF."""
+        lines = None
+        while not lines:
+            if self._eof:
+                raise StopIteration
+            block = self._file.read(self._blockSize)
+            if not block:
+                self._eof = True
+                data = self._tail
+            else:
+                data = self._tail + block
+            if '\r' in data:
+                data = data.replace('\r\n','\n')
+            lines = data.split('\n')
+            if self._eof:
+                # -- Check for acceptable end of file (trailing empty lines are OK) --
+                while lines and not lines[-1]:
+                    lines.pop()
+                if len(lines) % 4:
+                    _bad_fastq_rec("It looks like I encountered a premature EOF or empty line",
+                                   self._currentLineNumber + len(lines))
+                self._tail = ''
+            else:
+                # -- keep the partial last line and any incomplete rec for the next block --
+                keep = len(lines) % 4 or 4
+                self._tail = '\n'.join(lines[-keep:])
+                del lines[-keep:]
+        
+        firstLine = self._currentLineNumber + 1
+        self._currentLineNumber += len(lines)
+        return FastQBatch.from_lines(lines,self._hdSyms,self._phredOffset,firstLine)
+    
+    def next_chunk_str(self,count):
+        """Returns (txt,firstLineNumber): txt holds the next <count> recs (fewer at
+        EOF) as raw fastQ text, unsplit and unchecked, so that the parsing can be
+        done elsewhere with FastQBatch.from_str().  Raises StopIteration at EOF.
+        Do not mix with next()/take()/next_batch()."""
+        lineCount = 4*count
+        chunks = [self._tail]
+        have   = self._tail.count('\n')
+        while (have < lineCount) and not self._eof:
+            block = self._file.read(self._blockSize)
+            if not block:
+                self._eof = True
+                break
+            chunks.append(block)
+            have += block.count('\n')
+        data = ''.join(chunks)
+        if have >= lineCount:
+            newLines = np.flatnonzero(np.frombuffer(data,dtype=np.uint8) == ord('\n'))
+            cut = newLines[lineCount-1] + 1
+            txt,self._tail = data[:cut],data[cut:]
+        else:
+            txt,self._tail = data,''
+        if not txt.strip():
             raise StopIteration
-        # -- Make sure we got 4 full lines of data --
-        assert trues == 4,\
-               "** ERROR: It looks like I encountered a premature EOF or empty line.\n\
-               Please check FastQ file near line number %s (plus or minus ~4 lines) and try again**" % (self._currentLineNumber)
-        # -- Make sure we are in the correct "register" --
-        assert elemList[0].startswith(self._hdSyms[0]),\
-               "** ERROR: The 1st line in fastq element does not start with '%s'.\n\
-               Please check FastQ file near line number %s (plus or minus ~4 lines) and try again**" % (self._hdSyms[0],self._currentLineNumber) 
-        assert elemList[2].startswith(self._hdSyms[1]),\
-               "** ERROR: The 3rd line in fastq element does not start with '%s'.\n\
-               Please check FastQ file near line number %s (plus or minus ~4 lines) and try again**" % (self._hdSyms[1],self._currentLineNumber) 
-        # -- Make sure the seq line and qual line have equal lengths --
-        assert len(elemList[1]) == len(elemList[3]), "** ERROR: The length of Sequence data and Quality data of the last record aren't equal.\n\
-               Please check FastQ file near line number %s (plus or minus ~4 lines) and try again**" % (self._currentLineNumber) 
-        
-        # ++++ Return fatsQ data as tuple ++++
-        return tuple(elemList)
+        firstLine = self._currentLineNumber + 1
+        self._currentLineNumber += lineCount
+        return txt,firstLine
     
     def get_next_readSeq(self):
         """Convenience method: calls self.next and returns only the readSeq."""
@@ -524,33 +1126,35 @@ class ParseFastQ(object):
         except StopIteration:
             return None
         
-    def filter_SEfastQ_headings(self,filteredPath,key=None):
+    def filter_SEfastQ_headings(self,filteredPath,key=None,compress=None):
         """
         Iterates through a single-end fastQ file and writes only those recs
         that satisfy the <key> lambda func to <filteredPath>.
+        <key> is given the seqHeader of each rec.  It can also be a readFilter
+        expression (str or ReadFilter), which tests whole batches of recs at
+        once.  key=None keeps every rec.
+        <compress> is passed to compression.open_stream() (BGZF output).
         """
         fastqLen = 0
         filteredLen = 0
         
-        if key == None:
-            key = lambda x: x
-        filtered = open(filteredPath, 'w')
+        if isinstance(key,basestring):
+            key = compile_read_filter(key)
+        filtered = open_stream(filteredPath, 'w', compress=compress)
         
-        while 1:
-            try:
-                qRec = self.next()
-                fastqLen += 1
-            except StopIteration:
-                break
-            
-            if key(qRec[0]) == True:
-                for line in qRec:
-                    filtered.write('%s\n' % (line))
-                    filteredLen += 1
-            elif key(qRec[0]) == False:
-                pass
+        for batch in self.batches():
+            fastqLen += len(batch)
+            if key == None:
+                keep = np.ones(len(batch),dtype=bool)
+            elif isinstance(key,ReadFilter):
+                keep = key.mask(batch)
             else:
-                raise UnexpectedValueError("ERROR: in ParseFastQ.filter_fastQ_headings() 'key' returned a non-T/F value.")
+                keep = [key(header) for header in batch.headers]
+                if [k for k in keep if k not in [True,False]]:
+                    raise UnexpectedValueError("ERROR: in ParseFastQ.filter_fastQ_headings() 'key' returned a non-T/F value.")
+                keep = np.array(keep,dtype=bool)
+            filtered.write(batch.to_str(keep))
+            filteredLen += 4*int(keep.sum()) # lines written
         
         filtered.flush()
         filtered.close()
@@ -559,14 +1163,113 @@ class ParseFastQ(object):
                 "original":fastqLen,
                 "filtered":filteredLen})
         
-def onlyInA(fileA,fileB,outFile):
+def _partition_lines(path,partFiles,numbered=False):
+    """Writes every line of path to partFiles[crc32(line) % len(partFiles)];
+    prefixed with its line number if <numbered>."""
+    parts = len(partFiles)
+    inFile = open(path,'rU')
+    for lineNum,line in enumerate(inFile):
+        line = line.strip('\n')
+        part = partFiles[(zlib.crc32(line) & 0xffffffff) % parts]
+        if numbered:
+            part.write('%s\t%s\n' % (lineNum,line))
+        else:
+            part.write('%s\n' % (line))
+    inFile.close()
+
+def _onlyInA_partitioned(fileA,fileB,outFile,partitions,keepOrder,tmpDir):
+    """onlyInA() for files that do not fit in memory: lines of both files are
+    hashed into <partitions> pairs of temp files so that equal lines land in
+    the same pair, then each pair is diffed in memory.  Returns (rLines,written)."""
+    tmpDir = tempfile.mkdtemp(prefix='onlyInA.',dir=tmpDir)
+    try:
+        partsA = [open(os.path.join(tmpDir,'A.%s' % (i)),'w') for i in range(partitions)]
+        partsB = [open(os.path.join(tmpDir,'B.%s' % (i)),'w') for i in range(partitions)]
+        _partition_lines(fileA,partsA,numbered=keepOrder)
+        _partition_lines(fileB,partsB)
+        for f in partsA + partsB:
+            f.close()
+        
+        rLines  = 0
+        written = 0
+        results = []
+        for i in range(partitions):
+            linesB = set(open(partsB[i].name).read().split('\n')[:-1])
+            os.remove(partsB[i].name)
+            # distinct lines of A in first-seen order: (firstLineNum,count)
+            linesA = collections.OrderedDict()
+            for line in open(partsA[i].name):
+                line = line[:-1]
+                lineNum = None
+                if keepOrder:
+                    lineNum,line = line.split('\t',1)
+                if line in linesB:
+                    continue
+                if line in linesA:
+                    linesA[line][1] += 1
+                else:
+                    linesA[line] = [lineNum,1]
+            os.remove(partsA[i].name)
+            del linesB
+            
+            if keepOrder:
+                # line numbers rise within a partition: save them for the final merge
+                result = open(os.path.join(tmpDir,'out.%s' % (i)),'w')
+                results.append(result.name)
+            else:
+                result = outFile
+            for line,(lineNum,count) in linesA.iteritems():
+                if count > 1:
+                    rLines += 1
+                if keepOrder:
+                    result.write('%s\t%s\n' % (lineNum,line))
+                else:
+                    result.write('%s\n' % (line))
+                written += 1
+            if keepOrder:
+                result.close()
+        
+        if keepOrder:
+            def numbered(path):
+                for line in open(path):
+                    lineNum,line = line.split('\t',1)
+                    yield int(lineNum),line
+            for lineNum,line in heapq.merge(*[numbered(path) for path in results]):
+                outFile.write(line)
+        return rLines,written
+    finally:
+        shutil.rmtree(tmpDir,ignore_errors=True)
+
+def onlyInA(fileA,fileB,outFile,partitions=None,keepOrder=False,tmpDir=None):
     """Takes two files. Writes a third file with the lines that are unique to
-    fileA.  NOTE: Can be Memory intensive for large files."""
+    fileA.  NOTE: Can be Memory intensive for large files.
+    
+    <partitions> moves the work to disk for files that do not fit in memory:
+    both files are split by line hash into that many partitions ('auto': one
+    per ~256MB of input) in <tmpDir> and only one partition pair is in memory
+    at a time.  Lines are written in partition order unless <keepOrder>, in
+    which case they come out in the order of their first occurrence in fileA.
+    Lines repeated in fileA are written once (with a warning) in both modes."""
+    
+    if partitions:
+        if partitions == 'auto':
+            inputSize  = os.path.getsize(fileA) + os.path.getsize(fileB)
+            partitions = max(1,int(inputSize // (256*1024*1024)) + 1)
+        outFile = open(outFile,'w')
+        rLines,written = _onlyInA_partitioned(fileA,fileB,outFile,partitions,keepOrder,tmpDir)
+        if rLines:
+            sys.stderr.write('WARNING: %s lines written to %s occured more than once in %s, but %s is now non-redundant.' %\
+                             (rLines,outFile.name,fileA,outFile.name))
+        outFile.close()
+        return
     
     fileA = open(fileA,'rU')
     fileB = open(fileB,'rU')
     
-    lineDict = {}
+    if keepOrder:
+        lineDict = collections.OrderedDict()
+    else:
+        lineDict = {}
     
     # Get line info
     for line in fileA:
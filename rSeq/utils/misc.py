@@ -1,4 +1,5 @@
 import sys
+import string
 import inspect
 import textwrap
 import smtplib
@@ -155,6 +156,14 @@ def slidingWindow(sequence,winSize,step=1):
 
 def fold_seq(seq, lineLen=70):
     return [seq[i:i+lineLen] for i in xrange(0, len(seq), lineLen)]
+
+# translation table used by revComp(); keeps soft-masking (case) and IUPAC codes intact.
+_compTable = string.maketrans('ACGTRYMKBDHVNacgtrymkbdhvn',
+                              'TGCAYRKMVHDBNtgcayrkmvhdbn')
+
+def revComp(seq):
+    """Returns the reverse complement of a nucleotide string."""
+    return seq.translate(_compTable)[::-1]
         
 
 def email_notification(sender,to,subject,txt,pw):
@@ -5,11 +5,15 @@ from collections import namedtuple
 import exceptions
 import os
 import hashlib
+import itertools
+import multiprocessing
+import numpy as np
 from motility import IUPAC,PWM
 import motility
 from cogent import DNA,SequenceCollection,Alignment
 from rSeq.utils.files import ParseFastA
-from rSeq.utils.stats import cumHypergeoP,seqStats
+from rSeq.utils.stats import cumHypergeoP,cumHypergeoPvals,seqStats
+from rSeq.utils.motifDiscovery.pwmScan import SeqCodes,ScoreDistribution,scanPWMs
 from rSeq.utils.errors import *
 
 # ++++++++ useful constants ++++++++ 
@@ -51,6 +55,7 @@ class Motif(object,IUPAC,PWM):
         self.pwm         = {}    # key(nulceotide),value(tuple of freqs at each position)
         self.threshPval  = None
         self.threshPval_target = None
+        self.threshBias  = None  # (halfAT,halfGC) the thresholds were set for
         self.threshScore = None
         self.kmersOverThresh =None
 
@@ -324,44 +329,41 @@ class Motif(object,IUPAC,PWM):
         """
         raise exceptions.NotImplementedError()
 
-    def scan(self,dnaSeq,pValThresh=0.01,halfAT=0.25,halfGC=0.25,log=False):
-        """Return motility hits tuple.  You should use this instead of 'find'."""
-        def _setThresh(newPval):
-            """Return threshold that is approximately
-            exquivilent to a p-value of 'pValThresh'"""
-            maxScore = self.max_score()
-            minScore = self.min_score() # to be used for lower bound (but later.. :( )
-            scoreSteps = [maxScore*(x/100.0) for x in range(1,101)]
-            scoreSteps.reverse()
-            thresh = maxScore
-            for score in scoreSteps:
-                pVal = self.weight_sites_over(score,AT_bias=halfAT, GC_bias=halfGC)
-                if pVal <= newPval:
-                    thresh = score
-                elif pVal > newPval:
-                    break
-            threshPval = self.weight_sites_over(thresh,AT_bias=halfAT, GC_bias=halfGC)
-            if threshPval <= newPval:
-                return thresh,threshPval
-            else:
-                return None
-
-        if (self.threshPval == pValThresh) or (self.threshPval_target == pValThresh):
+    def scoreMatrix(self):
+        """Returns self.pwm as a float array (positions x bases A,C,G,T), the
+        matrix motility scores with."""
+        return np.array(self._getMotilityMatrix(self.pwm),dtype=float)
+
+    def setThresh(self,pValThresh=0.01,halfAT=0.25,halfGC=0.25,cache=None):
+        """Sets threshScore, threshPval and kmersOverThresh to the lowest score
+        whose exact background p-value is not over pValThresh, unless they are
+        already set for pValThresh and this background.  With <cache> (a
+        threshCache.ThreshCache) they are looked up there by barcode first and
+        newly set ones are added to it (call cache.save() to keep them).
+        Returns True if at least one kmer scores over the threshold."""
+        if ((self.threshPval == pValThresh) or (self.threshPval_target == pValThresh)) \
+           and (self.threshBias == (halfAT,halfGC)):
             #print 'No change in Thresh.'
             pass
         else:
             self.threshPval_target = pValThresh
-            newThreshs = _setThresh(pValThresh)
+            self.threshBias = (halfAT,halfGC)
+            newThreshs = None
+            if cache:
+                newThreshs = cache.get(self.barcode,pValThresh,halfAT,halfGC)
             if not newThreshs:
-                return False
-            else:
-                self.threshScore,self.threshPval = _setThresh(pValThresh)
-                self.kmersOverThresh = len(self.generate_sites_over(self.threshScore))
-                #print '%s new score: %s pVal: %s  kmersOver: %s' % (self.id,
-                                                                    #self.threshScore,
-                                                                    #self.threshPval,
-                                                                    #self.kmersOverThresh)
-        if self.kmersOverThresh < 1:
+                # exact p-values from the PWM's score distribution (see pwmScan.ScoreDistribution)
+                scoreDist  = ScoreDistribution(self.scoreMatrix(),(halfAT,halfGC,halfGC,halfAT))
+                newThreshs = scoreDist.threshold(pValThresh) or (None,None,0)
+                if cache:
+                    cache.put(self.barcode,pValThresh,halfAT,halfGC,newThreshs)
+            self.threshScore,self.threshPval,self.kmersOverThresh = newThreshs
+        return self.kmersOverThresh >= 1
+
+    def scan(self,dnaSeq,pValThresh=0.01,halfAT=0.25,halfGC=0.25,log=False,cache=None):
+        """Return motility hits tuple.  You should use this instead of 'find'.
+        <cache>: threshCache.ThreshCache to reuse thresholds from (see setThresh())."""
+        if not self.setThresh(pValThresh,halfAT,halfGC,cache):
             return False
         else:
             return self.find(dnaSeq,self.threshScore)
@@ -482,35 +484,84 @@ def toTAMOmotifs(motifList,seqData=None):
     return tList
     
 
-def getEvalHitDict(motifList,seqDict,pThresh=0.01,halfAT=0.25,halfGC=0.25):
+def getHitCountMatrix(motifList,seqDict,pThresh=0.01,halfAT=0.25,halfGC=0.25,procs=1,cache=None):
+    """
+    GIVEN:
+    1) motifList: Motif objs
+    2) seqDict: geneName:seq dict
+    3) pThresh,halfAT,halfGC: see Motif.scan()
+    4) procs: number of processes scanning motifs at once
+    5) cache: threshCache.ThreshCache of motif thresholds (or None)
+
+    DO:
+    1) set each motif's score threshold for pThresh (Motif.setThresh()),
+       reusing those in cache and saving the new ones to it
+    2) encode every seq once and count the hits of all motifs with PWMs on
+       both strands of every seq (see pwmScan); motifs without a PWM are
+       scanned one seq at a time with Motif.scan()
+
+    RETURN:
+    1) (geneNames,counts,usable): counts is an int array (genes x motifs) of
+       the hits of each motif and usable is a bool array that is False for
+       the motifs that no kmer can hit at pThresh (their counts are 0)
+    """
+    genes  = seqDict.keys()
+    counts = np.zeros((len(genes),len(motifList)),dtype=np.int64)
+    usable = np.array([m.setThresh(pThresh,halfAT,halfGC,cache) for m in motifList],dtype=bool)
+    if cache:
+        cache.save()
+    pwmCols = [j for j,m in enumerate(motifList) if usable[j] and m.pwm]
+    if pwmCols:
+        seqCodes = SeqCodes([seqDict[g] for g in genes])
+        counts[:,pwmCols] = scanPWMs(seqCodes,[motifList[j].scoreMatrix() for j in pwmCols],
+                                     [motifList[j].threshScore for j in pwmCols],procs=procs)
+    for j,m in enumerate(motifList):
+        if usable[j] and not m.pwm:
+            counts[:,j] = [len(m.scan(seqDict[g],pValThresh=pThresh,halfAT=halfAT,halfGC=halfGC,cache=cache)) for g in genes]
+    return genes,counts,usable
+
+def getEvalHitDict(motifList,seqDict,pThresh=0.01,halfAT=0.25,halfGC=0.25,procs=1,cache=None):
     """Return a dict of which motifs return more hits at given threshold than expected by
     the pval*kmers searched (E-val). 
     
     Keys=geneNames, Values=namedTuple of results named by each motif's ID"""
     
     hDict = {}
+    genes,counts,usable = getHitCountMatrix(motifList,seqDict,pThresh,halfAT,halfGC,procs,cache)
     
     # define named tuple
     MotifTup = namedtuple('MotifTup','%s'%(' '.join([x.id for x in motifList])))
-    for seq in seqDict:
+    motifLens = [len(m) for m in motifList]
+    for seq,hits in zip(genes,counts.tolist()):
         motifData = []
-        for m in motifList:
-            hits = m.scan(seqDict[seq],pValThresh=pThresh,halfAT=halfAT,halfGC=halfGC)
-            if hits == False:
-                motifData.append(hits)
+        seqLen = len(seqDict[seq])
+        for j,m in enumerate(motifList):
+            if not usable[j]:
+                motifData.append(False)
             else:
-                seqLen      = len(seqDict[seq])
-                kmersTested = (seqLen-len(m)+1)*2 # we search on both strands
+                kmersTested = (seqLen-motifLens[j]+1)*2 # we search on both strands
                 Eval        = pThresh*kmersTested
-                if len(hits) > Eval:
-                    motifData.append(len(hits))
-                    #print 'Yay! %s' % (m.id)
+                if hits[j] > Eval:
+                    motifData.append(hits[j])
                 else:
                     motifData.append(None)
         hDict[seq] = MotifTup._make(motifData)
     return hDict
                 
             
+def hitDict2matrix(hitDict,motifIDs,expect=0):
+    """Returns (geneNames,hits) for a getEvalHitDict() dict: hits is a bool
+    array (genes x motifIDs) that is True where a gene has more than <expect>
+    hits of the motif."""
+    genes = hitDict.keys()
+    if not genes:
+        return genes,np.zeros((0,len(motifIDs)),dtype=bool)
+    fields = hitDict[genes[0]]._fields
+    cols   = [fields.index(x) for x in motifIDs]
+    counts = np.array([hitDict[g] for g in genes],dtype=object)[:,cols]
+    # misses are None/False; both compare below any number in py2
+    return genes,np.asarray(counts > expect,dtype=bool)
+            
 def motifHyprGeoEnrichment(motifList,hitDict,foregroundSeqs,expect=0):
     """Calculate the hypergeometric enrichment p-Value of each motif in motifList.
     n = # of positives in population
@@ -520,37 +571,87 @@ def motifHyprGeoEnrichment(motifList,hitDict,foregroundSeqs,expect=0):
 
     P(i) = sum([as i->N] (choose(n,i)choose(m,N-i))/choose(n+m,N))"""
     
-    def _get_n_and_i(motifID,expect):
-        """Number of positives in population and sample."""
-        n = 0
-        i = 0
-        for item in hitDict.iteritems():
-            if item[1].__getattribute__(motifID) > expect:
-                if item[0] in foregroundSeqs:
-                    n += 1
-                    i += 1
-                else:
-                    n += 1
-        return n,i
-
-    def _get_m():
-        """Number of negatives in population"""
-        return len(hitDict)-n
-        
-    def _get_N():
-        """sample size"""
-        return len(foregroundSeqs)
-    
     foregroundSeqs = set(foregroundSeqs)
-    pVals = []
-    for mtf in motifList:
-        n,i = _get_n_and_i(mtf.id,expect)
-        m = _get_m()
-        N = _get_N()
-        pVal = cumHypergeoP(n,i,m,N)
-        pVals.append(tuple([mtf.id,cumHypergeoP(n,i,m,N)]))
-        
-    return tuple(pVals)
+    motifIDs = [mtf.id for mtf in motifList]
+    genes,hits = hitDict2matrix(hitDict,motifIDs,expect)
+    inFg = np.array([g in foregroundSeqs for g in genes],dtype=bool)
+    
+    n = hits.sum(0)           # positives in population
+    i = hits[inFg].sum(0)     # positives in sample
+    m = len(genes) - n        # negatives in population
+    N = len(foregroundSeqs)   # sample size
+    pVals = cumHypergeoPvals(n,i,m,N)
+    
+    return tuple(zip(motifIDs,pVals.tolist()))
+    
+def _init_permutation_worker(hits,n,m,sampleSize):
+    global _permData
+    _permData = (hits,n,m,sampleSize)
+
+def _permutation_batch(batch):
+    """Returns the p-values (reps x motifs) of one batch of random foregrounds."""
+    batchIdx,reps,seed = batch
+    hits,n,m,sampleSize = _permData
+    rng = np.random.RandomState([seed,batchIdx])
+    picks = np.zeros((reps,hits.shape[0]),dtype=np.float32)
+    for rep in range(reps):
+        picks[rep,rng.permutation(hits.shape[0])[:sampleSize]] = 1
+    i = np.dot(picks,hits).astype(np.int64) # positives in each random sample
+    return cumHypergeoPvals(n,i,m,sampleSize)
+
+def motifHyprGeoPermutations(motifList,hitDict,sampleSize,reps,expect=0,universe=None,seed=None,procs=1,batchSize=50):
+    """
+    GIVEN:
+    1) motifList, hitDict, expect: as for motifHyprGeoEnrichment()
+    2) sampleSize: number of genes in each random foreground
+    3) reps: number of random foregrounds
+    4) universe: genes the foregrounds are drawn from (default: hitDict's keys);
+       genes missing from hitDict count as having no hits
+    5) seed: int seed; the same seed gives the same p-values with any procs
+    6) procs: number of worker processes
+    7) batchSize: random foregrounds scored per matrix multiply
+
+    DO:
+    1) hold the hits as a gene x motif matrix and draw each batch of random
+       foregrounds as a 0/1 (reps x gene) matrix from its own RandomState
+       (seeded with [seed,batchIdx])
+    2) count the positives of every foreground and motif with one matrix
+       multiply per batch and score them all with cumHypergeoPvals()
+
+    RETURN:
+    1) float array of p-values (reps x motifs in motifList order)
+    """
+    motifIDs = [mtf.id for mtf in motifList]
+    genes,hits = hitDict2matrix(hitDict,motifIDs,expect)
+    n = hits.sum(0)
+    m = len(genes) - n
+    if universe != None:
+        rows  = dict([(g,x) for x,g in enumerate(genes)])
+        hits  = np.vstack((hits,np.zeros((1,len(motifIDs)),dtype=bool)))
+        hits  = hits[[rows.get(g,-1) for g in universe]]
+    if sampleSize > hits.shape[0]:
+        raise InvalidOptionError(sampleSize,'sampleSize','no more than the %s genes to draw from' % (hits.shape[0]))
+    if seed == None:
+        seed = np.random.randint(2**31)
+    batches = [(b,min(batchSize,reps-start),seed) for b,start in enumerate(range(0,reps,batchSize))]
+    hits = hits.astype(np.float32)
+    
+    if procs > 1:
+        pool = multiprocessing.Pool(procs,initializer=_init_permutation_worker,initargs=(hits,n,m,sampleSize))
+        results = pool.imap(_permutation_batch,batches)
+    else:
+        pool = None
+        _init_permutation_worker(hits,n,m,sampleSize)
+        results = itertools.imap(_permutation_batch,batches)
+    try:
+        pVals = [x for x in results]
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+    if not pVals:
+        return np.zeros((0,len(motifIDs)))
+    return np.vstack(pVals)
     
 def motifHyprGeoEnrichmentTAMO(motifList,probeset,foregroundSeqs,factor=0.75,bestFactor=False):
     """Calculate the hypergeometric enrichment p-Value of each motif in motifList using TAMO.
@@ -0,0 +1,225 @@
+"""
+####################
+pwmScan.py
+####################
+Vectorized PWM scanning of many sequences at once.
+
+All sequences are encoded once (SeqCodes): joined by 'N' spacers into one
+array of base codes (A,C,G,T = 0-3, anything else = 4) that is then packed
+into overlapping k-mer codes.  A PWM is scored on every window of every
+sequence with one table lookup per k columns of the matrix (the table holds
+the summed scores of all 5**k k-mers for those columns) instead of one per
+column and base.  Windows holding an 'N' (or a spacer) score -inf, so they
+are never hits.  The reverse strand is scored with the reverse-complemented
+matrix, so hits on both strands are counted as motility's find() does.
+
+Score thresholds come from the exact distribution of a PWM's scores under a
+background base composition (ScoreDistribution): the scores are put on an
+integer lattice and the distribution is built one matrix column at a time by
+dynamic programming, so a p-value maps to a threshold (and to the number of
+kmers over it) in O(length x bins) without enumerating any kmer.
+"""
+import itertools
+import multiprocessing
+
+import numpy as np
+
+from rSeq.utils.errors import *
+
+# ++++++++ useful constants ++++++++
+KMER_SIZE  = 4          # matrix columns scored per table lookup (5**4 entry tables)
+BLOCK_SIZE = 2**22      # windows scored at once
+MAX_LATTICE = 2**20     # widest score range of int matrices scored exactly
+SCORE_BINS  = 10000     # score bins used for the other matrices
+PVAL_RTOL   = 1e-9      # p-values this close to the target count as equal to it
+_baseCodes = ''.join([chr('ACGT'.find(chr(x).upper())) if chr(x) in 'ACGTacgt' else '\x04' for x in range(256)])
+_scanCodes = None
+
+
+# ++++++++ helper defs ++++++++
+def _encode(seq):
+    """Returns uint8 array of the base codes of seq (non-ACGT = 4)."""
+    return np.frombuffer(str(seq).translate(_baseCodes),dtype=np.uint8)
+
+def _kmerTables(matrix,k):
+    """Returns list of 5**k score tables, one per k columns of matrix (L x 4,
+    cols ACGT); 'N' scores -inf and the columns padding the last table score 0."""
+    L = len(matrix)
+    pad = (-L) % k
+    ext = np.zeros((L+pad,5))
+    ext[:L,:4] = matrix
+    ext[:L,4]  = -np.inf
+    tables = []
+    for c in range(0,L+pad,k):
+        table = np.zeros([5]*k)
+        for j in range(k):
+            shape = [1]*k
+            shape[j] = 5
+            table = table + ext[c+j].reshape(shape)
+        tables.append(table.ravel())
+    return tables
+
+def revCompMatrix(matrix):
+    """Returns the reverse complement of a (L x 4, cols ACGT) matrix."""
+    return np.asarray(matrix)[::-1,::-1]
+
+
+# ++++++++ classes ++++++++
+class SeqCodes(object):
+    """A set of sequences encoded once for scanning with many PWMs."""
+    def __init__(self,seqs,k=KMER_SIZE):
+        """
+        seqs : list of sequences (str or anything str() turns into one)
+        k    : matrix columns scored per table lookup
+        """
+        self.k = k
+        lengths = np.array([len(s) for s in seqs],dtype=np.int64)
+        # every seq is followed by one 'N' spacer; k more pad the end
+        self.starts = np.concatenate(([0],np.cumsum(lengths+1)[:-1])).astype(np.int64)
+        self.lengths = lengths
+        joined = np.empty(int(lengths.sum())+len(seqs)+k,dtype=np.uint8)
+        joined.fill(4)
+        for start,seq in zip(self.starts.tolist(),seqs):
+            joined[start:start+len(seq)] = _encode(seq)
+        self.kmers = np.zeros(len(joined)-k+1,dtype=np.int32)
+        for j in range(k):
+            self.kmers *= 5
+            self.kmers += joined[j:len(joined)-k+1+j]
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def scores(self,matrix,start,end):
+        """Returns float array of the scores of matrix on windows start..end-1."""
+        return self._scores(_kmerTables(np.asarray(matrix,dtype=float),self.k),start,end)
+
+    def _scores(self,tables,start,end):
+        scores = np.zeros(end-start)
+        for c,table in enumerate(tables):
+            first = start + c*self.k
+            scores += table.take(self.kmers[first:first+end-start])
+        return scores
+
+    def count_hits(self,matrix,thresh):
+        """Returns int array: per seq number of windows scoring >= thresh on
+        either strand (a window matching both strands counts twice)."""
+        matrix = np.asarray(matrix,dtype=float)
+        lastWin = len(self.kmers) - self.k*((len(matrix)-1)//self.k)
+        counts  = np.zeros(len(self),dtype=np.int64)
+        if len(self) == 0:
+            return counts
+        for mat in (matrix,revCompMatrix(matrix)):
+            tables = _kmerTables(mat,self.k)
+            for start in xrange(0,lastWin,BLOCK_SIZE):
+                end  = min(start+BLOCK_SIZE,lastWin)
+                hits = np.flatnonzero(self._scores(tables,start,end) >= thresh) + start
+                if len(hits):
+                    counts += np.bincount(np.searchsorted(self.starts,hits,side='right')-1,minlength=len(self))
+        return counts
+
+
+class ScoreDistribution(object):
+    """Distribution of the scores of every kmer a PWM can match, weighted by a
+    background base composition and counted."""
+    def __init__(self,matrix,bgFreqs=(0.25,0.25,0.25,0.25),bins=SCORE_BINS):
+        """
+        matrix  : PWM (L x 4 array, cols ACGT)
+        bgFreqs : background probability of A,C,G,T (ex: motility's
+                  AT_bias,GC_bias,GC_bias,AT_bias)
+        bins    : score bins used when matrix is not made of ints (or its
+                  score range is wider than MAX_LATTICE); scores are then
+                  rounded to multiples of (max score - min score)/bins
+        """
+        matrix   = np.asarray(matrix,dtype=float)
+        colMins  = matrix.min(1)
+        spread   = (matrix.max(1) - colMins).sum()
+        if (matrix == np.round(matrix)).all() and spread <= MAX_LATTICE:
+            self.step = 1.0
+        else:
+            self.step = max(spread,1e-12) / bins
+        self.offset = colMins.sum()
+        offsets = np.round((matrix - colMins[:,np.newaxis]) / self.step).astype(np.int64)
+
+        probs  = np.ones(1)
+        counts = np.ones(1)
+        bgFreqs = np.asarray(bgFreqs,dtype=float)
+        for col in offsets:
+            newProbs  = np.zeros(len(probs)+col.max())
+            newCounts = np.zeros(len(probs)+col.max())
+            for b in range(4):
+                newProbs[col[b]:col[b]+len(probs)]   += probs * bgFreqs[b]
+                newCounts[col[b]:col[b]+len(counts)] += counts
+            probs,counts = newProbs,newCounts
+        self.probs  = probs
+        self.counts = counts
+        # P(score >= bin) and number of kmers scoring >= bin
+        self.tailProbs  = probs[::-1].cumsum()[::-1]
+        self.tailCounts = counts[::-1].cumsum()[::-1]
+
+    def _bin(self,score):
+        return min(max(int(np.ceil((score - self.offset) / self.step - 1e-9)),0),len(self.probs))
+
+    def score_of(self,scoreBin):
+        return self.offset + scoreBin*self.step
+
+    def pval(self,score):
+        """Returns the background probability of a kmer scoring >= score."""
+        k = self._bin(score)
+        return float(self.tailProbs[k]) if k < len(self.probs) else 0.0
+
+    def kmers_over(self,score):
+        """Returns the number of kmers scoring >= score."""
+        k = self._bin(score)
+        return int(round(self.tailCounts[k])) if k < len(self.probs) else 0
+
+    def threshold(self,pVal):
+        """Returns (score,pVal,kmersOver) for the lowest score whose p-value is
+        not over pVal, or None if even the best kmer is more likely than pVal.
+        Tail p-values within a relative PVAL_RTOL of pVal count as equal to it,
+        so summation round-off does not decide ties."""
+        ok = np.flatnonzero((self.tailProbs <= pVal*(1+PVAL_RTOL)) & (self.probs > 0))
+        if not len(ok):
+            return None
+        k = ok[0]
+        return self.score_of(k),float(self.tailProbs[k]),int(round(self.tailCounts[k]))
+
+
+# ++++++++ meta functions ++++++++
+def _init_scan_worker(seqCodes):
+    global _scanCodes
+    _scanCodes = seqCodes
+
+def _scan_one(args):
+    matrix,thresh = args
+    return _scanCodes.count_hits(matrix,thresh)
+
+def scanPWMs(seqCodes,matrices,threshs,procs=1):
+    """
+    GIVEN:
+    1) seqCodes: SeqCodes of the sequences to scan
+    2) matrices: list of PWMs (L x 4 arrays, cols ACGT; see Motif.scoreMatrix())
+    3) threshs: min score of a hit for each matrix
+    4) procs: number of worker processes (each PWM is scanned by one)
+
+    RETURN:
+    1) int array (seqs x matrices) of the number of hits on both strands
+    """
+    if len(matrices) != len(threshs):
+        raise SanityCheckError("scanPWMs: got %s matrices but %s thresholds." % (len(matrices),len(threshs)))
+    tasks = zip(matrices,threshs)
+    if procs > 1:
+        pool = multiprocessing.Pool(procs,initializer=_init_scan_worker,initargs=(seqCodes,))
+        results = pool.imap(_scan_one,tasks)
+    else:
+        pool = None
+        _init_scan_worker(seqCodes)
+        results = itertools.imap(_scan_one,tasks)
+    try:
+        counts = [x for x in results]
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+    if not counts:
+        return np.zeros((len(seqCodes),0),dtype=np.int64)
+    return np.column_stack(counts)
@@ -0,0 +1,76 @@
+"""
+####################
+threshCache.py
+####################
+On-disk cache of motif score thresholds.
+
+Setting a motif's threshold (Motif.setThresh()) depends only on its PWM, the
+target p-value and the background AT/GC bias, so the results (threshScore,
+threshPval, kmersOverThresh) are kept in one json file keyed on the motif's
+md5 barcode and those three values.  Runs against the same motif libraries
+and backgrounds then skip threshold calibration.  The file is rewritten via
+a temp file that is renamed into place, merging entries other runs added
+since it was loaded.
+"""
+import os
+import json
+import tempfile
+
+from rSeq.utils.errors import *
+
+# ++++++++ useful constants ++++++++
+CACHE_VERSION = 1   # bump when the way thresholds are set changes
+
+
+# ++++++++ classes ++++++++
+class ThreshCache(object):
+    """Motif thresholds keyed by (barcode,pValThresh,halfAT,halfGC)."""
+    def __init__(self,cachePath):
+        """
+        cachePath : json file holding the thresholds (created on first save())
+        """
+        self.cachePath = os.path.abspath(os.path.expanduser(cachePath))
+        self.threshs   = self._load()
+        self._new      = {}
+
+    def _load(self):
+        if not os.path.exists(self.cachePath):
+            return {}
+        try:
+            data = json.load(open(self.cachePath))
+        except ValueError:
+            raise InvalidFileFormatError("ThreshCache: %s is not a valid threshold cache; delete it and try again." % (self.cachePath))
+        if data.get('version') != CACHE_VERSION:
+            return {}
+        return data['threshs']
+
+    def key(self,barcode,pValThresh,halfAT,halfGC):
+        return '%s:%r:%r:%r' % (barcode,float(pValThresh),float(halfAT),float(halfGC))
+
+    def get(self,barcode,pValThresh,halfAT,halfGC):
+        """Returns (threshScore,threshPval,kmersOverThresh) or None if not cached."""
+        found = self.threshs.get(self.key(barcode,pValThresh,halfAT,halfGC))
+        if found == None:
+            return None
+        return tuple(found)
+
+    def put(self,barcode,pValThresh,halfAT,halfGC,threshs):
+        """Caches threshs (threshScore,threshPval,kmersOverThresh); written by save()."""
+        key = self.key(barcode,pValThresh,halfAT,halfGC)
+        self.threshs[key] = self._new[key] = list(threshs)
+
+    def save(self):
+        """Writes the thresholds added since the last save() to cachePath."""
+        if not self._new:
+            return
+        self.threshs = self._load()
+        self.threshs.update(self._new)
+        cacheDir = os.path.dirname(self.cachePath)
+        if not os.path.isdir(cacheDir):
+            os.makedirs(cacheDir)
+        tmpFd,tmpPath = tempfile.mkstemp(dir=cacheDir,suffix='.tmp')
+        tmpFile = os.fdopen(tmpFd,'w')
+        json.dump({'version':CACHE_VERSION,'threshs':self.threshs},tmpFile)
+        tmpFile.close()
+        os.rename(tmpPath,self.cachePath)
+        self._new = {}
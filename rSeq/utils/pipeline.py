@@ -0,0 +1,291 @@
+"""
+####################
+pipeline.py
+####################
+Runs the per-sample align -> index -> count -> merge steps as a dependency
+graph.  Steps of different samples run at the same time as long as they fit
+inside a CPU and memory budget; a failed step only stops the steps that
+depend on it.
+"""
+import os
+import sys
+import time
+import threading
+import Queue
+import collections
+from multiprocessing import cpu_count
+
+from rSeq import scripts
+from rSeq.utils.errors import *
+from rSeq.utils.misc import Bag
+from rSeq.utils.externals import run_external,mkdirp
+from rSeq.utils.align import run_pipe
+from rSeq.utils.files import tableFile2namedTuple
+from rSeq.utils.stepCache import cached_run
+
+
+# ++++++++ classes ++++++++
+class Step(object):
+    """One node of a pipeline."""
+    def __init__(self,name,cmd,deps=None,cpus=1,mem=0,stdout=None,outputs=None,inputs=None):
+        """
+        name    : unique name of the step (ex: 'align:sample1')
+        cmd     : args list of the program to run, or a list of args lists
+                  that are connected by pipes (see align.run_pipe())
+        deps    : names of the steps that must succeed first
+        cpus    : number of cpus the step will keep busy
+        mem     : memory (MB) the step is expected to need
+        stdout  : path to write the step's stdout to (default: its log file)
+        outputs : paths the step creates (informational; used by dry runs)
+        inputs  : index base names in cmd (ex: bowtie's ebwt) whose files the
+                  step reads; used by the step cache (see StepCache.key())
+        """
+        self.name    = name
+        self.cmd     = cmd
+        self.deps    = list(deps or [])
+        self.cpus    = cpus
+        self.mem     = mem
+        self.stdout  = stdout
+        self.outputs = list(outputs or [])
+        self.inputs  = list(inputs or [])
+        self.status  = 'pending'
+        self.results = None
+
+    def is_piped(self):
+        return isinstance(self.cmd[0],(list,tuple))
+
+    def __str__(self):
+        if self.is_piped():
+            cmdStr = ' | '.join([' '.join(args) for args in self.cmd])
+        else:
+            cmdStr = ' '.join(self.cmd)
+        if self.stdout:
+            cmdStr += ' > %s' % (self.stdout)
+        return cmdStr
+
+    def __repr__(self):
+        return "Step(%r,cpus=%s,mem=%s,deps=%s)" % (self.name,self.cpus,self.mem,self.deps)
+
+
+class Scheduler(object):
+    """Runs Steps as soon as their deps are done and they fit in the budget."""
+    def __init__(self,cpus=None,mem=None,logDir=None,cache=None):
+        """
+        cpus   : max cpus used at once (default: all of them)
+        mem    : max memory (MB) used at once (default: no limit)
+        logDir : dir for the per-step log files (default: cwd)
+        cache  : stepCache.StepCache; steps whose inputs, tools and options
+                 match a cached run get its outputs instead of being run
+        """
+        self.cpus   = cpus or cpu_count()
+        self.mem    = mem
+        self.logDir = logDir or os.getcwd()
+        self.cache  = cache
+        self.steps  = collections.OrderedDict()
+
+    def add(self,step):
+        if step.name in self.steps:
+            raise SanityCheckError("Scheduler: a step named %s was already added." % (step.name))
+        for dep in step.deps:
+            if dep not in self.steps:
+                raise SanityCheckError("Scheduler: %s depends on unknown step %s (add deps first)." % (step.name,dep))
+        self.steps[step.name] = step
+        return step
+
+    def _depth(self,step):
+        """Number of steps upstream of step on its longest path."""
+        if not step.deps:
+            return 0
+        return 1 + max([self._depth(self.steps[d]) for d in step.deps])
+
+    def _needs(self,step):
+        """Returns the (cpus,mem) a step holds; clamped so every step can run."""
+        mem = step.mem
+        if self.mem:
+            mem = min(mem,self.mem)
+        return min(step.cpus,self.cpus),mem
+
+    def _execStep(self,step,log):
+        """Runs step's cmd(s) writing stdout to step.stdout (or log) and stderr to log."""
+        out = log
+        if step.stdout:
+            out = open(step.stdout,'wb')
+        try:
+            startTime = time.time()
+            if step.is_piped():
+                pipeResults = run_pipe([('%s.%s' % (i+1,args[0]),args) for i,args in enumerate(step.cmd)],stdout=out)
+                for name,txt in pipeResults.stderr.iteritems():
+                    log.write(''.join(['[%s] %s\n' % (name,line) for line in txt.splitlines()]))
+                return Bag({'returncode':0,'wallTime':time.time()-startTime,
+                            'returncodes':pipeResults.returncodes})
+            return run_external(step.cmd,stdout=out,stderr=log)
+        finally:
+            if step.stdout:
+                out.close()
+
+    def _runStep(self,step,done):
+        logPath = os.path.join(self.logDir,'%s.log' % (step.name.replace(':','.').replace('/','_')))
+        log = open(logPath,'w')
+        log.write('%s\n' % (step))
+        log.flush()
+        outputs = list(step.outputs)
+        if step.stdout and (step.stdout not in outputs):
+            outputs.append(step.stdout)
+        try:
+            startTime = time.time()
+            results = cached_run(self.cache,step.cmd,outputs,self._execStep,step,log,inputs=step.inputs)
+            if results.get('cached'):
+                log.write('outputs restored from step cache (key %s)\n' % (results.key))
+                results.wallTime = time.time() - startTime
+            done.put((step.name,results,None))
+        except Exception as err:
+            log.write('%s\n' % (err))
+            done.put((step.name,None,err))
+        finally:
+            log.close()
+
+    def run(self,dryRun=False):
+        """Runs every step; returns OrderedDict of stepName:Step with status
+        ('done','failed' or 'skipped') and results (run_external() Bag) set.
+        Raises SystemCallError after everything that could run has run if any step failed."""
+        mkdirp(self.logDir)
+        if dryRun:
+            for step in self.steps.itervalues():
+                print "[%s] (cpus=%s mem=%s deps=%s)\n\t%s" % (step.name,step.cpus,step.mem,','.join(step.deps),step)
+            return self.steps
+
+        pending  = sorted(self.steps.values(),key=lambda s: -self._depth(s)) # finish samples before starting new ones
+        running  = {}
+        usedCpus = 0
+        usedMem  = 0
+        done     = Queue.Queue()
+
+        while pending or running:
+            for step in list(pending):
+                depStatus = [self.steps[d].status for d in step.deps]
+                if [x for x in depStatus if x in ['failed','skipped']]:
+                    step.status = 'skipped'
+                    pending.remove(step)
+                    sys.stderr.write("[pipeline] skipping %s: an upstream step failed.\n" % (step.name))
+                    continue
+                if [x for x in depStatus if x != 'done']:
+                    continue
+                cpus,mem = self._needs(step)
+                if (usedCpus + cpus > self.cpus) or (self.mem and (usedMem + mem > self.mem)):
+                    continue
+                usedCpus += cpus
+                usedMem  += mem
+                step.status = 'running'
+                running[step.name] = step
+                pending.remove(step)
+                sys.stderr.write("[pipeline] starting %s (cpus in use: %s/%s)\n" % (step.name,usedCpus,self.cpus))
+                t = threading.Thread(target=self._runStep,args=(step,done))
+                t.daemon = True
+                t.start()
+
+            if not running:
+                break
+            name,results,err = done.get()
+            step = running.pop(name)
+            cpus,mem = self._needs(step)
+            usedCpus -= cpus
+            usedMem  -= mem
+            step.results = results
+            if err:
+                step.status = 'failed'
+                sys.stderr.write("[pipeline] %s FAILED: %s\n" % (name,err))
+            else:
+                step.status = 'done'
+                sys.stderr.write("[pipeline] finished %s in %.1fs\n" % (name,results.wallTime))
+
+        failed = [s.name for s in self.steps.itervalues() if s.status == 'failed']
+        if failed:
+            skipped = [s.name for s in self.steps.itervalues() if s.status == 'skipped']
+            raise SystemCallError(None,'pipeline steps failed: %s; skipped: %s (see logs in %s)' % \
+                                  (', '.join(failed),', '.join(skipped) or 'none',self.logDir),'pipeline')
+        return self.steps
+
+
+# ++++++++ meta functions ++++++++
+def read_sample_sheet(sheetPath):
+    """Returns list of Bags (name,fastq1,fastq2) from a tab-delim sample sheet with
+    a header line naming at least the columns: sample, fastq1 (optional: fastq2).
+    fastq1/fastq2 may be comma-separated lists of files."""
+    samples = []
+    for row in tableFile2namedTuple(sheetPath):
+        row = row._asdict()
+        if not (row.get('sample') and row.get('fastq1')):
+            raise InvalidFileFormatError("%s needs 'sample' and 'fastq1' columns with a value on every line." % (sheetPath))
+        samples.append(Bag({'name':row['sample'],
+                            'fastq1':row['fastq1'],
+                            'fastq2':row.get('fastq2') or None}))
+    names = [s.name for s in samples]
+    if len(set(names)) != len(names):
+        raise InvalidFileFormatError("%s contains duplicate sample names." % (sheetPath))
+    return samples
+
+def build_sample_pipeline(samples,btIndex,gtfPath,outDir,btOptions='-v 2 -m 1',alignThreads=4,alignMem=0,
+                          countMem=0,sharedIndex=True,countOptions=None,scheduler=None):
+    """
+    GIVEN:
+    1) samples: list of Bags (name,fastq1,fastq2) (see read_sample_sheet())
+    2) btIndex: bowtie index name/path
+    3) gtfPath: annotation used for counting
+    4) outDir: where every output and the step logs go
+    5) btOptions: bowtie options str ("-S", "-p" and "--mm" are added here)
+    6) alignThreads: bowtie -p threads (and cpus reserved) per align step
+    7) alignMem, countMem: MB reserved for each align/count step.  With
+       sharedIndex the index is mmap'd (--mm) so its pages are shared by every
+       bowtie running at once; alignMem then only needs to cover one process's
+       own working memory.
+    8) countOptions: list of extra args for my_htseq_count.py (ex: ['-s','no'])
+    9) scheduler: Scheduler to add to (default: a new one logging to outDir/logs)
+
+    DO:
+    1) per sample: align (bowtie | samtools view | samtools sort, streamed) ->
+       index -> count (my_htseq_count.py)
+    2) merge all count tables into one (sam2count_table.py)
+
+    RETURN:
+    1) the Scheduler (call its run())
+    """
+    if scheduler == None:
+        scheduler = Scheduler(logDir=os.path.join(outDir,'logs'))
+    scriptDir = os.path.dirname(os.path.abspath(scripts.__file__))
+    btOpts = btOptions.split()
+    if not [x for x in btOpts if x in ['-S','--sam']]:
+        btOpts.append('-S')
+    if sharedIndex and '--mm' not in btOpts:
+        btOpts.append('--mm')
+    btOpts += ['-p',str(alignThreads)]
+
+    tables = []
+    for sample in samples:
+        prefix = os.path.join(outDir,sample.name)
+        bam    = '%s.srt.bam' % (prefix)
+        if sample.fastq2:
+            reads = ['-1',sample.fastq1,'-2',sample.fastq2]
+        else:
+            reads = [sample.fastq1]
+
+        align = scheduler.add(Step('align:%s' % (sample.name),
+                                   [['bowtie'] + btOpts + [btIndex] + reads,
+                                    ['samtools','view','-bSu','-'],
+                                    ['samtools','sort','-','%s.srt' % (prefix)]],
+                                   cpus=alignThreads,mem=alignMem,outputs=[bam],inputs=[btIndex]))
+        index = scheduler.add(Step('index:%s' % (sample.name),
+                                   ['samtools','index',bam],
+                                   deps=[align.name],outputs=[bam + '.bai']))
+        table = '%s.counts.txt' % (prefix)
+        count = scheduler.add(Step('count:%s' % (sample.name),
+                                   [sys.executable,os.path.join(scriptDir,'my_htseq_count.py'),'-q'] + \
+                                   list(countOptions or []) + [bam,gtfPath],
+                                   deps=[index.name],mem=countMem,stdout=table,outputs=[table]))
+        tables.append((sample.name,table,count.name))
+
+    merged = os.path.join(outDir,'counts_table.txt')
+    scheduler.add(Step('merge',
+                       [sys.executable,os.path.join(scriptDir,'sam2count_table.py')] + \
+                       [t[1] for t in tables] + ['-n'] + [t[0] for t in tables] + ['-o',merged],
+                       deps=[t[2] for t in tables],outputs=[merged]))
+    return scheduler
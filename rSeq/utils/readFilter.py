@@ -0,0 +1,213 @@
+"""
+####################
+readFilter.py
+####################
+A small declarative language for filtering fastQ reads.  Expressions are
+compiled into predicates that test a whole FastQBatch at once with numpy
+instead of calling a python func on every read.
+
+Grammar:
+    expr       := term ('or' term)*
+    term       := factor ('and' factor)*
+    factor     := 'not' factor | '(' expr ')' | comparison
+    comparison := FIELD OP VALUE
+
+Fields:
+    flag      the Casava 1.8 "is filtered" flag (Y/N) of headers such as
+              "@HWI-ST619:70:B0BMTABXX:3:1102:9652:78621 1:N:0:TAGCTT";
+              '' for older headers (ex: "@HWUSI-EAS100R:6:73:941:1973#0/1")
+    header    the whole seq header line (use with ~ or !~ and a regex)
+    meanqual  mean Phred score of the read
+    minqual   lowest Phred score of the read
+    ncount    number of N bases in the read
+    length    read length
+
+Ops:  == != < <= > >=  and  ~ !~ (regex search, header only)
+
+Exmpl: flag == N and meanqual >= 20 and ncount <= 2
+       not header ~ "^@HWI-ST619:70" or length > 50
+"""
+import re
+import operator
+
+import numpy as np
+
+from rSeq.utils.errors import *
+
+# ++++++++ useful constants ++++++++
+NUMERIC_FIELDS = {'meanqual':lambda batch: batch.mean_quals(),
+                  'minqual' :lambda batch: batch.min_quals(),
+                  'ncount'  :lambda batch: batch.n_counts(),
+                  'length'  :lambda batch: batch.lengths}
+TEXT_FIELDS    = ['flag','header']
+COMPARE_OPS    = {'==':operator.eq,
+                  '!=':operator.ne,
+                  '<' :operator.lt,
+                  '<=':operator.le,
+                  '>' :operator.gt,
+                  '>=':operator.ge}
+REGEX_OPS      = ['~','!~']
+
+# one group per header line: the flag or '' if the header does not have one
+# (nothing may match a '\n': pre-Casava 1.8 headers have no space in them)
+_flagRegex = re.compile(r'^(?:\S*[ \t]+[^:\s]*:([^:\s]*):)?.*$',re.M)
+_tokenRegex = re.compile(r'''\s*(?:(?P<num>-?\d+(?:\.\d*)?)|
+                                  (?P<str>"[^"]*"|'[^']*')|
+                                  (?P<op>==|!=|<=|>=|!~|<|>|~|\(|\))|
+                                  (?P<word>[A-Za-z_][\w.]*))''',re.X)
+
+
+# ++++++++ helper defs ++++++++
+def _tokenize(expr):
+    """Returns list of (kind,value) tuples."""
+    tokens = []
+    pos = 0
+    expr = expr.strip()
+    while pos < len(expr):
+        m = _tokenRegex.match(expr,pos)
+        if (not m) or (m.end() == pos):
+            raise InvalidOptionError(expr[pos:],'filter expression','<field> <op> <value> joined by and/or/not')
+        kind = m.lastgroup
+        value = m.group(kind)
+        if kind == 'str':
+            value = value[1:-1]
+        elif kind == 'num':
+            value = float(value)
+        elif (kind == 'word') and (value in ['and','or','not']):
+            kind = value
+        tokens.append((kind,value))
+        pos = m.end()
+        while (pos < len(expr)) and expr[pos].isspace():
+            pos += 1
+    return tokens
+
+def header_flags(headers):
+    """Returns str array of the Casava 1.8 filter flag of each header ('' if none)."""
+    return np.array(_flagRegex.findall('\n'.join(headers)) or [''],dtype=str)[:len(headers)]
+
+def header_matches(regex,headers):
+    """Returns bool array: True where compiled <regex> is found in the header.
+    Each header is searched on its own so that the regex can not match
+    across the end of one header into the next."""
+    search = regex.search
+    return np.fromiter((search(h) != None for h in headers),dtype=bool,count=len(headers))
+
+
+# ++++++++ classes ++++++++
+class ReadFilter(object):
+    """A compiled read filter.
+    filt.mask(batch) returns a bool array (True = KEEP) for a FastQBatch.
+    filt(rec) tests a single (seqHeader,seqStr,qualHeader,qualStr) rec so a
+    ReadFilter can be used anywhere the old lambda filters were."""
+    def __init__(self,expr):
+        self.expr = expr
+        self._tokens = _tokenize(expr)
+        self._pos = 0
+        self._test = self._parseExpr()
+        if self._pos != len(self._tokens):
+            raise InvalidOptionError(self._tokens[self._pos][1],'filter expression','and/or or the end of the expression')
+        del self._tokens
+
+    def __repr__(self):
+        return "ReadFilter(%r)" % (self.expr)
+
+    def mask(self,batch):
+        """Returns bool array: True for every rec of batch that passes the filter."""
+        mask = np.asarray(self._test(batch),dtype=bool)
+        if mask.shape != (len(batch),):
+            raise SanityCheckError("ReadFilter: %r gave %s values for a batch of %s reads." % (self.expr,mask.size,len(batch)))
+        return mask
+
+    def __call__(self,rec):
+        from rSeq.utils.files import FastQBatch
+        return bool(self.mask(FastQBatch(*[[line] for line in rec]))[0])
+
+    # ---- recursive descent parser ----
+    def _peek(self):
+        if self._pos < len(self._tokens):
+            return self._tokens[self._pos]
+        return (None,None)
+
+    def _take(self,kind=None):
+        token = self._peek()
+        if (token[0] == None) or (kind and token[0] != kind):
+            raise InvalidOptionError(token[1],'filter expression','a %s in "%s"' % (kind or 'token',self.expr))
+        self._pos += 1
+        return token
+
+    def _parseExpr(self):
+        tests = [self._parseTerm()]
+        while self._peek()[0] == 'or':
+            self._take()
+            tests.append(self._parseTerm())
+        if len(tests) == 1:
+            return tests[0]
+        return lambda batch: np.logical_or.reduce([t(batch) for t in tests])
+
+    def _parseTerm(self):
+        tests = [self._parseFactor()]
+        while self._peek()[0] == 'and':
+            self._take()
+            tests.append(self._parseFactor())
+        if len(tests) == 1:
+            return tests[0]
+        return lambda batch: np.logical_and.reduce([t(batch) for t in tests])
+
+    def _parseFactor(self):
+        kind,value = self._peek()
+        if kind == 'not':
+            self._take()
+            test = self._parseFactor()
+            return lambda batch: ~test(batch)
+        if value == '(':
+            self._take()
+            test = self._parseExpr()
+            if self._take('op')[1] != ')':
+                raise InvalidOptionError(self.expr,'filter expression','balanced parentheses')
+            return test
+        return self._parseComparison()
+
+    def _parseComparison(self):
+        field = self._take('word')[1].lower()
+        op    = self._take('op')[1]
+        kind,value = self._take()
+        if kind not in ['num','str','word']:
+            raise InvalidOptionError(value,'filter expression','a value after %s %s' % (field,op))
+
+        if field in NUMERIC_FIELDS:
+            if (op not in COMPARE_OPS) or (kind != 'num'):
+                raise InvalidOptionError('%s %s %s' % (field,op,value),'filter expression',
+                                         '%s compared to a number with one of %s' % (field,sorted(COMPARE_OPS)))
+            getValues = NUMERIC_FIELDS[field]
+            compare = COMPARE_OPS[op]
+            return lambda batch: compare(getValues(batch),value)
+
+        if field == 'flag':
+            if op not in ['==','!=']:
+                raise InvalidOptionError(op,'flag operator',['==','!='])
+            if kind == 'num':
+                value = str(int(value))
+            compare = COMPARE_OPS[op]
+            return lambda batch: compare(header_flags(batch.headers),value)
+
+        if field == 'header':
+            if op not in REGEX_OPS:
+                raise InvalidOptionError(op,'header operator',REGEX_OPS)
+            regex = re.compile(str(value))
+            if op == '~':
+                return lambda batch: header_matches(regex,batch.headers)
+            return lambda batch: ~header_matches(regex,batch.headers)
+
+        raise InvalidOptionError(field,'filter field',sorted(NUMERIC_FIELDS.keys()) + TEXT_FIELDS)
+
+
+# ++++++++ meta functions ++++++++
+def compile_read_filter(expr):
+    """Returns a ReadFilter for a filter expression (see module doc).
+    For backward compatibility, a str starting with 'lambda' is eval'd
+    (without builtins) and the func is returned as is."""
+    if callable(expr):
+        return expr
+    if expr.strip().startswith('lambda'):
+        return eval(expr,{"__builtins__":None})
+    return ReadFilter(expr)
@@ -1,3 +1,5 @@
+import math
+import itertools
 from decimal import Decimal
 import numpy as np
 import operator as o
@@ -139,6 +141,15 @@ def cumHypergeoP(n,i,m,N):
     For more details -> http://mathworld.wolfram.com/HypergeometricDistribution.html
     """
 
+    return float(cumHypergeoPvals(n,i,m,N))
+
+
+def cumHypergeoP_exact(n,i,m,N):
+    """
+    Same as cumHypergeoP() but sums the terms of hypergeoP() one by one with
+    exact big-integer binomials (slow; kept to check cumHypergeoPvals()).
+    """
+
     cumPVal = 0
 
     for x in range(i,N+1):
@@ -147,6 +158,82 @@ def cumHypergeoP(n,i,m,N):
     return cumPVal
 
 
+# log(k!) for k in 0..len-1; grown on demand by logFactorial()
+_logFactorials = np.zeros(1)
+
+def logFactorial(k):
+    """Returns log(k!) of int (or int array) k from a cached table of lgamma values."""
+    global _logFactorials
+    top = int(np.max(k))
+    if top >= len(_logFactorials):
+        size = max(top+1,2*len(_logFactorials))
+        more = np.fromiter(itertools.imap(math.lgamma,xrange(len(_logFactorials)+1,size+1)),dtype=float)
+        _logFactorials = np.concatenate((_logFactorials,more))
+    return _logFactorials[k]
+
+def logHypergeoP(n,i,m,N):
+    """Returns log of hypergeoP(n,i,m,N); takes ints or int arrays."""
+    return (logFactorial(n) - logFactorial(i) - logFactorial(n-i) +
+            logFactorial(m) - logFactorial(N-i) - logFactorial(m-N+i) -
+            logFactorial(n+m) + logFactorial(N) + logFactorial(n+m-N))
+
+def _hypergeoTail(n,x,m,N,end,step):
+    """Sums P(x)+P(x+step)+... up to P(end), stepping away from the mode so
+    that the terms shrink; each term comes from the last one by recurrence
+    and the sum stops once the terms no longer change it."""
+    term  = np.exp(logHypergeoP(n,x,m,N))
+    total = term.copy()
+    x     = x.astype(float)
+    n,m,N = n.astype(float),m.astype(float),N.astype(float)
+    live  = x != end
+    while live.any():
+        if step > 0:
+            ratio = (n-x)*(N-x) / ((x+1)*(m-N+x+1))
+        else:
+            ratio = x*(m-N+x) / ((n-x+1)*(N-x+1))
+        term   = np.where(live,term*ratio,0.0)
+        total += term
+        x     += step*live
+        live  &= (x != end) & (term > total*1e-17)
+    return total
+
+def cumHypergeoPvals(n,i,m,N):
+    """
+    GIVEN (ints or arrays of them, broadcast against each other):
+    1) n = # of positives in population
+    2) i = # of positives in sample
+    3) m = # of negatives in population
+    4) N = sample size
+
+    DO:
+    1) compute the upper tail P(x >= i) of each hypergeometric in log space
+       (lgamma table) for its first term and by the recurrence between
+       successive terms for the rest.  Tails holding the mode are computed
+       as 1 - P(x < i) so the summed terms always shrink.
+
+    RETURN:
+    1) float array of p-values shaped like the broadcast inputs (a float for scalars)
+    """
+    n,i,m,N = np.broadcast_arrays(*[np.asarray(x,dtype=np.int64) for x in (n,i,m,N)])
+    shape   = n.shape
+    n,i,m,N = [x.ravel() for x in (n,i,m,N)]
+    lo = np.maximum(0,N-m)  # smallest possible i
+    hi = np.minimum(n,N)    # largest possible i
+    pVals = np.where(i <= lo,1.0,0.0)
+    mode  = ((N+1)*(n+1)) // np.maximum(n+m+2,1)
+    todo  = (i > lo) & (i <= hi)
+    upper = todo & (i > mode)
+    lower = todo & ~upper
+    if upper.any():
+        pVals[upper] = _hypergeoTail(n[upper],i[upper],m[upper],N[upper],hi[upper],1)
+    if lower.any():
+        pVals[lower] = 1.0 - _hypergeoTail(n[lower],i[lower]-1,m[lower],N[lower],lo[lower],-1)
+    pVals = np.clip(pVals,0.0,1.0)
+    if not shape:
+        return pVals[0]
+    return pVals.reshape(shape)
+
+
 def binomialPval(n,k,p):
     """Returns exact binomial P-value.
     n = number of trials
@@ -169,25 +256,24 @@ def binomialPval_gte(n,k,p):
 
 
 def seqStats(seqDict,show=False):
-    """Returns Dict of useful sequence statistics."""
-    combinedSeq = ''
-    
+    """Returns Dict of useful sequence statistics.
+    seqDict values may be strings or anything str() turns into one
+    (twoBit.PackedSeq, GenomeStore buffers)."""
     seqLens = []
+    aCnt = cCnt = gCnt = tCnt = nCnt = 0
     for each in seqDict:
-        seqLens.append(len(seqDict[each]))
-        combinedSeq += seqDict[each]
-    
-    combinedSeq= combinedSeq.upper()
+        seq = str(seqDict[each]).upper()
+        seqLens.append(len(seq))
+        aCnt += seq.count('A')
+        cCnt += seq.count('C')
+        gCnt += seq.count('G')
+        tCnt += seq.count('T')
+        nCnt += seq.count('N')
     
     seqNum     = len(seqDict)
-    totNucs    = len(combinedSeq)
-    aCnt       = combinedSeq.count('A')
-    cCnt       = combinedSeq.count('C')
-    gCnt       = combinedSeq.count('G')
-    tCnt       = combinedSeq.count('T')
-    nCnt       = combinedSeq.count('N')
+    totNucs    = sum(seqLens)
     nonNs      = aCnt+cCnt+gCnt+tCnt
-    n2tot      = float(nCnt)/len(combinedSeq)
+    n2tot      = float(nCnt)/totNucs
     n2nonN     = float(nCnt)/nonNs
     percentGC  = (float(gCnt)+cCnt)/nonNs
     avgLen     = np.mean(seqLens)
@@ -0,0 +1,225 @@
+"""
+####################
+stepCache.py
+####################
+Content-addressed cache of pipeline step outputs.
+
+A step's key is the sha1 of: the versions of the programs it runs, its
+exact argument list, and fingerprints (size+mtime, or md5 when asked) of
+every input file named in those args, plus the files of any index base
+names (ex: bowtie's ebwt) the caller lists as inputs.  Output paths are replaced by
+placeholders before hashing so the same work sent to a different out dir
+still hits.  Outputs of a finished step are copied into <cacheDir>/<key>/
+and copied back out on a hit.  They are never hard-linked: steps such as
+samtools sort or a Step's stdout rewrite their output paths in place, which
+would also rewrite a cached entry sharing the inode.
+"""
+import os
+import sys
+import glob
+import json
+import shutil
+import hashlib
+import tempfile
+import subprocess
+
+from rSeq.utils.errors import *
+from rSeq.utils.misc import Bag
+from rSeq.utils.externals import whereis
+
+_versions = {}
+
+
+# ++++++++ helper defs ++++++++
+def file_md5(path,blockSize=4*1024*1024):
+    """Returns the md5 hexdigest of path's contents."""
+    md5 = hashlib.md5()
+    f = open(path,'rb')
+    for block in iter(lambda: f.read(blockSize),''):
+        md5.update(block)
+    f.close()
+    return md5.hexdigest()
+
+def fingerprint(path,useHash=False):
+    """Returns a str identifying the contents of path (a file or dir)."""
+    if os.path.isdir(path):
+        return ';'.join(['%s=%s' % (os.path.relpath(p,path),fingerprint(p,useHash)) for p in sorted(_walk_files(path))])
+    if useHash:
+        return 'md5:%s' % (file_md5(path))
+    stat = os.stat(path)
+    return 'size:%s,mtime:%s' % (stat.st_size,int(stat.st_mtime))
+
+def tool_version(progName):
+    """Returns a str identifying the version of progName (cached per process).
+    Uses the first line mentioning 'version' in the output of
+    "progName --version" (samtools 0.1.x prints it with its usage text); falls
+    back to the fingerprint of the executable."""
+    if progName in _versions:
+        return _versions[progName]
+    path = whereis(progName) or progName
+    version = None
+    try:
+        proc = subprocess.Popen([path,'--version'],stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
+        out = proc.communicate()[0]
+        for line in out.splitlines():
+            if 'version' in line.lower():
+                version = line.strip()
+                break
+    except OSError:
+        pass
+    if not version and os.path.exists(path):
+        version = fingerprint(path)
+    _versions[progName] = version or 'unknown'
+    return _versions[progName]
+
+def _walk_files(path):
+    if not os.path.isdir(path):
+        return [path]
+    files = []
+    for root,dirs,names in os.walk(path):
+        files.extend([os.path.join(root,n) for n in names])
+    return files
+
+def _input_paths(arg,indexes=()):
+    """Returns the existing files named by a cmd line arg: the arg itself, the
+    members of a comma-separated list, or (only for the index base names in
+    <indexes>, like bowtie's) the files starting with arg + '.' here or in
+    $BOWTIE_INDEXES."""
+    paths = []
+    for part in arg.split(','):
+        if not part:
+            continue
+        if os.path.exists(part):
+            paths.append(part)
+            continue
+        if part not in indexes:
+            continue
+        for base in [part,os.path.join(os.environ.get('BOWTIE_INDEXES',''),part)]:
+            matches = sorted(glob.glob(base + '.*'))
+            if matches:
+                paths.extend(matches)
+                break
+    return paths
+
+def _copy(src,dest):
+    """Copies file or dir src to dest, replacing dest."""
+    if os.path.lexists(dest):
+        if os.path.isdir(dest) and not os.path.islink(dest):
+            shutil.rmtree(dest)
+        else:
+            os.remove(dest)
+    if os.path.isdir(src):
+        os.makedirs(dest)
+        for name in os.listdir(src):
+            _copy(os.path.join(src,name),os.path.join(dest,name))
+        return
+    destDir = os.path.dirname(os.path.abspath(dest))
+    if not os.path.isdir(destDir):
+        os.makedirs(destDir)
+    shutil.copy2(src,dest)
+
+
+# ++++++++ classes ++++++++
+class StepCache(object):
+    """On-disk cache of step outputs keyed by their inputs, tools and options."""
+    def __init__(self,cacheDir,useHash=False):
+        """
+        cacheDir : where cached outputs are kept
+        useHash  : fingerprint inputs by md5 of their contents instead of size+mtime
+        """
+        self.cacheDir = os.path.abspath(cacheDir)
+        self.useHash  = useHash
+        if not os.path.isdir(self.cacheDir):
+            os.makedirs(self.cacheDir)
+
+    def key(self,cmds,outputs=(),inputs=()):
+        """Returns the cache key of a step.
+        cmds    : one args list, or a list of args lists (a pipe)
+        outputs : paths the step writes (not treated as inputs)
+        inputs  : index base names in cmds (ex: bowtie's ebwt) whose
+                  <name>.* files are read by the step; other args are only
+                  treated as inputs when they are existing paths"""
+        if not isinstance(cmds[0],(list,tuple)):
+            cmds = [cmds]
+        outNames = {}
+        for i,path in enumerate(outputs):
+            outNames[path] = '<out%s>' % (i)
+            prefix = os.path.splitext(path)[0]
+            if (prefix != path) and not os.path.exists(prefix):
+                outNames[prefix] = '<out%s:prefix>' % (i) # ex: samtools sort's out.prefix
+        parts = []
+        for args in cmds:
+            args = [str(x) for x in args]
+            tool = args[0]
+            parts.append(['tool',os.path.basename(tool),tool_version(tool)])
+            for arg in args[1:]:
+                if arg in outNames:
+                    parts.append(['out',outNames[arg]])
+                    continue
+                paths = _input_paths(arg,inputs)
+                if paths:
+                    parts.append(['in',arg.startswith('-') and arg or os.path.basename(arg),
+                                  [fingerprint(p,self.useHash) for p in paths]])
+                else:
+                    parts.append(['arg',arg])
+        return hashlib.sha1(json.dumps(parts,sort_keys=True)).hexdigest()
+
+    def _entryDir(self,key):
+        return os.path.join(self.cacheDir,key)
+
+    def restore(self,key,outputs):
+        """If key is cached, copies its outputs to the paths in <outputs> and returns True."""
+        entry = self._entryDir(key)
+        manifestPath = os.path.join(entry,'manifest.json')
+        if not os.path.exists(manifestPath):
+            return False
+        manifest = json.load(open(manifestPath))
+        if len(manifest['outputs']) != len(outputs):
+            return False
+        cached = [os.path.join(entry,name) for name in manifest['outputs']]
+        if [p for p in cached if not os.path.exists(p)]:
+            return False
+        for src,dest in zip(cached,outputs):
+            _copy(src,dest)
+        return True
+
+    def store(self,key,outputs,info=None):
+        """Copies finished <outputs> into the cache under key."""
+        missing = [p for p in outputs if not os.path.exists(p)]
+        if missing:
+            raise SanityCheckError("StepCache: can not cache missing outputs: %s" % (missing))
+        entry = self._entryDir(key)
+        tmpEntry = tempfile.mkdtemp(prefix='%s.tmp' % (key),dir=self.cacheDir)
+        names = []
+        for i,path in enumerate(outputs):
+            name = '%s.%s' % (i,os.path.basename(path.rstrip('/')))
+            _copy(path,os.path.join(tmpEntry,name))
+            names.append(name)
+        manifest = open(os.path.join(tmpEntry,'manifest.json'),'w')
+        json.dump({'outputs':names,'info':info or {}},manifest)
+        manifest.close()
+        if os.path.exists(entry):
+            shutil.rmtree(entry)
+        os.rename(tmpEntry,entry)
+
+
+# ++++++++ meta functions ++++++++
+def cached_run(cache,cmds,outputs,runFunc,*args,**kwargs):
+    """
+    Runs runFunc(*args,**kwargs) unless <cache> (a StepCache or None) already
+    holds the <outputs> of the step described by <cmds>; in that case the
+    cached outputs are copied into place instead.  An 'inputs' kwarg (index
+    base names, see StepCache.key()) is used for the key and not passed on.
+
+    RETURN: runFunc's return value, or Bag(cached=True,key=key) on a hit.
+    """
+    inputs = kwargs.pop('inputs',())
+    if cache == None:
+        return runFunc(*args,**kwargs)
+    key = cache.key(cmds,outputs,inputs)
+    if cache.restore(key,outputs):
+        sys.stderr.write("[stepCache] reusing cached %s\n" % (', '.join(outputs)))
+        return Bag({'cached':True,'key':key})
+    results = runFunc(*args,**kwargs)
+    cache.store(key,outputs,info={'cmds':cmds})
+    return results
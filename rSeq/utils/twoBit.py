@@ -0,0 +1,293 @@
+"""
+####################
+twoBit.py
+####################
+Compact, array-backed nucleotide sequences packed at 2 bits per base with
+side masks for N and soft-masked (lowercase) runs.  Sequences can be written
+to and loaded from UCSC-style ".2bit" files.
+"""
+import os
+import struct
+
+import numpy as np
+
+from rSeq.utils.errors import *
+
+# ++++++++ useful constants ++++++++
+TWOBIT_SIGNATURE = 0x1A412743
+
+# UCSC packing order: T=0, C=1, A=2, G=3 (so complement == code ^ 2)
+_code2base = np.frombuffer('TCAG',dtype=np.uint8)
+_base2code = np.zeros(256,dtype=np.uint8)
+for _i,_b in enumerate('TCAG'):
+    _base2code[ord(_b)] = _i
+    _base2code[ord(_b.lower())] = _i
+_isACGT = np.zeros(256,dtype=bool)
+_isACGT[[ord(x) for x in 'ACGTacgt']] = True
+_isLower = np.zeros(256,dtype=bool)
+_isLower[ord('a'):ord('z')+1] = True
+
+
+# ++++++++ helper defs ++++++++
+def _runs(boolArray):
+    """Returns (starts,sizes) arrays of the runs of True in boolArray."""
+    if not len(boolArray):
+        return np.zeros(0,dtype=np.int64),np.zeros(0,dtype=np.int64)
+    edges  = np.diff(np.concatenate(([0],boolArray.view(np.int8),[0])))
+    starts = np.flatnonzero(edges == 1)
+    ends   = np.flatnonzero(edges == -1)
+    return starts,ends-starts
+
+def _clipRuns(starts,sizes,start,end):
+    """Returns (starts,sizes) of the runs clipped to [start,end) and
+    shifted so that start becomes 0."""
+    ends   = starts + sizes
+    keep   = (ends > start) & (starts < end)
+    starts = np.maximum(starts[keep],start)
+    ends   = np.minimum(ends[keep],end)
+    return starts-start,ends-starts
+
+def _pack(codes):
+    """Returns uint8 array holding codes 4 to a byte (first base in the high bits)."""
+    pad = (-len(codes)) % 4
+    if pad:
+        codes = np.concatenate((codes,np.zeros(pad,dtype=np.uint8)))
+    codes = codes.reshape(-1,4)
+    return ((codes[:,0] << 6) | (codes[:,1] << 4) | (codes[:,2] << 2) | codes[:,3]).astype(np.uint8)
+
+
+# ++++++++ classes ++++++++
+class PackedSeq(object):
+    """A nucleotide sequence stored at 2 bits per base.
+
+    N runs and soft-masked runs are kept as (starts,sizes) arrays.  Slices
+    share the packed array of their parent so slicing does not copy the seq."""
+
+    def __init__(self,packed,length,nBlocks=None,maskBlocks=None,start=0):
+        """Fill in from already packed data; usually you want PackedSeq.from_str().
+
+        packed     : uint8 array holding 4 bases per byte (UCSC .2bit layout)
+        length     : number of bases
+        nBlocks    : (starts,sizes) of N runs relative to this seq
+        maskBlocks : (starts,sizes) of lowercase runs relative to this seq
+        start      : offset of this seq's first base inside packed
+        """
+        empty = (np.zeros(0,dtype=np.int64),np.zeros(0,dtype=np.int64))
+        self._packed    = packed
+        self._start     = start
+        self.length     = length
+        self.nBlocks    = nBlocks    if nBlocks    != None else empty
+        self.maskBlocks = maskBlocks if maskBlocks != None else empty
+
+    @classmethod
+    def from_str(cls,seq):
+        """Returns PackedSeq built from a nucleotide string.  Anything that is
+        not A,C,G or T is recorded as N."""
+        raw = np.frombuffer(str(seq),dtype=np.uint8)
+        return cls(_pack(_base2code[raw]),
+                   len(raw),
+                   nBlocks=_runs(~_isACGT[raw]),
+                   maskBlocks=_runs(_isLower[raw]))
+
+    def __len__(self):
+        return self.length
+
+    def __str__(self):
+        return self.to_str()
+
+    def __repr__(self):
+        return "PackedSeq(length=%s)" % (self.length)
+
+    def __eq__(self,other):
+        return str(self) == str(other)
+
+    def __ne__(self,other):
+        return not self.__eq__(other)
+
+    def __getitem__(self,index):
+        """seq[i] returns a str; seq[i:j] returns a PackedSeq that shares this one's data."""
+        if isinstance(index,slice):
+            start,end,step = index.indices(self.length)
+            if step != 1:
+                raise InvalidOptionError(step,'slice step',[1])
+            end = max(start,end)
+            return PackedSeq(self._packed,
+                             end-start,
+                             nBlocks=_clipRuns(self.nBlocks[0],self.nBlocks[1],start,end),
+                             maskBlocks=_clipRuns(self.maskBlocks[0],self.maskBlocks[1],start,end),
+                             start=self._start+start)
+        if index < 0:
+            index += self.length
+        if not (0 <= index < self.length):
+            raise IndexError('PackedSeq index out of range')
+        return self[index:index+1].to_str()
+
+    def codes(self):
+        """Returns uint8 array with one 2-bit code (T=0,C=1,A=2,G=3) per base.
+        N positions hold whatever code was packed there (T when built here)."""
+        first  = self._start // 4
+        last   = (self._start + self.length + 3) // 4
+        chunk  = np.asarray(self._packed[first:last],dtype=np.uint8)
+        codes  = np.empty((len(chunk),4),dtype=np.uint8)
+        codes[:,0] = chunk >> 6
+        codes[:,1] = (chunk >> 4) & 3
+        codes[:,2] = (chunk >> 2) & 3
+        codes[:,3] = chunk & 3
+        offset = self._start - first*4
+        return codes.ravel()[offset:offset+self.length]
+
+    def to_str(self):
+        """Returns the seq as a str with N and soft-masked runs restored."""
+        letters = _code2base[self.codes()]
+        for start,size in zip(*self.nBlocks):
+            letters[start:start+size] = ord('N')
+        for start,size in zip(*self.maskBlocks):
+            letters[start:start+size] += 32 # ord('a') - ord('A')
+        return letters.tostring()
+
+    def revComp(self):
+        """Returns the reverse complement as a new PackedSeq."""
+        length = self.length
+        def _flip(blocks):
+            starts,sizes = blocks
+            return (length-(starts+sizes))[::-1],sizes[::-1]
+        return PackedSeq(_pack(self.codes()[::-1] ^ 2),
+                         length,
+                         nBlocks=_flip(self.nBlocks),
+                         maskBlocks=_flip(self.maskBlocks))
+
+    def packed(self):
+        """Returns the uint8 array of this seq's bases packed from its own first base
+        (copies only if this seq is an unaligned slice)."""
+        if self._start % 4 == 0:
+            first = self._start // 4
+            return np.asarray(self._packed[first:first+(self.length+3)//4],dtype=np.uint8)
+        return _pack(self.codes())
+
+
+class TwoBitFile(object):
+    """Returns a lazy reader of a ".2bit" file; records are memory-mapped as they are requested."""
+    def __init__(self,filePath):
+        """Reads the header and index of filePath.
+        Exmpl: TwoBitFile('AaegL1.2bit')['supercont1.1'][1000:3000].to_str()
+        """
+        self.name = os.path.abspath(filePath)
+        self._file = open(filePath,'rb')
+
+        sig = struct.unpack('<I',self._file.read(4))[0]
+        if sig == TWOBIT_SIGNATURE:
+            self._end = '<'
+        elif sig == struct.unpack('>I',struct.pack('<I',TWOBIT_SIGNATURE))[0]:
+            self._end = '>'
+        else:
+            raise InvalidFileFormatError("TwoBitFile: %s does not have a .2bit signature." % (filePath))
+        version,seqCount,reserved = struct.unpack(self._end+'III',self._file.read(12))
+        if version != 0:
+            raise InvalidFileFormatError("TwoBitFile: unsupported .2bit version (%s) in %s." % (version,filePath))
+
+        self.offsets = {}
+        self.names   = []
+        for i in xrange(seqCount):
+            nameSize = ord(self._file.read(1))
+            name     = self._file.read(nameSize)
+            self.offsets[name] = struct.unpack(self._end+'I',self._file.read(4))[0]
+            self.names.append(name)
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __contains__(self,name):
+        return name in self.offsets
+
+    def __len__(self):
+        return len(self.names)
+
+    def _readInts(self,count):
+        return np.fromfile(self._file,dtype=np.dtype(self._end+'u4'),count=count).astype(np.int64)
+
+    def __getitem__(self,name):
+        """Returns PackedSeq of rec name (the packed bases are memory-mapped, not read)."""
+        try:
+            self._file.seek(self.offsets[name])
+        except KeyError:
+            raise InvalidOptionError(name,'name')
+        dnaSize,nCount = struct.unpack(self._end+'II',self._file.read(8))
+        nBlocks   = (self._readInts(nCount),self._readInts(nCount))
+        maskCount = struct.unpack(self._end+'I',self._file.read(4))[0]
+        maskBlocks = (self._readInts(maskCount),self._readInts(maskCount))
+        self._file.read(4) # reserved
+        packedSize = (dnaSize+3)//4
+        if packedSize:
+            packed = np.memmap(self.name,dtype=np.uint8,mode='r',offset=self._file.tell(),shape=(packedSize,))
+        else:
+            packed = np.zeros(0,dtype=np.uint8)
+        return PackedSeq(packed,dnaSize,nBlocks=nBlocks,maskBlocks=maskBlocks)
+
+    def to_dict(self):
+        """Returns a Dict of name:PackedSeq for every rec in the file."""
+        return dict([(name,self[name]) for name in self.names])
+
+    def close(self):
+        self._file.close()
+
+
+# ++++++++ meta functions ++++++++
+def write_twoBit(seqDict,outPath,order=None):
+    """
+    GIVEN:
+    1) seqDict: dict of name:seq (seq can be a str or a PackedSeq)
+    2) outPath: path to the new ".2bit" file
+    3) order: list of names setting the rec order (default: sorted(seqDict))
+
+    DO:
+    1) pack every seq and write them with their N and mask blocks in the
+       UCSC ".2bit" layout (little-endian).
+
+    RETURN:
+    1) outPath
+    """
+    if order == None:
+        order = sorted(seqDict.keys())
+
+    packedSeqs = []
+    for name in order:
+        seq = seqDict[name]
+        if not isinstance(seq,PackedSeq):
+            seq = PackedSeq.from_str(seq)
+        if len(name) > 255:
+            raise InvalidOptionError(name,'name','names of 255 characters or less')
+        packedSeqs.append((name,seq))
+
+    # header(16) + index entries(1 + len(name) + 4)
+    offset = 16 + sum([5 + len(name) for name,seq in packedSeqs])
+    outFile = open(outPath,'wb')
+    outFile.write(struct.pack('<IIII',TWOBIT_SIGNATURE,0,len(packedSeqs),0))
+    for name,seq in packedSeqs:
+        outFile.write(struct.pack('<B',len(name)) + name + struct.pack('<I',offset))
+        offset += 16 + 8*len(seq.nBlocks[0]) + 8*len(seq.maskBlocks[0]) + (len(seq)+3)//4
+
+    for name,seq in packedSeqs:
+        outFile.write(struct.pack('<II',len(seq),len(seq.nBlocks[0])))
+        for blockArray in seq.nBlocks:
+            outFile.write(np.asarray(blockArray,dtype='<u4').tostring())
+        outFile.write(struct.pack('<I',len(seq.maskBlocks[0])))
+        for blockArray in seq.maskBlocks:
+            outFile.write(np.asarray(blockArray,dtype='<u4').tostring())
+        outFile.write(struct.pack('<I',0))
+        outFile.write(seq.packed().tostring())
+    outFile.close()
+
+    return outPath
+
+def fasta2twoBit(fastaPath,outPath=None):
+    """Packs every rec of fastaPath into outPath (default: fastaPath + '.2bit')
+    and returns outPath.  Only the packed seqs are held in memory."""
+    from rSeq.utils.files import ParseFastA
+    if not outPath:
+        outPath = fastaPath + '.2bit'
+    seqs  = {}
+    order = []
+    for name,seq in ParseFastA(fastaPath):
+        seqs[name] = PackedSeq.from_str(seq)
+        order.append(name)
+    return write_twoBit(seqs,outPath,order=order)